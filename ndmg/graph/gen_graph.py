@@ -30,8 +30,10 @@ import nibabel as nib
 import time
 import os
 from dipy.tracking._utils import (_mapping_to_voxel, _to_voxel_coordinates)
+from scipy.sparse import coo_matrix, csr_matrix, triu
 from itertools import combinations
 from collections import defaultdict
+from functools import lru_cache
 
 
 def get_sphere(coords, r, vox_dims, dims):
@@ -68,6 +70,674 @@ def get_sphere(coords, r, vox_dims, dims):
     neighbors = sphere[(np.min(sphere, 1) >= 0) & (np.max(np.subtract(sphere, dims), 1) <= -1), :].astype(int)
     return neighbors
 
+
+def _node_lut(rois, mx):
+    """
+    Build a lookup table from label intensity to graph node number (1..mx), with 0 marking unlabeled voxels.
+
+    Parameters
+    ----------
+    rois : array
+        Integer label volume.
+    mx : int
+        Number of nodes in the parcellation.
+
+    Returns
+    -------
+    node_lut : array
+        1D array indexed by label intensity that holds the corresponding node number.
+    """
+    labels = np.unique(rois)
+    node_lut = np.zeros(int(labels.max()) + 1, dtype=np.int64)
+    keys = labels[:mx] + 1
+    vals = np.arange(mx) + 1
+    valid = (keys > 0) & (keys < len(node_lut))
+    node_lut[keys[valid]] = vals[valid]
+    return node_lut
+
+
+def _streamline_buffer(tracks):
+    """
+    Return all streamline points as one contiguous (P, 3) array, along with the number of points per streamline.
+
+    Parameters
+    ----------
+    tracks : Streamlines or list
+        A dipy/nibabel ArraySequence or any sequence of (n, 3) arrays.
+
+    Returns
+    -------
+    points : array
+        (P, 3) array of every streamline point, in streamline order.
+    lengths : array
+        1D array with the number of points in each streamline.
+    """
+    if hasattr(tracks, "_data") and hasattr(tracks, "_offsets"):
+        lengths = np.asarray(tracks._lengths, dtype=np.int64)
+        offsets = np.asarray(tracks._offsets, dtype=np.int64)
+        # Streamlines built straight from a generator are packed, so the buffer can be used without a copy
+        if len(lengths) == 0:
+            return np.zeros((0, 3), dtype=np.float32), lengths
+        if np.array_equal(offsets, np.cumsum(lengths) - lengths) and len(tracks._data) == lengths.sum():
+            return tracks._data, lengths
+    lengths = np.array([len(s) for s in tracks], dtype=np.int64)
+    if len(lengths) == 0:
+        return np.zeros((0, 3), dtype=np.float32), lengths
+    return np.concatenate([np.asarray(s) for s in tracks]), lengths
+
+
+def _edge_counts(nodes, sl_ids, mx, overlap_thr=1, weights=None):
+    """
+    Count, for every pair of nodes, the number of streamlines that pass through both.
+
+    Parameters
+    ----------
+    nodes : array
+        Node number (1..mx, 0 for unlabeled) of every streamline point.
+    sl_ids : array
+        Index of the streamline each point belongs to.
+    mx : int
+        Number of nodes in the parcellation.
+    overlap_thr : int
+        Minimum number of points a streamline must place in a node for that node to be counted.
+    weights : array
+        Optional (n_streamlines, W) array of per-streamline values to sum over the streamlines of each edge.
+
+    Returns
+    -------
+    counts : list
+        (mx, mx) upper-triangular csr_matrix of streamline counts per edge, followed by one matrix of per-edge sums for
+        each column of `weights`.
+    """
+    keep = nodes > 0
+    key = sl_ids[keep].astype(np.int64) * (mx + 1) + nodes[keep]
+    key, hits = np.unique(key, return_counts=True)
+    key = key[hits >= overlap_thr]
+    sl, node = np.divmod(key, mx + 1)
+
+    # Within a streamline, nodes are sorted, so pairing each node with those after it yields every edge once with
+    # row < col, exactly as combinations() over the sorted label set would.
+    starts = np.flatnonzero(np.r_[True, sl[1:] != sl[:-1]]) if len(sl) else np.zeros(0, dtype=np.int64)
+    sizes = np.diff(np.r_[starts, len(sl)])
+    rank = np.arange(len(sl)) - np.repeat(starts, sizes)
+    n_partners = np.repeat(sizes, sizes) - rank - 1
+    first = np.repeat(np.arange(len(sl)), n_partners)
+    run_start = np.repeat(np.cumsum(n_partners) - n_partners, n_partners)
+    second = first + 1 + np.arange(len(first)) - run_start
+
+    rows, cols = node[first] - 1, node[second] - 1
+    values = [np.ones(len(first))]
+    if weights is not None:
+        values.extend(weights[sl[first]].T)
+    return [coo_matrix((vals, (rows, cols)), shape=(mx, mx)).tocsr() for vals in values]
+
+
+def _node_stack(rois_list):
+    """
+    Stack aligned label volumes into one multi-channel volume of node numbers, so that every parcellation can be
+    looked up with a single fancy-index per streamline point.
+
+    Parameters
+    ----------
+    rois_list : list
+        Integer label volumes, all in the same voxel grid.
+
+    Returns
+    -------
+    node_stack : array
+        (X, Y, Z, A) array holding, for each of the A parcellations, the node number (1..mx, 0 for unlabeled) of each
+        voxel.
+    mxs : list
+        Number of nodes in each parcellation.
+    """
+    shapes = set([rois.shape for rois in rois_list])
+    if len(shapes) > 1:
+        raise ValueError("Label volumes must share a voxel grid to be labeled together, got shapes {}".format(shapes))
+    mxs = [len(np.unique(rois.astype(np.int64))) - 1 for rois in rois_list]
+    dtype = np.uint16 if max(mxs) < np.iinfo(np.uint16).max else np.int64
+    node_stack = np.empty(rois_list[0].shape + (len(rois_list),), dtype=dtype)
+    for idx, (rois, mx) in enumerate(zip(rois_list, mxs)):
+        node_stack[..., idx] = _node_lut(rois, mx)[rois.clip(min=0)]
+    return node_stack, mxs
+
+
+@lru_cache(maxsize=None)
+def _sphere_kernel(r, vox_dims):
+    """
+    Return the integer voxel offsets of every voxel center within r mm of the origin. Computed once per
+    (radius, voxel size) and reused for every streamline endpoint.
+
+    Parameters
+    ----------
+    r : float
+        Radius for sphere, in mm.
+    vox_dims : tuple
+        (x, y, z) mm voxel resolution.
+
+    Returns
+    -------
+    kernel : array
+        (K, 3) array of voxel offsets, including the origin.
+    """
+    vox_dims = np.asarray(vox_dims, dtype=float)
+    reach = np.floor(float(r) / vox_dims + 1e-6).astype(int)
+    cube = np.mgrid[-reach[0]:reach[0] + 1, -reach[1]:reach[1] + 1, -reach[2]:reach[2] + 1].reshape(3, -1).T
+    kernel = cube[np.sqrt(np.sum((cube * vox_dims) ** 2, axis=1)) <= float(r) + 1e-6]
+    kernel.setflags(write=False)
+    return kernel
+
+
+def _densify(points, lengths, max_step):
+    """
+    Resample concatenated streamlines so that no segment is longer than `max_step`, by linear interpolation between
+    the stored points. Used to restore the point density of compressed tractograms before labeling, so that no voxel a
+    straight segment passes through is skipped.
+    """
+    if not len(points):
+        return points, lengths
+    starts = np.cumsum(lengths) - lengths
+    is_start = np.zeros(len(points), dtype=bool)
+    is_start[starts] = True
+    seg_lengths = np.sqrt(np.sum(np.diff(points, axis=0) ** 2, axis=1))
+
+    # Each point stands for the segment that ends at it, split into `counts` pieces; first points stand for themselves
+    counts = np.ones(len(points), dtype=np.int64)
+    counts[1:] = np.maximum(np.ceil(seg_lengths / max_step), 1)
+    counts[is_start] = 1
+    ends = np.repeat(np.arange(len(points)), counts)
+    begins = np.where(is_start[ends], ends, ends - 1)
+    step = np.arange(len(ends)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    frac = (step / np.repeat(counts, counts).astype(np.float64))[:, np.newaxis]
+    dense = points[begins] + frac * (points[ends] - points[begins])
+    dense_lengths = np.add.reduceat(counts, starts) if len(starts) else lengths
+    return dense.astype(points.dtype), dense_lengths.astype(lengths.dtype)
+
+
+def _block_counts(
+    points, lengths, node_stack, mxs, lin_T, offset, overlap_thr=1, kernel=None, edge_lengths=False, scalar_stack=None,
+    max_step=None,
+):
+    """
+    Label one block of concatenated streamline points and return its partial matrices for each parcellation.
+    If a sphere `kernel` is given, only the two endpoints of each streamline are labeled, each dilated by the kernel.
+    Streamline lengths and mean scalar samples are reduced per streamline from the same block of points.
+    If `max_step` is given, the streamlines are first resampled to at most that spacing.
+    """
+    if max_step:
+        points, lengths = _densify(points, lengths, max_step)
+    point_ids = np.repeat(np.arange(len(lengths)), lengths)
+    voxels = None
+    if kernel is None or scalar_stack is not None:
+        voxels = _to_voxel_coordinates(points, lin_T, offset)
+    if kernel is None:
+        i, j, k = voxels.T
+        nodes = node_stack[i, j, k].astype(np.int64)
+        sl_ids = point_ids
+    else:
+        ends = np.cumsum(lengths) - 1
+        endpoints = _to_voxel_coordinates(points[np.r_[ends - lengths + 1, ends]], lin_T, offset)
+        samples = (endpoints[:, np.newaxis, :] + kernel[np.newaxis, :, :]).reshape(-1, 3)
+        sl_ids = np.repeat(np.tile(np.arange(len(lengths)), 2), len(kernel))
+        in_bounds = np.all((samples >= 0) & (samples < np.array(node_stack.shape[:3])), axis=1)
+        i, j, k = samples[in_bounds].T
+        nodes = node_stack[i, j, k].astype(np.int64)
+        sl_ids = sl_ids[in_bounds]
+
+    weights = []
+    if edge_lengths:
+        # Segment reduction: sum the length of every segment whose two points belong to the same streamline
+        same = point_ids[1:] == point_ids[:-1]
+        segments = np.sqrt(np.sum(np.diff(points, axis=0) ** 2, axis=1))
+        weights.append(np.bincount(point_ids[1:][same], weights=segments[same], minlength=len(lengths)))
+    if scalar_stack is not None:
+        i, j, k = voxels.T
+        samples = scalar_stack[i, j, k]
+        for idx in range(samples.shape[1]):
+            weights.append(
+                np.bincount(point_ids, weights=samples[:, idx], minlength=len(lengths)) / np.maximum(lengths, 1)
+            )
+    weights = np.column_stack(weights) if weights else None
+
+    return [
+        _edge_counts(nodes[:, idx], sl_ids, mx, overlap_thr=overlap_thr, weights=weights)
+        for idx, mx in enumerate(mxs)
+    ]
+
+
+def _to_shared(arr):
+    """
+    Copy an array into shared memory that pool workers inherit, returning what they need to view it again.
+    """
+    import multiprocessing
+
+    buf = multiprocessing.RawArray("B", arr.nbytes)
+    np.frombuffer(buf, dtype=arr.dtype).reshape(arr.shape)[...] = arr
+    return buf, arr.shape, arr.dtype
+
+
+def _from_shared(shared):
+    buf, shape, dtype = shared
+    return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+
+# Per-process state of connectome workers, set once by _init_counts_worker so the label volume is never pickled
+_worker_state = {}
+
+
+def _init_counts_worker(shared_nodes, shared_scalars, args, kwargs):
+    _worker_state["node_stack"] = _from_shared(shared_nodes)
+    _worker_state["args"] = args
+    _worker_state["kwargs"] = dict(kwargs)
+    if shared_scalars is not None:
+        _worker_state["kwargs"]["scalar_stack"] = _from_shared(shared_scalars)
+
+
+def _worker_block_counts(block):
+    points, lengths = block
+    return _block_counts(
+        points, lengths, _worker_state["node_stack"], *_worker_state["args"], **_worker_state["kwargs"]
+    )
+
+
+def _tree_reduce(blocks):
+    """
+    Sum a list of per-block results pairwise, so that no single accumulator is added to more than log2(n) times.
+    Each block is a list of sparse matrices, which are summed elementwise.
+    """
+    while len(blocks) > 1:
+        blocks = [
+            [a + b for a, b in zip(blocks[idx], blocks[idx + 1])] if idx + 1 < len(blocks) else blocks[idx]
+            for idx in range(0, len(blocks), 2)
+        ]
+    return blocks[0]
+
+
+def streamline_counts(
+    tracks, node_stack, mxs, lin_T, offset, overlap_thr=1, chunk_size=100000, n_jobs=1, kernel=None,
+    edge_lengths=False, scalar_stack=None, max_step=None,
+):
+    """
+    Vectorized streamline-to-connectome engine. Concatenates all streamline points, maps them to voxel coordinates
+    once, labels them in every parcellation with a single fancy-index into the stacked node volume, and reduces node
+    pairs into sparse matrices per parcellation.
+
+    With `n_jobs` > 1, blocks of `chunk_size` streamlines are labeled in a process pool that reads the node volume from
+    shared memory, and the partial matrices are combined with a tree reduction.
+
+    Parameters
+    ----------
+    tracks : Streamlines or list
+        Streamlines in the voxel space of the label volumes.
+    node_stack : array
+        (X, Y, Z, A) stack of node numbers, as returned by `_node_stack`.
+    mxs : list
+        Number of nodes in each of the A parcellations.
+    lin_T : array
+        Linear part of the streamline-to-voxel mapping, as returned by `_mapping_to_voxel`.
+    offset : array
+        Offset part of the streamline-to-voxel mapping, as returned by `_mapping_to_voxel`.
+    overlap_thr : int
+        Minimum number of points a streamline must place in a node for that node to be counted.
+    chunk_size : int
+        Number of streamlines labeled per block.
+    n_jobs : int
+        Number of worker processes. Values below 1 use every available core.
+    kernel : array
+        Optional (K, 3) voxel offsets from `_sphere_kernel`. If given, streamlines are labeled by the nodes within the
+        kernel around their two endpoints instead of by every point.
+    edge_lengths : bool
+        Whether to sum streamline lengths, in streamline coordinate units, over the streamlines of each edge.
+    scalar_stack : array
+        Optional (X, Y, Z, S) stack of scalar maps in the voxel grid of `node_stack`. The mean sample along each
+        streamline is summed over the streamlines of each edge.
+    max_step : float
+        If set, streamlines are resampled so that no segment is longer than this, in streamline coordinate units,
+        before labeling. Use the tracking step size when the tractogram was stored compressed.
+
+    Returns
+    -------
+    counts : list
+        For each parcellation, a list holding the (mx, mx) upper-triangular csr_matrix of streamline counts per edge,
+        then the per-edge length sums if `edge_lengths`, then the per-edge sums of each scalar map.
+    """
+    import multiprocessing
+
+    points, lengths = _streamline_buffer(tracks)
+    bounds = np.r_[0, np.cumsum(lengths)]
+    blocks = (
+        (points[bounds[start]:bounds[min(start + chunk_size, len(lengths))]],
+         lengths[start:min(start + chunk_size, len(lengths))])
+        for start in range(0, len(lengths), chunk_size)
+    )
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, max(1, int(np.ceil(len(lengths) / float(chunk_size)))))
+
+    n_mats = 1 + int(bool(edge_lengths)) + (scalar_stack.shape[-1] if scalar_stack is not None else 0)
+    empty = [[csr_matrix((mx, mx)) for _ in range(n_mats)] for mx in mxs]
+    args = (mxs, lin_T, offset, overlap_thr)
+    kwargs = dict(kernel=kernel, edge_lengths=edge_lengths, max_step=max_step)
+
+    if n_jobs == 1:
+        counts = empty
+        for block_points, block_lengths in blocks:
+            block = _block_counts(block_points, block_lengths, node_stack, *args, scalar_stack=scalar_stack, **kwargs)
+            counts = [[a + b for a, b in zip(count, partial)] for count, partial in zip(counts, block)]
+        return counts
+
+    print("Labeling streamlines with {} workers...".format(n_jobs))
+    shared_scalars = _to_shared(scalar_stack) if scalar_stack is not None else None
+    pool = multiprocessing.Pool(
+        n_jobs, initializer=_init_counts_worker, initargs=(_to_shared(node_stack), shared_scalars, args, kwargs)
+    )
+    partials = [[mats] for mats in empty]
+    try:
+        for block in pool.imap(_worker_block_counts, blocks):
+            for idx, mats in enumerate(block):
+                partials[idx].append(mats)
+    finally:
+        pool.close()
+        pool.join()
+    return [_tree_reduce(partial) for partial in partials]
+
+
+class connectome(object):
+    def __init__(self, counts, node_labels, edge_attrs=None, **attr):
+        """
+        A compact, undirected connectome stored as an upper-triangular sparse matrix plus an array of node labels.
+        Dense and networkx representations are only built when they are asked for.
+
+        **Positional Arguments:**
+                counts:
+                    - (N, N) matrix or sparse matrix of edge weights. Only the upper triangle is kept, so symmetric and
+                      upper-triangular inputs are both accepted.
+                node_labels:
+                    - Array of N node labels, used to name nodes on export.
+                edge_attrs:
+                    - Optional dict of additional (N, N) edge attribute matrices, such as mean fiber length. Values
+                      are stored aligned with the edges of `counts`.
+                attr:
+                    - Graph attributes, carried over to networkx and graphml exports.
+        """
+        self.triu = triu(csr_matrix(counts, dtype=np.float64), k=1, format="csr")
+        self.triu.eliminate_zeros()
+        self.triu.sort_indices()
+        self.node_labels = np.asarray(node_labels)
+        self.edge_attrs = {}
+        if edge_attrs:
+            rows, cols, _ = self.edges()
+            for name, mat in edge_attrs.items():
+                self.edge_attrs[name] = np.asarray(csr_matrix(mat, dtype=np.float64)[rows, cols]).ravel()
+        self.graph = dict(attr)
+        self.graph["vcount"] = len(self.node_labels)
+        self.graph["ecount"] = self.number_of_edges()
+
+    def number_of_nodes(self):
+        return len(self.node_labels)
+
+    def number_of_edges(self):
+        return self.triu.nnz
+
+    def edges(self, weight="weight"):
+        """
+        Returns the (row, col, value) arrays of every edge, in row-major order, without copying the values. `weight`
+        selects the streamline count ("weight") or one of `edge_attrs`.
+        """
+        rows = np.repeat(np.arange(self.triu.shape[0]), np.diff(self.triu.indptr))
+        values = self.triu.data if weight == "weight" else self.edge_attrs[weight]
+        return rows, self.triu.indices, values
+
+    def to_dense(self, weight="weight"):
+        """
+        Returns the full symmetric matrix of streamline counts, or of one of `edge_attrs`.
+        """
+        rows, cols, values = self.edges(weight)
+        conn_matrix = np.zeros(self.triu.shape)
+        conn_matrix[rows, cols] = values
+        return conn_matrix + conn_matrix.T
+
+    def to_networkx(self):
+        """
+        Returns the connectome as a networkx graph, with nodes named by `node_labels`.
+        """
+        g = nx.Graph(**self.graph)
+        g.add_nodes_from(self.node_labels.tolist())
+        rows, cols, weights = self.edges()
+        g.add_weighted_edges_from(
+            zip(self.node_labels[rows].tolist(), self.node_labels[cols].tolist(), weights.tolist())
+        )
+        for name, values in self.edge_attrs.items():
+            nx.set_edge_attributes(
+                g, dict(zip(zip(self.node_labels[rows].tolist(), self.node_labels[cols].tolist()), values.tolist())),
+                name,
+            )
+        return g
+
+    def write_edgelist(self, graphname, delimiter=" ", weight="weight"):
+        """
+        Writes one "<node> <node> <value>" line per edge, in the format of nx.write_weighted_edgelist. `weight`
+        selects the streamline count ("weight") or one of `edge_attrs`.
+        """
+        rows, cols, weights = self.edges(weight)
+        with open(graphname, "w", encoding="utf-8") as f:
+            for u, v, w in zip(self.node_labels[rows].tolist(), self.node_labels[cols].tolist(), weights.tolist()):
+                f.write("{}{}{}{}{}\n".format(u, delimiter, v, delimiter, w))
+
+    def write_graphml(self, graphname):
+        """
+        Writes the connectome as GraphML, with a double-valued `weight` attribute on each edge, plus one for each of
+        `edge_attrs`.
+        """
+        from xml.sax.saxutils import quoteattr
+
+        rows, cols, weights = self.edges()
+        names = ["weight"] + sorted(self.edge_attrs)
+        values = [weights.tolist()] + [self.edge_attrs[name].tolist() for name in names[1:]]
+        with open(graphname, "w", encoding="utf-8") as f:
+            f.write('<?xml version=\'1.0\' encoding=\'utf-8\'?>\n')
+            f.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns" '
+                    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                    'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns '
+                    'http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">\n')
+            for name in names:
+                f.write('  <key id={} for="edge" attr.name={} attr.type="double" />\n'.format(
+                    quoteattr(name), quoteattr(name)))
+            for key in self.graph:
+                f.write('  <key id={} for="graph" attr.name={} attr.type="string" />\n'.format(
+                    quoteattr("g_" + str(key)), quoteattr(str(key))))
+            f.write('  <graph edgedefault="undirected">\n')
+            for key, val in self.graph.items():
+                f.write('    <data key={}>{}</data>\n'.format(quoteattr("g_" + str(key)), val))
+            for node in self.node_labels.tolist():
+                f.write('    <node id={} />\n'.format(quoteattr(str(node))))
+            for idx, (u, v) in enumerate(zip(self.node_labels[rows].tolist(), self.node_labels[cols].tolist())):
+                f.write('    <edge source={} target={}>\n'.format(quoteattr(str(u)), quoteattr(str(v))))
+                for name, vals in zip(names, values):
+                    f.write('      <data key={}>{}</data>\n'.format(quoteattr(name), vals[idx]))
+                f.write('    </edge>\n')
+            f.write('  </graph>\n</graphml>\n')
+
+    def info(self):
+        """
+        Returns a summary of the connectome, in the format of nx.info.
+        """
+        n_nodes = self.number_of_nodes()
+        n_edges = self.number_of_edges()
+        return "Name: {}\nType: connectome\nNumber of nodes: {}\nNumber of edges: {}\nAverage degree: {:8.4f}".format(
+            self.graph.get("name", ""), n_nodes, n_edges, 2.0 * n_edges / n_nodes if n_nodes else 0.0
+        )
+
+
+def make_graphs(graphs, error_margin=None, overlap_thr=1, voxel_size=2, chunk_size=100000, n_jobs=1,
+                edge_lengths=False, scalar_maps=None, max_step=None):
+    """
+    Builds the connectomes of several parcellations from a single traversal of a shared tractogram. Streamline points
+    are concatenated and converted to voxel coordinates once, and all aligned label volumes are looked up together.
+    Per-edge attributes (fiber length, mean scalar values) are accumulated in the same pass as the counts.
+
+    Parameters
+    ----------
+    graphs : list
+        graph_tools instances sharing the same `tracks`. Label volumes in the same voxel grid are labeled together.
+    error_margin : float
+        Endpoint tolerance, in mm. If set, each streamline is labeled by the nodes within `error_margin` of its two
+        endpoints, rather than by every point along it.
+    overlap_thr : int
+        Minimum number of points a streamline must place in a label for that label to be counted.
+    voxel_size : int
+        Voxel resolution of the label volumes, in mm.
+    chunk_size : int
+        Number of streamlines labeled per block, which bounds the memory used for node pairs.
+    n_jobs : int
+        Number of worker processes that label streamline blocks. Values below 1 use every available core.
+    edge_lengths : bool
+        Whether to store the mean length, in mm, of the streamlines on each edge as the "length" edge attribute.
+    scalar_maps : dict
+        Maps attribute names to scalar volumes (paths or arrays) in the grid of the label volumes, such as FA. The
+        mean value sampled along the streamlines on each edge is stored as the matching edge attribute.
+    max_step : float
+        If set, streamlines are resampled to at most this spacing, in voxels, before labeling. Pass the tracking step
+        size for tractograms stored with compression, whose straight segments would otherwise skip voxels.
+
+    Returns
+    -------
+    conns : list
+        The connectome of each graph_tools instance, which is also stored as its `g` attribute.
+    """
+    if len(set([id(graph.tracks) for graph in graphs])) > 1:
+        raise ValueError("All graphs must share the same streamlines to be built in a single pass.")
+    print("Building connectivity matrices for {} parcellation(s)...".format(len(graphs)))
+
+    # Create voxel-affine mapping
+    lin_T, offset = _mapping_to_voxel(np.eye(4), voxel_size)
+    kernel = None
+    if error_margin:
+        kernel = _sphere_kernel(float(error_margin), (float(voxel_size),) * 3)
+        print("Labeling streamline endpoints within {}mm ({} voxels per endpoint)...".format(error_margin, len(kernel)))
+
+    scalar_names = sorted(scalar_maps) if scalar_maps else []
+    scalars = []
+    for name in scalar_names:
+        scalar = scalar_maps[name]
+        if isinstance(scalar, str):
+            scalar = nib.load(scalar).get_data()
+        scalars.append(np.asarray(scalar, dtype=np.float32))
+
+    tracks = graphs[0].tracks
+    print("# of Streamlines: " + str(len(tracks)))
+
+    # Parcellations are labeled together whenever they share a voxel grid
+    grids = defaultdict(list)
+    for graph in graphs:
+        grids[graph.rois.shape].append(graph)
+    for shape, grid_graphs in grids.items():
+        node_stack, mxs = _node_stack([graph.rois for graph in grid_graphs])
+        scalar_stack = None
+        if scalars:
+            if any(scalar.shape != shape for scalar in scalars):
+                raise ValueError("Scalar maps must be in the voxel grid of the label volumes they are sampled with.")
+            scalar_stack = np.stack(scalars, axis=-1)
+        mats = streamline_counts(
+            tracks, node_stack, mxs, lin_T, offset, overlap_thr=overlap_thr, chunk_size=chunk_size, n_jobs=n_jobs,
+            kernel=kernel, edge_lengths=edge_lengths, scalar_stack=scalar_stack, max_step=max_step,
+        )
+        for graph, (count, *sums), mx in zip(grid_graphs, mats, mxs):
+            names = (["length"] if edge_lengths else []) + scalar_names
+            # Attribute sums become per-edge means; lengths are measured in voxels, so rescale them to mm
+            inv_count = count.copy()
+            inv_count.data = 1.0 / inv_count.data
+            edge_attrs = {name: total.multiply(inv_count) for name, total in zip(names, sums)}
+            if edge_lengths:
+                edge_attrs["length"] = edge_attrs["length"] * voxel_size
+            graph.g = connectome(count, np.arange(1, mx + 1), edge_attrs=edge_attrs, sensor=graph.modal)
+    return [graph.g for graph in graphs]
+
+
+def _standardize(ts):
+    """
+    Center each ROI timeseries and scale it to unit norm in one float32 buffer, so that the Pearson correlation of
+    two rows is their dot product. Constant rows are left at zero, which yields zero correlations instead of NaNs.
+
+    Parameters
+    ----------
+    ts : array
+        (n_rois, n_timesteps) timeseries.
+
+    Returns
+    -------
+    z : array
+        (n_rois, n_timesteps) float32 array of standardized rows.
+    valid : array
+        Boolean mask of the rows that were not constant.
+    """
+    z = np.array(ts, dtype=np.float32)
+    z -= z.mean(axis=1, keepdims=True)
+    norms = np.sqrt(np.einsum("ij,ij->i", z, z, dtype=np.float64))
+    valid = norms > 0
+    z[valid] /= norms[valid, np.newaxis].astype(np.float32)
+    z[~valid] = 0
+    return z, valid
+
+
+def correlation_matrix(ts, kind="correlation", absolute=True, block_size=2048):
+    """
+    Compute an ROI-by-ROI functional connectivity matrix in float32. The timeseries are standardized once, and the
+    correlation is computed as a single matrix product, in row blocks of `block_size` ROIs to bound temporaries.
+
+    Parameters
+    ----------
+    ts : array
+        (n_rois, n_timesteps) timeseries.
+    kind : str
+        "correlation" for the Pearson correlation, "fisher_z" for its Fisher z-transform, or "ledoit_wolf" for the
+        correlation shrunk towards the identity with the Ledoit-Wolf coefficient.
+    absolute : bool
+        Whether to return absolute values, as the dMRI-style unsigned graphs expect.
+    block_size : int
+        Number of ROIs per block of the matrix product.
+
+    Returns
+    -------
+    conn : array
+        (n_rois, n_rois) float32 connectivity matrix. Rows of constant timeseries are zero.
+    """
+    if kind not in ("correlation", "fisher_z", "ledoit_wolf"):
+        raise ValueError("kind must be one of correlation, fisher_z, or ledoit_wolf, got {}".format(kind))
+    z, valid = _standardize(ts)
+    n_rois, n_timesteps = z.shape
+    conn = np.empty((n_rois, n_rois), dtype=np.float32)
+    for start in range(0, n_rois, block_size):
+        np.dot(z[start:start + block_size], z.T, out=conn[start:start + block_size])
+    np.clip(conn, -1, 1, out=conn)
+    diag = np.arange(n_rois)
+    conn[diag, diag] = valid
+
+    if kind == "fisher_z":
+        # The diagonal is infinite under the transform, so it is zeroed as in most connectivity toolboxes
+        conn[diag, diag] = 0
+        np.clip(conn, -1 + 1e-7, 1 - 1e-7, out=conn)
+        np.arctanh(conn, out=conn)
+    elif kind == "ledoit_wolf":
+        # With unit-norm rows the sample covariance of the z-scored data is `conn`, and every term of the shrinkage
+        # coefficient reduces to sums over the same standardized buffer. The target is the identity, as the
+        # correlation has a unit diagonal.
+        n_valid = max(int(valid.sum()), 1)
+        mu = 1.0
+        fro2 = np.einsum("ij,ij->", conn, conn, dtype=np.float64)
+        sq_norms = np.einsum("ij,ij->j", z, z, dtype=np.float64)
+        beta = (n_timesteps * np.sum(sq_norms ** 2) - fro2) / (n_valid * n_timesteps)
+        delta = (fro2 - n_valid * mu ** 2) / n_valid
+        beta = min(beta, delta)
+        shrinkage = 0.0 if beta <= 0 else beta / delta
+        print("Ledoit-Wolf shrinkage: {:.4f}".format(shrinkage))
+        conn *= np.float32(1 - shrinkage)
+        conn[diag[valid], diag[valid]] += np.float32(shrinkage * mu)
+
+    if absolute:
+        np.abs(conn, out=conn)
+    return conn
+
+
 class graph_tools(object):
     def __init__(
         self, rois, tracks, affine, namer, connectome_path, attr=None, sens="dwi"
@@ -151,72 +821,44 @@ class graph_tools(object):
         self.g.add_weighted_edges_from(edge_list)
         return self.g, self.edge_dict
 
-    def make_graph(self, error_margin=2, overlap_thr=1, voxel_size=2):
+    def make_graph(
+        self, error_margin=None, overlap_thr=1, voxel_size=2, chunk_size=100000, n_jobs=1, edge_lengths=False,
+        scalar_maps=None, max_step=None,
+    ):
         """
-        Takes streamlines and produces a graph
+        Takes streamlines and produces a sparse connectome. All streamline points are mapped to voxel coordinates and labeled in a
+        single pass, and edge counts are accumulated with a sparse reduction rather than per-streamline dict updates.
         **Positional Arguments:**
                 streamlines:
                     - Fiber streamlines either file or array in a dipy EuDX
                       or compatible format.
+        **Optional Arguments:**
+                error_margin:
+                    - Endpoint tolerance in mm. If set, streamlines are labeled by the nodes within this distance of
+                      their endpoints instead of by every point.
+                overlap_thr:
+                    - Minimum number of points a streamline must place in a label for that label to be counted.
+                voxel_size:
+                    - Voxel resolution of the label volume, in mm.
+                chunk_size:
+                    - Number of streamlines labeled per block, which bounds the memory used for node pairs.
+                n_jobs:
+                    - Number of worker processes that label streamline blocks.
+                edge_lengths:
+                    - Whether to store the mean streamline length per edge, in mm, as the "length" edge attribute.
+                scalar_maps:
+                    - Dict of scalar volumes (paths or arrays) whose mean along each edge's streamlines is stored as an
+                      edge attribute of the same name.
+                max_step:
+                    - If set, streamlines are resampled to at most this spacing, in voxels, before labeling, as needed
+                      for compressed tractograms.
         """
-        print("Building connectivity matrix...")
-
-        # Instantiate empty networkX graph object & dictionary
-        # Create voxel-affine mapping
-        lin_T, offset = _mapping_to_voxel(np.eye(4), voxel_size)
-        mx = len(np.unique(self.rois.astype(np.int64))) - 1
-        self.g = nx.Graph(ecount=0, vcount=mx)
-        edge_dict = defaultdict(int)
-        node_dict = dict(zip(np.unique(self.rois) + 1, np.arange(mx) + 1))
-
-        # Add empty vertices
-        for node in range(1, mx+1):
-            self.g.add_node(node)
-
-        nlines = np.shape(self.tracks)[0]
-        print("# of Streamlines: " + str(nlines))
-
-        ix = 0
-        for s in self.tracks:
-            # Map the streamlines coordinates to voxel coordinates and get labels for label_volume
-            # i, j, k = np.vstack(np.array([get_sphere(coord, error_margin,
-            #                                          (voxel_size, voxel_size, voxel_size),
-            #                                          self.roi_img.shape) for coord in
-            #                               _to_voxel_coordinates(s, lin_T, offset)])).T
-
-            # Map the streamlines coordinates to voxel coordinates
-            points = _to_voxel_coordinates(s, lin_T, offset)
-
-            # get labels for label_volume
-            i, j, k = points.T
-
-            lab_arr = self.rois[i, j, k]
-            endlabels = []
-            for lab in np.unique(lab_arr):
-                if lab > 0:
-                    if np.sum(lab_arr == lab) >= overlap_thr:
-                        endlabels.append(node_dict[lab])
-
-            edges = combinations(endlabels, 2)
-            for edge in edges:
-                lst = tuple([int(node) for node in edge])
-                edge_dict[tuple(sorted(lst))] += 1
-
-            edge_list = [(k[0], k[1], v) for k, v in edge_dict.items()]
-
-            self.g.add_weighted_edges_from(edge_list)
-            ix = ix + 1
-
-        conn_matrix = np.array(nx.to_numpy_matrix(self.g))
-        conn_matrix[np.isnan(conn_matrix)] = 0
-        conn_matrix[np.isinf(conn_matrix)] = 0
-        conn_matrix = np.asmatrix(np.maximum(conn_matrix, conn_matrix.transpose()))
-        g = nx.from_numpy_matrix(conn_matrix)
+        return make_graphs(
+            [self], error_margin=error_margin, overlap_thr=overlap_thr, voxel_size=voxel_size, chunk_size=chunk_size,
+            n_jobs=n_jobs, edge_lengths=edge_lengths, scalar_maps=scalar_maps, max_step=max_step,
+        )[0]
 
-        return g
-
-
-    def cor_graph(self, timeseries):
+    def cor_graph(self, timeseries, kind="correlation", absolute=True, block_size=2048):
         """
         Takes timeseries and produces a correlation matrix
 
@@ -224,12 +866,18 @@ class graph_tools(object):
             timeseries:
                 -the timeseries file to extract correlation for
                 dimensions are [numrois]x[numtimesteps]
+        **Optional Arguments:**
+            kind:
+                - "correlation", "fisher_z", or "ledoit_wolf". See correlation_matrix.
+            absolute:
+                - Whether to keep absolute values of the connectivity matrix.
+            block_size:
+                - Number of ROIs per block of the correlation matrix product.
         """
         ts = timeseries[0]
         rois = timeseries[1]
-        print("Estimating absolute correlation matrix for {} ROIs...".format(len(rois)))
-        self.g = np.abs(np.corrcoef(ts))  # calculate abs pearson correlation
-        self.g = np.nan_to_num(self.g).astype(object)
+        print("Estimating {} matrix for {} ROIs...".format(kind, len(rois)))
+        self.g = correlation_matrix(ts, kind=kind, absolute=absolute, block_size=block_size)
         self.n_ids = rois
         return self.g
 
@@ -248,6 +896,10 @@ class graph_tools(object):
         Returns the graph as a matrix.
         """
         g = self.get_graph()
+        if isinstance(g, connectome):
+            return np.asmatrix(g.to_dense())
+        if isinstance(g, np.ndarray):
+            return np.asmatrix(g)
         return nx.to_numpy_matrix(g, nodelist=np.sort(g.nodes()).tolist())
 
     def save_graph(self, graphname, fmt="igraph"):
@@ -259,6 +911,10 @@ class graph_tools(object):
                 graphname:
                     - Filename for the graph
         """
+        if isinstance(self.g, connectome):
+            return self._save_connectome(graphname, fmt)
+        if isinstance(self.g, np.ndarray):
+            return self._save_matrix(graphname, fmt)
         self.g.graph["ecount"] = nx.number_of_edges(self.g)
         self.g = nx.convert_node_labels_to_integers(self.g, first_label=1)
         print(self.g.graph)
@@ -291,6 +947,73 @@ class graph_tools(object):
             raise ValueError("Only edgelist, gpickle, and graphml currently supported")
         pass
 
+    def _save_matrix(self, graphname, fmt):
+        """
+        Saves a dense connectivity matrix, such as the output of cor_graph, without converting it to networkx.
+        """
+        if fmt == "igraph" and self.modal == "func":
+            np.savetxt(
+                graphname,
+                self.g,
+                comments="",
+                delimiter=",",
+                header=",".join([str(n) for n in self.n_ids]),
+            )
+        elif fmt == "txt":
+            np.savetxt(graphname, self.g)
+        elif fmt == "npy":
+            np.save(graphname, self.g)
+        elif fmt in ("edgelist", "gpickle", "graphml"):
+            g = nx.convert_node_labels_to_integers(nx.from_numpy_array(self.g), first_label=1)
+            if fmt == "edgelist":
+                nx.write_weighted_edgelist(g, graphname, encoding="utf-8")
+            elif fmt == "gpickle":
+                nx.write_gpickle(g, graphname)
+            else:
+                nx.write_graphml(g, graphname)
+        else:
+            raise ValueError("Only edgelist, gpickle, graphml, txt, and npy currently supported")
+
+    def _save_connectome(self, graphname, fmt):
+        """
+        Saves a sparse connectome to disk without going through networkx, except for gpickle.
+        """
+        self.g.graph["ecount"] = self.g.number_of_edges()
+        print(self.g.graph)
+        if fmt == "edgelist" or (fmt == "igraph" and self.modal == "dwi"):
+            self.g.write_edgelist(graphname, delimiter=" ")
+        elif fmt == "gpickle":
+            nx.write_gpickle(self.g.to_networkx(), graphname)
+        elif fmt == "graphml":
+            self.g.write_graphml(graphname)
+        elif fmt == "txt":
+            np.savetxt(graphname, self.g.to_dense())
+        elif fmt == "npy":
+            np.save(graphname, self.g.to_dense())
+        elif fmt == "npz":
+            from scipy.sparse import save_npz
+
+            save_npz(graphname, self.g.triu)
+        elif fmt == "igraph":
+            raise ValueError("Unsupported Modality.")
+        else:
+            raise ValueError("Only edgelist, gpickle, graphml, txt, npy, and npz currently supported")
+
+        # Edge attributes beyond the streamline count are written beside the graph, one file per attribute
+        root, ext = os.path.splitext(graphname)
+        for name in sorted(self.g.edge_attrs):
+            attrname = "{}_{}{}".format(root, name, ext)
+            if fmt == "edgelist" or fmt == "igraph":
+                self.g.write_edgelist(attrname, delimiter=" ", weight=name)
+            elif fmt == "txt":
+                np.savetxt(attrname, self.g.to_dense(weight=name))
+            elif fmt == "npy":
+                np.save(attrname, self.g.to_dense(weight=name))
+            elif fmt == "npz":
+                from scipy.sparse import save_npz
+
+                save_npz(attrname, triu(csr_matrix(self.g.to_dense(weight=name)), k=1, format="csr"))
+        pass
 
     def save_graph_png(self, graphname):
         import matplotlib
@@ -299,7 +1022,12 @@ class graph_tools(object):
         from nilearn.plotting import plot_matrix
 
         from sklearn.preprocessing import normalize
-        conn_matrix = np.array(nx.to_numpy_matrix(self.g))
+        if isinstance(self.g, connectome):
+            conn_matrix = self.g.to_dense()
+        elif isinstance(self.g, np.ndarray):
+            conn_matrix = self.g
+        else:
+            conn_matrix = np.array(nx.to_numpy_matrix(self.g))
         conn_matrix = normalize(conn_matrix)
         [z_min, z_max] = np.abs(conn_matrix).min(), np.abs(conn_matrix).max()
         plot_matrix(conn_matrix, figure=(10, 10), vmax=z_max, vmin=z_min * 0.5, auto_fit=True, grid=False,
@@ -314,5 +1042,10 @@ class graph_tools(object):
         User friendly wrapping and display of graph properties
         """
         print("\nGraph Summary:")
-        print(nx.info(self.g))
+        if isinstance(self.g, connectome):
+            print(self.g.info())
+        elif isinstance(self.g, np.ndarray):
+            print("Type: correlation matrix\nNumber of nodes: {}".format(self.g.shape[0]))
+        else:
+            print(nx.info(self.g))
         pass
@@ -24,17 +24,19 @@ import warnings
 
 warnings.simplefilter("ignore")
 import os
+import os.path as op
 import nibabel as nib
 import numpy as np
 from nilearn.image import (load_img, math_img)
 from ndmg.utils import gen_utils as mgu
 from ndmg.utils import reg_utils as mgru
+from ndmg.utils import mask_utils as mgmu
 
 
-def direct_streamline_norm(streams, fa_path, namer):
+def direct_streamline_norm(streams, fa_path, namer, n_check=1000):
     import os.path as op
     from dipy.tracking.streamline import deform_streamlines
-    from dipy.io.streamline import load_trk
+    from ndmg.track import gen_track as mgt
     from ndmg.utils import reg_utils as regutils
     from dipy.tracking import utils
 
@@ -49,15 +51,20 @@ def direct_streamline_norm(streams, fa_path, namer):
 
     streams_warp_png = namer.dirs["tmp"]["base"] + '/warp_qc.png'
 
-    # Run SyN and normalize streamlines
-    fa_img = nib.load(fa_path)
+    # Run SyN and normalize streamlines. The FA image and streamlines are taken from earlier stages of this run when
+    # they are registered in mgu.artifacts.
+    fa_img = mgu.artifacts.get("image", fa_path)
+    if fa_img is None:
+        fa_img = nib.load(fa_path)
     vox_size = fa_img.get_header().get_zooms()[0]
     template_img = nib.load(template_path)
     template_data = template_img.get_data().astype('bool')
 
     # SyN FA->Template
     [mapping, affine_map] = regutils.wm_syn(template_path, fa_path, namer.dirs["tmp"]["base"])
-    [streamlines, _] = load_trk(streams)
+    streamlines = mgu.artifacts.get("streamlines", streams)
+    if streamlines is None:
+        [streamlines, _] = mgt.load_streamlines(streams)
 
     # Warp streamlines
     # Create an isocentered affine
@@ -73,52 +80,60 @@ def direct_streamline_norm(streams, fa_path, namer):
     # Scale z by the voxel size
     adjusted_affine[2][3] = adjusted_affine[2][3]/vox_size
 
-    # Apply the deformation and correct for the extents
-    mni_streamlines = deform_streamlines(streamlines, deform_field=mapping.get_forward_field(),
-                                         stream_to_current_grid=target_isocenter,
-                                         current_grid_to_world=adjusted_affine,
-                                         stream_to_ref_grid=target_isocenter,
-                                         ref_grid_to_world=np.eye(4))
-
-    # Check DSN quality, attempt y-flip if DSN fails. Occasionally, orientation affine may be corrupted and this tweak
-    # should handle the inverse case.
-    dm = utils.density_map(mni_streamlines, template_img.shape, affine=np.eye(4)).astype('bool')
-    in_brain = len(np.unique(np.where((template_data.astype('uint8') > 0) & (dm.astype('uint8') > 0))))
-    out_brain = len(np.unique(np.where((template_data.astype('uint8') == 0) & (dm.astype('uint8') > 0))))
+    # Check DSN orientation on a random subsample of streamlines, attempting a y-flip if it fails. Occasionally,
+    # orientation affine may be corrupted and this tweak should handle the inverse case. The full tractogram is then
+    # deformed once, with whichever affine passed.
+    forward_field = mapping.get_forward_field()
+    flipped_affine = adjusted_affine.copy()
+    flipped_affine[1][3] = -flipped_affine[1][3]
+    rng = np.random.RandomState(42)
+    sample = [streamlines[idx] for idx in rng.choice(len(streamlines), min(n_check, len(streamlines)), replace=False)]
+
+    def _overlap(affine):
+        sample_mni = deform_streamlines(sample, deform_field=forward_field,
+                                        stream_to_current_grid=target_isocenter,
+                                        current_grid_to_world=affine,
+                                        stream_to_ref_grid=target_isocenter,
+                                        ref_grid_to_world=np.eye(4))
+        dm = utils.density_map(sample_mni, template_img.shape, affine=np.eye(4)) > 0
+        return np.sum(dm & template_data), np.sum(dm & ~template_data)
+
+    in_brain, out_brain = _overlap(adjusted_affine)
     if in_brain < out_brain:
-        adjusted_affine[1][3] = -adjusted_affine[1][3]
-        mni_streamlines = deform_streamlines(streamlines, deform_field=mapping.get_forward_field(),
-                                             stream_to_current_grid=target_isocenter,
-                                             current_grid_to_world=adjusted_affine,
-                                             stream_to_ref_grid=target_isocenter,
-                                             ref_grid_to_world=np.eye(4))
-        dm = utils.density_map(mni_streamlines, template_img.shape, affine=np.eye(4)).astype('bool')
-        in_brain = len(np.unique(np.where((template_data.astype('uint8') > 0) & (dm.astype('uint8') > 0))))
-        out_brain = len(np.unique(np.where((template_data.astype('uint8') == 0) & (dm.astype('uint8') > 0))))
+        in_brain, out_brain = _overlap(flipped_affine)
         if in_brain > out_brain:
             print('Warning: Direct Streamline Normalization completed successfully only after inverting the y-plane '
                   'voxel-to-world. This may not be correct, so manual check for corrupted header orientations is '
                   'recommended.')
+            adjusted_affine = flipped_affine
         else:
             raise ValueError('ERROR: Direct Streamline Normalization failed. Check for corrupted header/affine.')
 
-    # Save streamlines
-    hdr = fa_img.header
-    trk_affine = np.eye(4)
-    trk_hdr = nib.streamlines.trk.TrkFile.create_empty_header()
-    trk_hdr['hdr_size'] = 1000
-    trk_hdr['dimensions'] = hdr['dim'][1:4].astype('float32')
-    trk_hdr['voxel_sizes'] = hdr['pixdim'][1:4]
-    trk_hdr['voxel_to_rasmm'] = trk_affine
-    trk_hdr['voxel_order'] = 'RAS'
-    trk_hdr['pad2'] = 'RAS'
-    trk_hdr['image_orientation_patient'] = np.array([0., 0., 0., 0., 0., 0.]).astype('float32')
-    trk_hdr['endianness'] = '<'
-    trk_hdr['_offset_data'] = 1000
-    trk_hdr['nb_streamlines'] = len(streamlines)
-    tractogram = nib.streamlines.Tractogram(streamlines, affine_to_rasmm=trk_affine)
-    trkfile = nib.streamlines.trk.TrkFile(tractogram, header=trk_hdr)
-    nib.streamlines.save(trkfile, streams)
+    # Apply the deformation and correct for the extents
+    mni_streamlines = deform_streamlines(streamlines, deform_field=forward_field,
+                                         stream_to_current_grid=target_isocenter,
+                                         current_grid_to_world=adjusted_affine,
+                                         stream_to_ref_grid=target_isocenter,
+                                         ref_grid_to_world=np.eye(4))
+
+    # Save streamlines. Reduced-precision tractograms are left as written, since TRK cannot hold them.
+    if streams.endswith(".trk"):
+        hdr = fa_img.header
+        trk_affine = np.eye(4)
+        trk_hdr = nib.streamlines.trk.TrkFile.create_empty_header()
+        trk_hdr['hdr_size'] = 1000
+        trk_hdr['dimensions'] = hdr['dim'][1:4].astype('float32')
+        trk_hdr['voxel_sizes'] = hdr['pixdim'][1:4]
+        trk_hdr['voxel_to_rasmm'] = trk_affine
+        trk_hdr['voxel_order'] = 'RAS'
+        trk_hdr['pad2'] = 'RAS'
+        trk_hdr['image_orientation_patient'] = np.array([0., 0., 0., 0., 0., 0.]).astype('float32')
+        trk_hdr['endianness'] = '<'
+        trk_hdr['_offset_data'] = 1000
+        trk_hdr['nb_streamlines'] = len(streamlines)
+        tractogram = nib.streamlines.Tractogram(streamlines, affine_to_rasmm=trk_affine)
+        trkfile = nib.streamlines.trk.TrkFile(tractogram, header=trk_hdr)
+        nib.streamlines.save(trkfile, streams)
 
     # DSN QC plotting
     mgu.show_template_bundles(mni_streamlines, template_path, streams_warp_png)
@@ -126,6 +141,174 @@ def direct_streamline_norm(streams, fa_path, namer):
     return mni_streamlines
 
 
+class atlas_cache(object):
+    def __init__(self, cache_dir, template, vox_size):
+        """
+        A persistent, study-wide store of the atlas preparation that does not depend on the subject: the atlas
+        reoriented to RAS+ and resliced to the working resolution, and its 12-DOF alignment to the MNI template.
+        Entries are keyed by the contents of the atlas and template files, the voxel size and the registration
+        backend and profile, so that only the first subject of a study runs these steps, and each later subject only runs its own
+        MNI-->T1w-->DWI steps.
+
+        **Positional Arguments:**
+                cache_dir:
+                    - Directory that holds the cache entries, shared by every subject of a study.
+                template:
+                    - Path to the MNI template brain that atlases are aligned to.
+                vox_size:
+                    - Working voxel resolution, '1mm' or '2mm'.
+        """
+        self.cache_dir = cache_dir
+        self.template = template
+        self.vox_size = vox_size
+        self.template_digest = mgu.file_digest(template)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def entry(self, atlas):
+        """
+        Returns the cache directory of an atlas, named after the atlas and a hash of its key.
+        """
+        import hashlib
+
+        key = hashlib.sha1()
+        key.update(mgu.file_digest(atlas).encode())
+        key.update(self.template_digest.encode())
+        key.update(str(self.vox_size).encode())
+        key.update(mgru.get_backend().encode())
+        key.update(mgru.get_profile().encode())
+        atlas_name = op.basename(atlas).split(".")[0]
+        return op.join(self.cache_dir, "{}_{}".format(atlas_name, key.hexdigest()[:16]))
+
+    def prepare(self, atlas, namer):
+        """
+        Returns the reoriented and resliced atlas, the atlas aligned to the template, and the FSL transform between
+        them, computing and storing them on the first call for this atlas. Files are written under temporary names and moved into place, so that
+        concurrent subjects never read a partial entry.
+        """
+        import shutil
+
+        entry = self.entry(atlas)
+        if not os.path.isdir(entry):
+            os.makedirs(entry, exist_ok=True)
+        prepared = [
+            op.join(entry, f) for f in os.listdir(entry)
+            if f.endswith(".nii.gz") and ".tmp." not in f and f != "atlas_template.nii.gz"
+        ]
+        if prepared:
+            atlas_res = prepared[0]
+        else:
+            labels_im_file = mgu.reorient_img(atlas, namer)
+            labels_im_file = mgu.match_target_vox_res(labels_im_file, self.vox_size, namer, sens="t1w")
+            atlas_res = op.join(entry, op.basename(labels_im_file))
+            tmp_file = "{}.{}.tmp.nii.gz".format(atlas_res[:-len(".nii.gz")], os.getpid())
+            shutil.copyfile(labels_im_file, tmp_file)
+            os.replace(tmp_file, atlas_res)
+
+        atlas_template = op.join(entry, "atlas_template.nii.gz")
+        atlas_xfm = op.join(entry, "xfm_atlas2template.mat")
+        if os.path.isfile(atlas_template):
+            print("Found cached template alignment of {}".format(atlas))
+        else:
+            tmp_file = op.join(entry, "atlas_template.{}.tmp.nii.gz".format(os.getpid()))
+            xfm = op.join(entry, "xfm_atlas2template.{}.tmp.mat".format(os.getpid()))
+            mgru.align(
+                atlas_res,
+                self.template,
+                init=None,
+                xfm=xfm,
+                out=tmp_file,
+                dof=12,
+                searchrad=True,
+                interp="nearestneighbour",
+                cost="mutualinfo",
+            )
+            os.replace(xfm, atlas_xfm)
+            os.replace(tmp_file, atlas_template)
+        return atlas_res, atlas_template, atlas_xfm
+
+
+class anat_cache(object):
+    # dmri_reg attributes holding the outputs of each T1w-only stage
+    stages = {
+        "tissue": ["t1w_brain", "wm_mask", "gm_mask", "csf_mask", "wm_edge"],
+        "mni": ["t12mni_xfm_init", "mni2t1_xfm_init", "warp_t1w2mni", "mni2t1w_warp", "t1_aligned_mni"],
+        "mni_simple": ["t12mni_xfm_init", "t12mni_xfm", "t1_aligned_mni"],
+    }
+
+    def __init__(self, cache_dir, t1w, vox_size, simple=False):
+        """
+        A persistent store of the registration outputs that depend only on a subject's T1w: the skull-stripped brain,
+        the FAST tissue maps and WM edge from gen_tissue, and the T1w<-->MNI transforms and warps from t1w2mni_align.
+        Entries are keyed by the contents of the T1w file, the voxel size, whether registration is simple, and the
+        registration backend and profile, so that later sessions sharing the anatomical scan skip segmentation and the
+        nonlinear registration and only run their own T1w-->DWI steps.
+
+        **Positional Arguments:**
+                cache_dir:
+                    - Directory that holds the cache entries, shared by every session of a subject.
+                t1w:
+                    - Path to the T1w input, before reorientation and reslicing.
+                vox_size:
+                    - Working voxel resolution, '1mm' or '2mm'.
+                simple:
+                    - Whether registration to MNI is linear only, as dmri_reg's `simple`.
+        """
+        import hashlib
+
+        key = hashlib.sha1()
+        key.update(mgu.file_digest(t1w).encode())
+        key.update(str(vox_size).encode())
+        key.update(str(bool(simple)).encode())
+        key.update(mgru.get_backend().encode())
+        key.update(mgru.get_profile().encode())
+        self.simple = simple
+        self.entry = op.join(cache_dir, "t1w_{}".format(key.hexdigest()[:16]))
+        if not os.path.isdir(self.entry):
+            os.makedirs(self.entry, exist_ok=True)
+
+    def _files(self, stage):
+        if stage == "mni" and self.simple:
+            stage = "mni_simple"
+        return self.stages[stage]
+
+    def restore(self, reg, stage):
+        """
+        Copies the cached outputs of a stage ("tissue" or "mni") to the paths of a dmri_reg. Returns False, copying
+        nothing, if the stage has not been stored.
+        """
+        import shutil
+
+        if not os.path.isfile(op.join(self.entry, "{}.done".format(stage))):
+            return False
+        for attr in self._files(stage):
+            shutil.copyfile(op.join(self.entry, attr + _ext(getattr(reg, attr))), getattr(reg, attr))
+        print("Restored cached {} outputs from {}".format(stage, self.entry))
+        return True
+
+    def store(self, reg, stage):
+        """
+        Stores the outputs of a stage ("tissue" or "mni") of a dmri_reg. Files are written under temporary names and
+        moved into place, and the stage is only marked complete once every file is in place, so that concurrent
+        sessions never read a partial entry.
+        """
+        import shutil
+
+        for attr in self._files(stage):
+            cached = op.join(self.entry, attr + _ext(getattr(reg, attr)))
+            tmp_file = "{}.{}.tmp".format(cached, os.getpid())
+            shutil.copyfile(getattr(reg, attr), tmp_file)
+            os.replace(tmp_file, cached)
+        open(op.join(self.entry, "{}.done".format(stage)), "w").close()
+
+
+def _ext(path):
+    """
+    Returns the extension of a file, including a trailing .gz.
+    """
+    return ".nii.gz" if path.endswith(".nii.gz") else op.splitext(path)[1]
+
+
 class dmri_reg(object):
     def __init__(self, namer, nodif_B0, nodif_B0_mask, t1w_in, vox_size, simple):
         import os.path as op
@@ -319,32 +502,18 @@ class dmri_reg(object):
             self.csf_mask, self.vox_size, self.namer, sens="t1w"
         )
 
-        # Threshold WM to binary in dwi space
-        self.t_img = load_img(self.wm_mask)
-        self.mask = math_img("img > 0.2", img=self.t_img)
-        self.mask.to_filename(self.wm_mask_thr)
-
-        # Extract wm edge
-        cmd = (
-            "fslmaths "
-            + self.wm_mask_thr
-            + " -edge -bin -mas "
-            + self.wm_mask_thr
-            + " "
-            + self.wm_edge
-        )
-        os.system(cmd)
-        print(cmd)
+        # Threshold WM to binary and extract its edge
+        maps = mgmu.mask_images()
+        wm_thr = maps[self.wm_mask] > 0.2
+        maps.save(mgmu.edge(wm_thr) & wm_thr, self.wm_edge)
 
         return
 
-    def t1w2dwi_align(self):
+    def t1w2mni_align(self):
         """
-        alignment from T1w --> MNI and T1w_MNI --> DWI
-        A function to perform self alignment. Uses a local optimisation
-        cost function to get the two images close, and then uses bbr
-        to obtain a good alignment of brain boundaries.
-        Assumes input dwi is already preprocessed and brain extracted.
+        alignment from T1w --> MNI, and the inverse transforms MNI --> T1w.
+        Depends only on the T1w, so its outputs can be reused by every
+        session that shares the scan (see anat_cache).
         """
 
         # Create linear transform/ initializer T1w-->MNI
@@ -406,6 +575,19 @@ class dmri_reg(object):
                 sch=None,
             )
 
+    def t1w2dwi_align(self, mni=True):
+        """
+        alignment from T1w --> MNI and T1w_MNI --> DWI
+        A function to perform self alignment. Uses a local optimisation
+        cost function to get the two images close, and then uses bbr
+        to obtain a good alignment of brain boundaries.
+        Assumes input dwi is already preprocessed and brain extracted.
+        Pass mni=False when the T1w --> MNI outputs were restored from an
+        anat_cache.
+        """
+        if mni:
+            self.t1w2mni_align()
+
         # Align T1w-->DWI
         mgru.align(
             self.nodif_B0,
@@ -484,62 +666,70 @@ class dmri_reg(object):
 
         return
 
-    def atlas2t1w2dwi_align(self, atlas, dsn=True):
+    def atlas2t1w2dwi_align(self, atlas, dsn=True, atlas_mni=None, atlas_xfm=None):
         """
         alignment from atlas --> T1 --> dwi
         A function to perform atlas alignment.
         Tries nonlinear registration first, and if that fails,
         does a linear registration instead.
+        If `atlas_mni` and `atlas_xfm`, the atlas already aligned to the MNI template and its transform (see
+        atlas_cache), are given, the atlas-->MNI alignment is taken from them instead of being recomputed.
+        The transforms from the atlas to dwi space are chained and applied to the atlas in a single resampling.
         NOTE: for this to work, must first have called t1w2dwi_align.
         """
+        import shutil
+        import threading
+
         self.atlas = atlas
         self.atlas_name = self.atlas.split("/")[-1].split(".")[0]
         self.aligned_atlas_t1mni = "{}/{}_aligned_atlas_t1w_mni.nii.gz".format(
             self.namer.dirs["tmp"]["reg_a"], self.atlas_name
         )
-        self.aligned_atlas_skull = "{}/{}_aligned_atlas_skull.nii.gz".format(
-            self.namer.dirs["tmp"]["reg_a"], self.atlas_name
-        )
         self.dwi_aligned_atlas = "{}/{}_aligned_atlas.nii.gz".format(
             self.namer.dirs["output"]["reg_anat"], self.atlas_name
         )
+        # Transforms are named per atlas, since several atlases may be aligned at once (see align_atlases)
+        self.xfm_atlas2mni = "{}/{}_xfm_atlas2mni.mat".format(
+            self.namer.dirs["tmp"]["reg_m"], self.atlas_name
+        )
+        self.xfm_atlas2t1w_init = "{}/{}_xfm_atlas2t1w_init.mat".format(
+            self.namer.dirs["tmp"]["reg_m"], self.atlas_name
+        )
+        self.xfm_atlas2t1w = "{}/{}_xfm_atlas2t1w.mat".format(
+            self.namer.dirs["tmp"]["reg_m"], self.atlas_name
+        )
         # self.dwi_aligned_atlas_mask = "{}/{}_aligned_atlas_mask.nii.gz".format(self.namer.dirs['tmp']['reg_a'], self.atlas_name)
 
-        mgru.align(
-            self.atlas,
-            self.t1_aligned_mni,
-            init=None,
-            xfm=None,
-            out=self.aligned_atlas_t1mni,
-            dof=12,
-            searchrad=True,
-            interp="nearestneighbour",
-            cost="mutualinfo",
-        )
+        if atlas_mni is not None:
+            shutil.copyfile(atlas_mni, self.aligned_atlas_t1mni)
+        else:
+            mgru.align(
+                self.atlas,
+                self.t1_aligned_mni,
+                init=None,
+                xfm=self.xfm_atlas2mni,
+                out=self.aligned_atlas_t1mni,
+                dof=12,
+                searchrad=True,
+                interp="nearestneighbour",
+                cost="mutualinfo",
+            )
+            atlas_xfm = self.xfm_atlas2mni
 
         if (self.simple is False) and (dsn is False):
             try:
-                # Apply warp resulting from the inverse of T1w-->MNI created earlier
-                mgru.apply_warp(
-                    self.t1w_brain,
-                    self.aligned_atlas_t1mni,
-                    self.aligned_atlas_skull,
-                    warp=self.mni2t1w_warp,
-                    interp="nn",
-                    sup=True,
-                )
-
-                # Apply transform to dwi space
-                mgru.align(
-                    self.aligned_atlas_skull,
-                    self.nodif_B0,
-                    init=self.t1wtissue2dwi_xfm,
-                    xfm=None,
-                    out=self.dwi_aligned_atlas,
-                    dof=6,
-                    searchrad=True,
-                    interp="nearestneighbour",
-                    cost="mutualinfo",
+                # Resample the atlas into dwi space once, through atlas-->MNI, the warp resulting from the inverse of
+                # T1w-->MNI created earlier, and T1w-->dwi
+                chain = mgru.transform_chain()
+                if atlas_xfm is not None:
+                    chain.affine(atlas_xfm)
+                    source = self.atlas
+                else:
+                    source = self.aligned_atlas_t1mni
+                chain.warp(self.mni2t1w_warp).affine(self.t1wtissue2dwi_xfm)
+                chain.apply(
+                    source, self.nodif_B0, self.dwi_aligned_atlas, interp="nn", sup=True,
+                    tmp_dir=self.namer.dirs["tmp"]["reg_m"],
                 )
             except:
                 print(
@@ -572,14 +762,11 @@ class dmri_reg(object):
                     init=self.xfm_atlas2t1w_init,
                 )
 
-                # Combine our linear transform from t1w to template with our transform from dwi to t1w space to get a transform from atlas ->(-> t1w ->)-> dwi
-                mgru.combine_xfms(
-                    self.xfm_atlas2t1w, self.t1wtissue2dwi_xfm, self.temp2dwi_xfm
-                )
-
-                # Apply linear transformation from template to dwi space
-                mgru.applyxfm(
-                    self.nodif_B0, self.atlas, self.temp2dwi_xfm, self.dwi_aligned_atlas
+                # Chain our linear transform from atlas to t1w with our transform from t1w to dwi space, and apply
+                # the transform from atlas ->(-> t1w ->)-> dwi in one step
+                mgru.transform_chain().affine(self.xfm_atlas2t1w).affine(self.t1wtissue2dwi_xfm).apply(
+                    self.atlas, self.nodif_B0, self.dwi_aligned_atlas, interp="trilinear",
+                    tmp_dir=self.namer.dirs["tmp"]["reg_m"],
                 )
         elif dsn is False:
             # Create transform to align atlas to T1w using flirt
@@ -609,14 +796,11 @@ class dmri_reg(object):
                 init=self.xfm_atlas2t1w_init,
             )
 
-            # Combine our linear transform from t1w to template with our transform from dwi to t1w space to get a transform from atlas ->(-> t1w ->)-> dwi
-            mgru.combine_xfms(
-                self.xfm_atlas2t1w, self.t1wtissue2dwi_xfm, self.temp2dwi_xfm
-            )
-
-            # Apply linear transformation from template to dwi space
-            mgru.applyxfm(
-                self.nodif_B0, self.atlas, self.temp2dwi_xfm, self.dwi_aligned_atlas
+            # Chain our linear transform from atlas to t1w with our transform from t1w to dwi space, and apply the
+            # transform from atlas ->(-> t1w ->)-> dwi in one step
+            mgru.transform_chain().affine(self.xfm_atlas2t1w).affine(self.t1wtissue2dwi_xfm).apply(
+                self.atlas, self.nodif_B0, self.dwi_aligned_atlas, interp="trilinear",
+                tmp_dir=self.namer.dirs["tmp"]["reg_m"],
             )
         else:
             pass
@@ -630,9 +814,13 @@ class dmri_reg(object):
         node_num = len(np.unique(self.atlas_data))
         self.atlas_data[self.atlas_data > node_num] = 0
 
+        # Written under a temporary name and moved into place, since concurrent alignments (see align_atlases) all
+        # write this mask
         t_img = load_img(self.wm_gm_int_in_dwi)
         mask = math_img("img > 0", img=t_img)
-        mask.to_filename(self.wm_gm_int_in_dwi_bin)
+        tmp_file = "{}.{}.tmp.nii.gz".format(self.wm_gm_int_in_dwi_bin[:-len(".nii.gz")], threading.get_ident())
+        mask.to_filename(tmp_file)
+        os.replace(tmp_file, self.wm_gm_int_in_dwi_bin)
 
         if dsn is False:
             nib.save(
@@ -655,12 +843,47 @@ class dmri_reg(object):
             )
             return self.aligned_atlas_t1mni
 
-    def tissue2dwi_align(self):
+    def align_atlases(self, atlases, dsn=True, n_jobs=1):
+        """
+        Runs atlas2t1w2dwi_align for several atlases concurrently, up to `n_jobs` at a time. Each alignment only
+        depends on t1w2dwi_align, so the atlases are independent of each other.
+
+        **Positional Arguments:**
+                atlases:
+                    - list of (atlas, atlas_mni, atlas_xfm) tuples, as returned by atlas_cache.prepare. atlas_mni
+                      and atlas_xfm may be None.
+                dsn:
+                    - whether the atlases are used for DSN connectomes, as for atlas2t1w2dwi_align.
+                n_jobs:
+                    - maximum number of alignments running at once.
+
+        Returns the aligned atlas of each pair, in order.
+        """
+        import copy
+        from multiprocessing.pool import ThreadPool
+
+        # atlas2t1w2dwi_align stores its per-atlas paths on the instance, so each alignment gets its own shallow copy.
+        # The FSL calls run in subprocesses, so threads are enough to keep them running side by side.
+        def _align(prepared):
+            atlas, atlas_mni, atlas_xfm = prepared
+            return copy.copy(self).atlas2t1w2dwi_align(atlas, dsn=dsn, atlas_mni=atlas_mni, atlas_xfm=atlas_xfm)
+
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = None
+        pool = ThreadPool(n_jobs)
+        try:
+            return pool.map(_align, atlases)
+        finally:
+            pool.close()
+            pool.join()
+
+    def tissue2dwi_align(self, n_jobs=1):
         """
         alignment of ventricle and CC ROI's from MNI space --> dwi and
         CC and CSF from T1w space --> dwi
         A function to generate and perform dwi space alignment of avoidance/waypoint masks for tractography.
         First creates ventricle and CC ROI. Then creates transforms from stock MNI template to dwi space.
+        Independent FSL steps run concurrently, up to `n_jobs` at a time.
         NOTE: for this to work, must first have called both t1w2dwi_align and atlas2t1w2dwi_align.
         """
 
@@ -668,17 +891,20 @@ class dmri_reg(object):
         print("Creating MNI-space ventricle ROI...")
         if not os.path.isfile(self.mni_atlas):
             raise ValueError("FSL atlas for ventricle reference not found!")
-        cmd = "fslmaths " + self.mni_vent_loc + " -thr 0.1 -bin " + self.mni_vent_loc
-        os.system(cmd)
-
-        cmd = "fslmaths " + self.corpuscallosum + " -bin " + self.corpuscallosum
-        os.system(cmd)
-
-        cmd = "fslmaths " + self.corpuscallosum + " -sub " + self.mni_vent_loc + " -bin " + self.corpuscallosum
-        os.system(cmd)
+        # Independent FSL steps run concurrently, each after the steps whose outputs it reads
+        jobs = mgru.job_runner(n_jobs=n_jobs)
+        jobs.add("vent_bin", "fslmaths " + self.mni_vent_loc + " -thr 0.1 -bin " + self.mni_vent_loc)
+        jobs.add("cc_bin", "fslmaths " + self.corpuscallosum + " -bin " + self.corpuscallosum)
+        jobs.add(
+            "cc_sub_vent",
+            "fslmaths " + self.corpuscallosum + " -sub " + self.mni_vent_loc + " -bin " + self.corpuscallosum,
+            after=["vent_bin", "cc_bin"],
+        )
 
         # Create transform to MNI atlas to T1w using flirt. This will be use to transform the ventricles to dwi space.
-        mgru.align(
+        jobs.add(
+            "roi2mni_xfm",
+            mgru.align,
             self.mni_atlas,
             self.input_mni,
             xfm=self.xfm_roi2mni_init,
@@ -692,129 +918,91 @@ class dmri_reg(object):
         )
 
         # Create transform to align roi to mni and T1w using flirt
-        mgru.applyxfm(
-            self.input_mni, self.mni_vent_loc, self.xfm_roi2mni_init, self.vent_mask_mni
+        jobs.add(
+            "vent_mni",
+            mgru.applyxfm,
+            self.input_mni, self.mni_vent_loc, self.xfm_roi2mni_init, self.vent_mask_mni,
+            after=["vent_bin", "roi2mni_xfm"],
         )
 
+        vent_t1w, cc_t1w = ["vent_mni"], ["cc_sub_vent"]
         if self.simple is False:
             # Apply warp resulting from the inverse MNI->T1w created earlier
-            mgru.apply_warp(
+            vent_t1w = [jobs.add(
+                "vent_t1w",
+                mgru.apply_warp,
                 self.t1w_brain,
                 self.vent_mask_mni,
                 self.vent_mask_t1w,
                 warp=self.mni2t1w_warp,
                 interp="nn",
                 sup=True,
-            )
+                after=vent_t1w,
+            )]
 
             # Apply warp resulting from the inverse MNI->T1w created earlier
-            mgru.apply_warp(
+            cc_t1w = [jobs.add(
+                "cc_t1w",
+                mgru.apply_warp,
                 self.t1w_brain,
                 self.corpuscallosum,
                 self.corpuscallosum_mask_t1w,
                 warp=self.mni2t1w_warp,
                 interp="nn",
                 sup=True,
-            )
+                after=cc_t1w,
+            )]
 
         # Applyxfm tissue maps to dwi space
-        mgru.applyxfm(
+        jobs.add(
+            "vent_dwi",
+            mgru.applyxfm,
             self.nodif_B0,
             self.vent_mask_t1w,
             self.t1wtissue2dwi_xfm,
             self.vent_mask_dwi,
+            after=vent_t1w,
         )
-        mgru.applyxfm(
+        jobs.add(
+            "cc_dwi",
+            mgru.applyxfm,
             self.nodif_B0,
             self.corpuscallosum_mask_t1w,
             self.t1wtissue2dwi_xfm,
             self.corpuscallosum_dwi,
+            after=cc_t1w,
         )
-        mgru.applyxfm(
-            self.nodif_B0, self.csf_mask, self.t1wtissue2dwi_xfm, self.csf_mask_dwi
+        jobs.add(
+            "csf_dwi", mgru.applyxfm, self.nodif_B0, self.csf_mask, self.t1wtissue2dwi_xfm, self.csf_mask_dwi
         )
-        mgru.applyxfm(
-            self.nodif_B0, self.gm_mask, self.t1wtissue2dwi_xfm, self.gm_in_dwi
+        jobs.add(
+            "gm_dwi", mgru.applyxfm, self.nodif_B0, self.gm_mask, self.t1wtissue2dwi_xfm, self.gm_in_dwi
         )
-        mgru.applyxfm(
-            self.nodif_B0, self.wm_mask, self.t1wtissue2dwi_xfm, self.wm_in_dwi
+        jobs.add(
+            "wm_dwi", mgru.applyxfm, self.nodif_B0, self.wm_mask, self.t1wtissue2dwi_xfm, self.wm_in_dwi
         )
+        jobs.run()
 
-        # Threshold WM to binary in dwi space
-        thr_img = nib.load(self.wm_in_dwi)
-        thr_img.get_data()[thr_img.get_data() < 0.15] = 0
-        nib.save(thr_img, self.wm_in_dwi_bin)
-
-        # Threshold GM to binary in dwi space
-        thr_img = nib.load(self.gm_in_dwi)
-        thr_img.get_data()[thr_img.get_data() < 0.15] = 0
-        nib.save(thr_img, self.gm_in_dwi_bin)
-
-        # Threshold CSF to binary in dwi space
-        thr_img = nib.load(self.csf_mask_dwi)
-        thr_img.get_data()[thr_img.get_data() < 0.99] = 0
-        nib.save(thr_img, self.csf_mask_dwi)
-
-        # Threshold WM to binary in dwi space
-        self.t_img = load_img(self.wm_in_dwi_bin)
-        self.mask = math_img("img > 0", img=self.t_img)
-        self.mask.to_filename(self.wm_in_dwi_bin)
-
-        # Threshold GM to binary in dwi space
-        self.t_img = load_img(self.gm_in_dwi_bin)
-        self.mask = math_img("img > 0", img=self.t_img)
-        self.mask.to_filename(self.gm_in_dwi_bin)
-
-        # Threshold CSF to binary in dwi space
-        self.t_img = load_img(self.csf_mask_dwi)
-        self.mask = math_img("img > 0", img=self.t_img)
-        self.mask.to_filename(self.csf_mask_dwi_bin)
+        # Build the tracking masks in memory from the dwi-space tissue maps, each loaded once
+        maps = mgmu.mask_images()
+        wm_bin = mgmu.binarize(mgmu.threshold(maps[self.wm_in_dwi], 0.15))
+        gm_bin = mgmu.binarize(mgmu.threshold(maps[self.gm_in_dwi], 0.15))
+        csf = mgmu.threshold(maps[self.csf_mask_dwi], 0.99)
 
         # Create ventricular CSF mask
         print("Creating ventricular CSF mask...")
-        cmd = (
-            "fslmaths "
-            + self.vent_mask_dwi
-            + " -kernel sphere 10 -ero -bin "
-            + self.vent_mask_dwi
-        )
-        os.system(cmd)
+        vent = mgmu.erode(mgmu.binarize(maps[self.vent_mask_dwi]), 10, maps.zooms())
         print("Creating Corpus Callosum mask...")
-        cmd = (
-            "fslmaths "
-            + self.corpuscallosum_dwi
-            + " -mas "
-            + self.wm_in_dwi_bin
-            + " -bin "
-            + self.corpuscallosum_dwi
-        )
-        os.system(cmd)
-        cmd = (
-            "fslmaths "
-            + self.csf_mask_dwi
-            + " -add "
-            + self.vent_mask_dwi
-            + " -bin "
-            + self.vent_csf_in_dwi
-        )
-        os.system(cmd)
+        cc = mgmu.binarize(maps[self.corpuscallosum_dwi]) & wm_bin
+        vent_csf = mgmu.binarize(csf) | vent
 
         # Create gm-wm interface image
-        cmd = (
-            "fslmaths "
-            + self.gm_in_dwi_bin
-            + " -mul "
-            + self.wm_in_dwi_bin
-            + " -add "
-            + self.corpuscallosum_dwi
-            + " -sub "
-            + self.vent_csf_in_dwi
-            + " -mas "
-            + self.nodif_B0_mask
-            + " -bin "
-            + self.wm_gm_int_in_dwi
-        )
-        os.system(cmd)
+        interface = mgmu.interface(gm_bin, wm_bin, cc, vent_csf, maps[self.nodif_B0_mask])
+
+        maps.save(csf, self.csf_mask_dwi, dtype=np.float32)
+        maps.save(cc, self.corpuscallosum_dwi)
+        maps.save(vent_csf, self.vent_csf_in_dwi)
+        maps.save(interface, self.wm_gm_int_in_dwi)
 
         return
 
@@ -1134,7 +1322,7 @@ class epi_register(object):
             out=None,
             dof=12,
             searchrad=True,
-            bins=256,
+            bins=None,
             interp="spline",
             wmseg=None,
             init=xfm_t1w2temp_init,
@@ -169,6 +169,12 @@ def session_level(
     creds=None,
     debug=False,
     modif="",
+    n_cpus=1,
+    max_streamlines=None,
+    compress_tol=None,
+    float16=False,
+    reg_backend="fsl",
+    reg_profile="standard",
 ):
     """
     Crawls the given BIDS organized directory for data pertaining to the given
@@ -252,6 +258,12 @@ def session_level(
         creds=creds,
         debug=debug,
         modif=modif,
+        n_cpus=n_cpus,
+        max_streamlines=max_streamlines,
+        compress_tol=compress_tol,
+        float16=float16,
+        reg_backend=reg_backend,
+        reg_profile=reg_profile,
     )
     rmflds = []
     if modality == "func" and not debug:
@@ -463,6 +475,49 @@ def main():
         help="Name of folder on s3 to push to. If empty, push to a folder with ndmg's version number.",
         default="",
     )
+    parser.add_argument(
+        "--n_cpus",
+        action="store",
+        type=int,
+        help="Number of worker processes for parallelized stages. Default is 1.",
+        default=1,
+    )
+    parser.add_argument(
+        "--max_streamlines",
+        action="store",
+        type=int,
+        help="Stop tractography after this many streamlines are kept. Default is to track every seed.",
+        default=None,
+    )
+    parser.add_argument(
+        "--compress_tol",
+        action="store",
+        type=float,
+        help="Compress streamlines, keeping every point within this distance (in voxels) of the tracked path. "
+        "Default is no compression.",
+        default=None,
+    )
+    parser.add_argument(
+        "--float16",
+        action="store_true",
+        help="Store streamline coordinates as float16 in a .npz file instead of a float32 .trk.",
+        default=False,
+    )
+    parser.add_argument(
+        "--reg_backend",
+        action="store",
+        choices=["fsl", "dipy"],
+        help="Affine registration backend: fsl runs flirt, dipy registers in-process. Default is fsl.",
+        default="fsl",
+    )
+    parser.add_argument(
+        "--reg_profile",
+        action="store",
+        choices=["fast", "standard", "accurate"],
+        help="Registration profile, trading accuracy for speed in the search range, cost-function bins, pyramid "
+        "levels and iterations of every registration. Default is standard.",
+        default="standard",
+    )
     result = parser.parse_args()
 
     inDir = result.bids_dir
@@ -492,6 +547,12 @@ def main():
     mod_func = result.mf
     reg_style = result.sp
     modif = result.modif
+    n_cpus = result.n_cpus
+    max_streamlines = result.max_streamlines
+    compress_tol = result.compress_tol
+    float16 = result.float16
+    reg_backend = result.reg_backend
+    reg_profile = result.reg_profile
 
     try:
         creds = bool(s3_utils.get_credentials())
@@ -567,6 +628,12 @@ def main():
             creds=creds,
             debug=debug,
             modif=modif,
+            n_cpus=n_cpus,
+            max_streamlines=max_streamlines,
+            compress_tol=compress_tol,
+            float16=float16,
+            reg_backend=reg_backend,
+            reg_profile=reg_profile,
         )
     else:
         print("Specified level not valid")
@@ -33,6 +33,7 @@ from ndmg import preproc as mgp
 from ndmg.utils import gen_utils as mgu
 from ndmg.utils import s3_utils
 from ndmg.register import gen_reg as mgr
+from ndmg.utils import reg_utils as mgru
 from ndmg.track import gen_track as mgt
 from ndmg.graph import gen_graph as mgg
 from ndmg.utils.bids_utils import name_resource
@@ -43,6 +44,21 @@ from datetime import datetime
 os.environ["MPLCONFIGDIR"] = "/tmp/"
 
 
+def clear_outputs(outdir, keep=()):
+    """
+    Deletes the contents of an output directory, except the directories in `keep` and the directories containing them.
+    """
+    keep = [os.path.abspath(path) for path in keep]
+    for name in os.listdir(outdir):
+        path = os.path.abspath(os.path.join(outdir, name))
+        if any(kept == path or kept.startswith(path + os.sep) for kept in keep):
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
 def ndmg_dwi_worker(
     dwi,
     bvals,
@@ -65,7 +81,17 @@ def ndmg_dwi_worker(
     push=False,
     creds=None,
     debug=False,
-    modif=""
+    modif="",
+    n_cpus=1,
+    max_streamlines=None,
+    compress_tol=None,
+    float16=False,
+    atlas_cache_dir=None,
+    anat_cache_dir=None,
+    model_cache_dir=None,
+    reg_backend="fsl",
+    reg_profile="standard",
+    random_seed=42,
 ):
 
     """
@@ -87,7 +113,24 @@ def ndmg_dwi_worker(
     print("clean = {}".format(clean))
     print("skip eddy = {}".format(skipeddy))
     print("skip registration = {}".format(skipreg))
+    print("n_cpus = {}".format(n_cpus))
+    print("max streamlines = {}".format(max_streamlines))
+    print("streamline compression tolerance = {}".format(compress_tol))
+    print("float16 streamlines = {}".format(float16))
+    print("atlas cache = {}".format(atlas_cache_dir))
+    print("anatomical cache = {}".format(anat_cache_dir))
+    print("model cache = {}".format(model_cache_dir))
+    print("registration backend = {}".format(reg_backend))
+    print("registration profile = {}".format(reg_profile))
+    print("random seed = {}".format(random_seed))
     fmt = "_adj.ssv"
+    # Caches outlive a run, so they are kept out of pushed results and out of the cleanup after a push
+    model_cache_dir = model_cache_dir or os.path.join(outdir, "model-cache")
+    atlas_cache_dir = atlas_cache_dir or os.path.join(outdir, "atlas-cache")
+    anat_cache_dir = anat_cache_dir or os.path.join(outdir, "anat-cache")
+    cache_dirs = [model_cache_dir, atlas_cache_dir, anat_cache_dir]
+    mgru.set_backend(reg_backend)
+    mgru.set_profile(reg_profile)
 
     assert all(
         [
@@ -130,7 +173,10 @@ def ndmg_dwi_worker(
     namer.add_dirs_dwi(paths, labels, label_dirs)
 
     # Create derivative output file names
-    streams = namer.name_derivative(namer.dirs["output"]["fiber"], "streamlines.trk")
+    # TRK only stores float32 coordinates, so reduced-precision tractograms are written as .npz
+    streams = namer.name_derivative(
+        namer.dirs["output"]["fiber"], "streamlines.npz" if float16 else "streamlines.trk"
+    )
 
     # Again, connectomes are different
     if not isinstance(labels, list):
@@ -281,9 +327,12 @@ def ndmg_dwi_worker(
             os.mkdir(namer.dirs["tmp"]["reg_m"])
         except:
             pass
+    # Record the registration settings next to the registered outputs
+    mgru.save_profile(os.path.join(namer.dirs["output"]["reg_anat"], "registration.json"))
 
     # Check orientation (t1w)
     start_time = time.time()
+    t1w_in = t1w
     t1w = mgu.reorient_img(t1w, namer)
     t1w = mgu.match_target_vox_res(t1w, vox_size, namer, sens="t1w")
     print(
@@ -296,14 +345,21 @@ def ndmg_dwi_worker(
         print("Running tractography in native space...")
         # Instantiate registration
         reg = mgr.dmri_reg(namer, nodif_B0, nodif_B0_mask, t1w, vox_size, simple=False)
+        # Atlas preparation and atlas-->MNI alignment are shared by every subject written to this output directory
+        atlas_cache = mgr.atlas_cache(atlas_cache_dir, reg.input_mni, vox_size)
+        # Segmentation and T1w<-->MNI registration are shared by every session with the same T1w scan
+        anat_cache = mgr.anat_cache(anat_cache_dir, t1w_in, vox_size, simple=reg.simple)
 
         # Perform anatomical segmentation
         start_time = time.time()
         if (skipreg is True) and os.path.isfile(reg.wm_edge):
             print('Found existing gentissue run!')
             pass
+        elif anat_cache.restore(reg, "tissue"):
+            pass
         else:
             reg.gen_tissue()
+            anat_cache.store(reg, "tissue")
             print(
                 "%s%s%s"
                 % ("gen_tissue runtime: ", str(np.round(time.time() - start_time, 1)), "s")
@@ -315,7 +371,10 @@ def ndmg_dwi_worker(
             print('Found existing t1w2dwi run!')
             pass
         else:
-            reg.t1w2dwi_align()
+            mni_cached = anat_cache.restore(reg, "mni")
+            reg.t1w2dwi_align(mni=not mni_cached)
+            if not mni_cached:
+                anat_cache.store(reg, "mni")
             print(
                 "%s%s%s"
                 % (
@@ -331,7 +390,7 @@ def ndmg_dwi_worker(
             print('Found existing tissue2dwi run!')
             pass
         else:
-            reg.tissue2dwi_align()
+            reg.tissue2dwi_align(n_jobs=n_cpus)
             print(
                 "%s%s%s"
                 % (
@@ -343,8 +402,13 @@ def ndmg_dwi_worker(
 
         # -------- Tensor Fitting and Fiber Tractography ---------------- #
         start_time = time.time()
-        seeds = mgt.build_seed_list(reg.wm_gm_int_in_dwi, np.eye(4), dens=10)
-        print("Using " + str(len(seeds)) + " seeds...")
+        # Seeds are drawn lazily in batches. With a streamline budget, voxels are visited in random order so that
+        # the streamlines kept cover the whole interface. Seeding and tracking share the random seed, so a run is
+        # reproducible.
+        seeds = mgt.seed_stream(
+            reg.wm_gm_int_in_dwi, np.eye(4), dens=10, shuffle=max_streamlines is not None, random_seed=random_seed
+        )
+        print("Using up to " + str(len(seeds)) + " seeds...")
 
         # Compute direction model and track fiber streamlines
         print("Beginning tractography...")
@@ -361,11 +425,11 @@ def ndmg_dwi_worker(
             mod_func,
             seeds,
             np.eye(4),
+            n_jobs=n_cpus,
+            random_seed=random_seed,
+            cache_dir=model_cache_dir,
+            max_streamlines=max_streamlines,
         )
-        streamlines = trct.run()
-        streamlines = Streamlines([sl for sl in streamlines if len(sl) > 40])
-        print("Streamlines complete")
-
         trk_affine = np.eye(4)
         trk_hdr = nib.streamlines.trk.TrkFile.create_empty_header()
         trk_hdr["hdr_size"] = 1000
@@ -379,12 +443,20 @@ def ndmg_dwi_worker(
         ).astype("float32")
         trk_hdr["endianness"] = "<"
         trk_hdr["_offset_data"] = 1000
-        trk_hdr["nb_streamlines"] = streamlines.total_nb_rows
-        tractogram = nib.streamlines.Tractogram(
-            streamlines, affine_to_rasmm=trk_affine
-        )
-        trkfile = nib.streamlines.trk.TrkFile(tractogram, header=trk_hdr)
-        nib.streamlines.save(trkfile, streams)
+
+        # Stream streamlines longer than 40 points straight to disk, then read back the filtered tractogram once.
+        # The step size is recorded in the sidecar so that compressed streamlines can be resampled for labeling.
+        with mgt.trk_stream(
+            streams, trk_hdr, affine_to_rasmm=trk_affine, min_length=40, compress_tol=compress_tol,
+            float16=float16, sidecar={"step_size": trct.step_size},
+        ) as sink:
+            trct.run(sink=sink)
+        # Release the fitted model and cropped volumes before the tractogram is loaded
+        del trct
+        [streamlines, stream_meta] = mgt.load_streamlines(streams)
+        streamlines = mgu.artifacts.put("streamlines", streamlines, streams)
+        max_step = stream_meta["step_size"] if stream_meta.get("compress_tol") else None
+        print("Streamlines complete")
         print(
             "%s%s%s"
             % ("Tractography runtime: ", str(np.round(time.time() - start_time, 1)), "s")
@@ -394,13 +466,16 @@ def ndmg_dwi_worker(
         # Save streamlines to disk
         print("Saving streamlines: " + streams)
 
-        fa_path = mgt.tens_mod_fa_est(gtab, dwi_prep, nodif_B0_mask)
+        fa_path = mgt.tens_mod_fa_est(gtab, dwi_prep, nodif_B0_mask, n_jobs=n_cpus)
 
         # Normalize streamlines
         print("Running DSN...")
         streamlines_mni = mgr.direct_streamline_norm(
             streams, fa_path, namer
         )
+        # Connectomes are built from the normalized streamlines, so release the native-space tractogram
+        mgu.artifacts.discard("streamlines", streams)
+        streamlines = None
 
     elif reg_style == "mni":
         # Check dimensions
@@ -456,17 +531,24 @@ def ndmg_dwi_worker(
         print("atlas location: {}").format(atlas)
 
     # ------- Connectome Estimation --------------------------------- #
+    # Align every parcellation to the dwi (or, for DSN, MNI) space first. The alignments are independent, so their
+    # FSL calls run side by side.
+    if reg_style == "native" or reg_style == "native_dsn":
+        start_time = time.time()
+        aligned_labels = reg.align_atlases(
+            [atlas_cache.prepare(label, namer) for label in labels], dsn=reg_style == "native_dsn", n_jobs=n_cpus
+        )
+        print(
+            "%s%s%s"
+            % ("Atlas alignment runtime: ", str(np.round(time.time() - start_time, 1)), "s")
+        )
+
     # Generate graphs from streamlines for each parcellation
+    graphs = []
     for idx, label in enumerate(labels):
         print("Generating graph for {} parcellation...".format(label))
         if reg_style == "native_dsn":
-            # align atlas to t1w to dwi
-            print("%s%s" % ("Applying native-space alignment to ", labels[idx]))
-            labels_im_file = mgu.reorient_img(labels[idx], namer)
-            labels_im_file = mgu.match_target_vox_res(
-                labels_im_file, vox_size, namer, sens="t1w"
-            )
-            labels_im_file_mni = reg.atlas2t1w2dwi_align(labels_im_file, dsn=True)
+            labels_im_file_mni = aligned_labels[idx]
             labels_im = nib.load(labels_im_file_mni)
             g1 = mgg.graph_tools(
                 attr=len(np.unique(labels_im.get_data().astype("int"))) - 1,
@@ -476,15 +558,8 @@ def ndmg_dwi_worker(
                 namer=namer,
                 connectome_path=connectomes[idx],
             )
-            g1.g = g1.make_graph()
         elif reg_style == "native":
-            # align atlas to t1w to dwi
-            print("%s%s" % ("Applying native-space alignment to ", labels[idx]))
-            labels_im_file = mgu.reorient_img(labels[idx], namer)
-            labels_im_file = mgu.match_target_vox_res(
-                labels_im_file, vox_size, namer, sens="t1w"
-            )
-            labels_im_file_dwi = reg.atlas2t1w2dwi_align(labels_im_file, dsn=False)
+            labels_im_file_dwi = aligned_labels[idx]
             labels_im = nib.load(labels_im_file_dwi)
             g1 = mgg.graph_tools(
                 attr=len(np.unique(labels_im.get_data().astype("int"))) - 1,
@@ -494,7 +569,6 @@ def ndmg_dwi_worker(
                 namer=namer,
                 connectome_path=connectomes[idx],
             )
-            g1.g = g1.make_graph()
         elif reg_style == "mni":
             labels_im_file = mgu.reorient_img(labels[idx], namer)
             labels_im_file = mgu.match_target_vox_res(
@@ -510,6 +584,29 @@ def ndmg_dwi_worker(
                 connectome_path=connectomes[idx],
             )
             g1.make_graph_old()
+        graphs.append(g1)
+
+    # Label the tractogram once for all native-space parcellations, which share a voxel grid
+    if reg_style == "native" or reg_style == "native_dsn":
+        start_time = time.time()
+        # Mean fiber length and FA per edge are sampled during the labeling pass. Native-space FA only lines up with
+        # native-space labels, so DSN connectomes carry lengths alone.
+        scalar_maps = None
+        if reg_style == "native":
+            scalar_maps = {"fa": mgt.tens_mod_fa_est(gtab, dwi_prep, nodif_B0_mask, n_jobs=n_cpus)}
+        # Later stages only need the graphs' own inputs, so release the registered artifacts before workers fork
+        mgu.artifacts.clear()
+        # Streamlines are in voxel coordinates of the working grid, so lengths are scaled by its voxel size
+        mgg.make_graphs(
+            graphs, voxel_size=int(vox_size[0]), n_jobs=n_cpus, edge_lengths=True, scalar_maps=scalar_maps,
+            max_step=max_step,
+        )
+        print(
+            "%s%s%s"
+            % ("Connectome runtime: ", str(np.round(time.time() - start_time, 1)), "s")
+        )
+
+    for idx, g1 in enumerate(graphs):
         g1.summary()
         g1.save_graph_png(connectomes[idx])
         g1.save_graph(connectomes[idx])
@@ -523,16 +620,19 @@ def ndmg_dwi_worker(
     if push and buck and remo is not None:
         if not modif:
             modif = "ndmg_{}".format(ndmg.VERSION.replace(".", "-"))
-        s3_utils.s3_push_data(buck, remo, outdir, modif, creds, debug=debug)
+        s3_utils.s3_push_data(
+            buck, remo, outdir, modif, creds, debug=debug,
+            exclude=[os.path.relpath(path, outdir) + "/*" for path in cache_dirs],
+        )
         print("Pushing Complete!")
         if not debug:
             print("Listing contents of output directory ...")
             print(os.listdir(outdir))
-            print("clearing contents of output directory ...")
-            shutil.rmtree(outdir)
+            print("clearing contents of output directory, except caches ...")
+            clear_outputs(outdir, keep=cache_dirs)
             print(
-                "Clearing complete. Output directory exists: {}".format(
-                    os.path.exists(outdir)
+                "Clearing complete. Output directory contents: {}".format(
+                    os.listdir(outdir)
                 )
             )
             # # Log docker info in EC2 containers, assuming we're using AWS Batch
@@ -623,6 +723,49 @@ def main():
         default=False,
         help="whether or not to skip registration",
     )
+    parser.add_argument(
+        "--n_cpus",
+        action="store",
+        type=int,
+        default=1,
+        help="Number of worker processes for parallelized stages. Default is 1.",
+    )
+    parser.add_argument(
+        "--max_streamlines",
+        action="store",
+        type=int,
+        default=None,
+        help="Stop tractography after this many streamlines are kept. Default is to track every seed.",
+    )
+    parser.add_argument(
+        "--compress_tol",
+        action="store",
+        type=float,
+        default=None,
+        help="Compress streamlines, keeping every point within this distance (in voxels) of the tracked path. "
+        "Default is no compression.",
+    )
+    parser.add_argument(
+        "--float16",
+        action="store_true",
+        default=False,
+        help="Store streamline coordinates as float16 in a .npz file instead of a float32 .trk.",
+    )
+    parser.add_argument(
+        "--reg_backend",
+        action="store",
+        choices=["fsl", "dipy"],
+        default="fsl",
+        help="Affine registration backend: fsl runs flirt, dipy registers in-process. Default is fsl.",
+    )
+    parser.add_argument(
+        "--reg_profile",
+        action="store",
+        choices=["fast", "standard", "accurate"],
+        default="standard",
+        help="Registration profile, trading accuracy for speed in the search range, cost-function bins, pyramid "
+        "levels and iterations of every registration. Default is standard.",
+    )
     result = parser.parse_args()
 
     # Create output directory
@@ -646,7 +789,13 @@ def main():
         result.sp,
         result.clean,
         result.skipeddy,
-        result.skipreg
+        result.skipreg,
+        n_cpus=result.n_cpus,
+        max_streamlines=result.max_streamlines,
+        compress_tol=result.compress_tol,
+        float16=result.float16,
+        reg_backend=result.reg_backend,
+        reg_profile=result.reg_profile,
     )
 
 
@@ -21,9 +21,12 @@
 
 import warnings
 warnings.simplefilter("ignore")
+import os
+import hashlib
 import numpy as np
 import nibabel as nib
 from dipy.tracking.streamline import Streamlines
+from ndmg.utils import gen_utils as mgu
 
 
 def build_seed_list(mask_img_file, stream_affine, dens):
@@ -40,31 +43,670 @@ def build_seed_list(mask_img_file, stream_affine, dens):
     return seeds
 
 
-def tens_mod_fa_est(gtab, dwi_file, B0_mask):
+def _uniform_hash(keys, n, random_seed):
+    """
+    Returns a (len(keys), n) array of uniform numbers in [0, 1), each a splitmix64 hash of its key, column and the
+    random seed. Unlike draws from a RandomState, the numbers for a key do not depend on the other keys or their order.
+    """
+    offset = np.uint64((int(random_seed) * 0x9E3779B97F4A7C15) % 2 ** 64)
+    x = np.asarray(keys, dtype=np.uint64)[:, np.newaxis] * np.uint64(n) + np.arange(n, dtype=np.uint64) + offset
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return (x >> np.uint64(11)).astype(np.float64) / 2.0 ** 53
+
+
+class seed_stream(object):
+    def __init__(self, mask_img_file, stream_affine, dens, batch_size=100000, shuffle=False, random_seed=None):
+        """
+        A lazy equivalent of build_seed_list. `dens` random seeds are drawn in each voxel of the mask, but only one
+        batch of seeds exists at a time, so memory does not grow with the number of seeds. Iterating yields (N, 3)
+        arrays of seeds, and len() gives the total number of seeds.
+
+        Parameters
+        ----------
+        mask_img_file: string
+            - Path to the seeding mask.
+        stream_affine: array
+            - Affine mapping voxel indices to streamline coordinates.
+        dens: int
+            - Number of seeds per mask voxel.
+        batch_size: int
+            - Approximate number of seeds per batch.
+        shuffle: bool
+            - Visit mask voxels in random order, so that any prefix of the seeds covers the whole mask. Used when
+            tracking stops after a fixed number of streamlines.
+        random_seed: int
+            - Seed of the random seed positions and voxel order, for reproducible seeding. The seeds of each voxel
+            depend only on the random seed and the voxel, so shuffling changes the order of the seeds but not the
+            seeds. None draws a new random seed on every iteration.
+        """
+        self.voxels = np.argwhere(load_data(mask_img_file, dtype=bool)).astype(np.int32)
+        self.stream_affine = np.asarray(stream_affine, dtype=float)
+        self.dens = int(dens)
+        self.voxels_per_batch = max(1, int(batch_size) // self.dens)
+        self.shuffle = shuffle
+        self.random_seed = random_seed
+
+    def __len__(self):
+        return len(self.voxels) * self.dens
+
+    def __iter__(self):
+        random_seed = np.random.randint(2 ** 31) if self.random_seed is None else self.random_seed
+        order = np.random.RandomState(random_seed).permutation(len(self.voxels)) if self.shuffle else None
+        for start in range(0, len(self.voxels), self.voxels_per_batch):
+            if order is None:
+                ids = np.arange(start, min(start + self.voxels_per_batch, len(self.voxels)))
+            else:
+                ids = order[start:start + self.voxels_per_batch]
+            jitter = _uniform_hash(ids, 3 * self.dens, random_seed).reshape(-1, 3)
+            seeds = np.repeat(self.voxels[ids], self.dens, axis=0) + jitter
+            seeds -= 0.5
+            yield np.dot(seeds, self.stream_affine[:3, :3].T) + self.stream_affine[:3, 3]
+
+
+# Per-process cache of loaded images and arrays, so each input file is read once per process. Forked workers
+# inherit it.
+_image_cache = {}
+
+
+def _file_key(path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return (path, stat.st_mtime, stat.st_size)
+
+
+def load_image(path):
+    """
+    Loads a NIfTI image once per process. Uncompressed images are memory-mapped read-only, so their data is only
+    paged in as it is sliced.
+    """
+    key = ("image",) + _file_key(path)
+    if key not in _image_cache:
+        _image_cache[key] = nib.load(path, mmap="r")
+    return _image_cache[key]
+
+
+def load_data(path, crop=None, dtype=np.float32):
+    """
+    Returns the data of a NIfTI image as `dtype`, optionally cropped to the voxel slices `crop`, reading it once per
+    process. Only the cropped block is read from disk, and crops of an already loaded volume are views into it.
+    Callers that modify the returned array must copy it first.
+
+    Parameters
+    ----------
+    path: string
+        - Path to a NIfTI image.
+    crop: tuple
+        - Slices of the first three axes to keep, such as from bbox_slices. None keeps the whole volume.
+    dtype: dtype
+        - Working dtype of the returned array.
+
+    Returns
+    -------
+    data: array
+        - The (cropped) image data.
+    """
+    dtype = np.dtype(dtype)
+    full_key = ("data",) + _file_key(path) + (None, dtype.str)
+    key = full_key if crop is None else full_key[:-2] + (tuple((sl.start, sl.stop) for sl in crop), dtype.str)
+    if key in _image_cache:
+        return _image_cache[key]
+    if crop is not None and full_key in _image_cache:
+        return _image_cache[full_key][crop]
+    dataobj = load_image(path).dataobj
+    data = np.asarray(dataobj if crop is None else dataobj[crop]).astype(dtype, copy=False)
+    _image_cache[key] = data
+    return data
+
+
+def clear_image_cache():
+    """
+    Drops every image and array loaded through load_image and load_data in this process.
+    """
+    _image_cache.clear()
+
+
+class _lazy_property(object):
+    """
+    A property computed on first access and then stored on the instance.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.func.__name__] = self.func(obj)
+        return value
+
+
+def bbox_slices(mask, margin=2):
+    """
+    Returns the slices of the bounding box of a mask, grown by `margin` voxels on every side and clipped to the
+    volume. A margin of None, or an empty mask, selects the whole volume.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if margin is None or not mask.any():
+        return tuple(slice(0, dim) for dim in mask.shape)
+    crop = []
+    for axis, dim in enumerate(mask.shape):
+        hits = np.flatnonzero(mask.any(axis=tuple(ax for ax in range(mask.ndim) if ax != axis)))
+        crop.append(slice(max(int(hits[0]) - margin, 0), min(int(hits[-1]) + 1 + margin, dim)))
+    return tuple(crop)
+
+
+# Per-process model fitting state. It is set in the parent before the worker pool forks, so workers inherit the
+# model and the packed in-mask voxels instead of unpickling them.
+_fit_state = {}
+
+
+def _fit_chunk(bounds):
+    """
+    Fits the shared model to one contiguous range of packed in-mask voxels and returns its parameter array.
+    """
+    start, stop = bounds
+    fit = _fit_state["model"].fit(_fit_state["voxels"][start:stop])
+    return np.asarray(getattr(fit, _fit_state["field"]))
+
+
+def fit_model(model, data, mask=None, n_jobs=1, chunk_size=20000):
+    """
+    Fits a dipy reconstruction model over a volume, in chunks of in-mask voxels spread over worker processes.
+    In-mask voxels are packed into one contiguous (N, G) array, fit chunk by chunk, and the chunk parameters are
+    scattered back into volume shape. Tensor fits (model_params) and spherical harmonic fits (shm_coeff) are
+    supported, including voxel-wise models such as CSD whose fits are gathered into a SphHarmFit; other models, and
+    n_jobs=1, are fit in a single call.
+
+    Parameters
+    ----------
+    model: ReconstModel
+        - A dipy model, such as TensorModel, CsaOdfModel, or ConstrainedSphericalDeconvModel.
+    data: array
+        - (X, Y, Z, G) diffusion data.
+    mask: array
+        - (X, Y, Z) mask of the voxels to fit. Defaults to every voxel.
+    n_jobs: int
+        - Number of worker processes. Values below 1 use every available core.
+    chunk_size: int
+        - Number of voxels fit per task.
+
+    Returns
+    -------
+    fit: ReconstFit
+        - The model fit over the whole volume, with zero parameters outside the mask.
+    """
+    import multiprocessing
+    from dipy.reconst.dti import TensorFit
+    from dipy.reconst.shm import SphHarmFit
+    from dipy.reconst.multi_voxel import MultiVoxelFit
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    if mask is None:
+        mask = np.ones(data.shape[:-1], dtype=bool)
+    mask = np.asarray(mask, dtype=bool)
+    n_voxels = int(mask.sum())
+    n_chunks = int(np.ceil(n_voxels / float(chunk_size)))
+    if n_jobs == 1 or n_chunks < 2:
+        return model.fit(data, mask=mask)
+    # Fit a single voxel to find out which parameter array describes the model's fits
+    probe = model.fit(data[mask][:1])
+    fit_type = type(probe)
+    if issubclass(fit_type, TensorFit):
+        field = "model_params"
+    elif issubclass(fit_type, SphHarmFit):
+        field = "shm_coeff"
+    elif issubclass(fit_type, MultiVoxelFit) and hasattr(probe, "shm_coeff"):
+        # Voxel-wise fits, such as CSD, keep one fit object per voxel; their coefficients are gathered per chunk
+        field = "shm_coeff"
+        fit_type = SphHarmFit
+    else:
+        return model.fit(data, mask=mask)
+
+    print("Fitting {} in-mask voxels in {} chunks with {} workers...".format(n_voxels, n_chunks, n_jobs))
+    _fit_state.update(model=model, voxels=np.ascontiguousarray(data[mask]), field=field)
+    bounds = [(start, min(start + chunk_size, n_voxels)) for start in range(0, n_voxels, chunk_size)]
+    pool = multiprocessing.get_context("fork").Pool(min(n_jobs, n_chunks))
+    try:
+        params = np.concatenate(pool.map(_fit_chunk, bounds))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _fit_state.clear()
+
+    volume = np.zeros(mask.shape + params.shape[1:], dtype=params.dtype)
+    volume[mask] = params
+    if field == "model_params":
+        return fit_type(model, volume)
+    return fit_type(model, volume, mask)
+
+
+def tens_mod_fa_est(gtab, dwi_file, B0_mask, n_jobs=1):
     '''
-    Estimate a tensor FA image to use for registrations.
+    Estimate a tensor FA image to use for registrations. The tensor fit is spread over `n_jobs` worker processes.
+    The FA map is registered in mgu.artifacts, so later calls on the same inputs reuse it, and the DWI block already
+    loaded by run_track is reused when it covers the mask, and then released.
     '''
     import os
     from dipy.reconst.dti import TensorModel
     from dipy.reconst.dti import fractional_anisotropy
 
-    data = nib.load(dwi_file).get_fdata()
+    fa_path = "%s%s" % (os.path.dirname(B0_mask), '/tensor_fa.nii.gz')
+    inputs = (dwi_file, B0_mask, gtab.bvals, gtab.bvecs)
+    if mgu.artifacts.get("fa_path", *inputs) == fa_path and mgu.artifacts.get("image", fa_path) is not None:
+        print('Reusing tensor FA image: ' + fa_path)
+        return fa_path
 
     print('Generating simple tensor FA image to use for registrations...')
-    nodif_B0_img = nib.load(B0_mask)
-    B0_mask_data = nodif_B0_img.get_fdata().astype('bool')
+    nodif_B0_img = load_image(B0_mask)
+    B0_mask_data = load_data(B0_mask, dtype=bool)
     nodif_B0_affine = nodif_B0_img.affine
+    # Only the bounding box of the mask is fit, using the tracking stage's cropped DWI when it covers the mask
+    tracked = mgu.artifacts.get("dwi_crop", dwi_file)
+    mgu.artifacts.discard("dwi_crop", dwi_file)
+    if tracked is not None and B0_mask_data[tracked[0]].sum() == B0_mask_data.sum():
+        crop, data = tracked
+    else:
+        crop = bbox_slices(B0_mask_data, margin=0)
+        data = load_data(dwi_file, crop=crop)
     model = TensorModel(gtab)
-    mod = model.fit(data, B0_mask_data)
-    FA = fractional_anisotropy(mod.evals)
-    FA[np.isnan(FA)] = 0
-    fa_img = nib.Nifti1Image(FA.astype(np.float32), nodif_B0_affine)
-    fa_path = "%s%s" % (os.path.dirname(B0_mask), '/tensor_fa.nii.gz')
+    mod = fit_model(model, data, B0_mask_data[crop], n_jobs=n_jobs)
+    FA = np.zeros(B0_mask_data.shape, dtype=np.float32)
+    FA[crop] = np.nan_to_num(fractional_anisotropy(mod.evals))
+    fa_img = nib.Nifti1Image(FA, nodif_B0_affine)
     nib.save(fa_img, fa_path)
+    mgu.artifacts.put("fa_path", fa_path, *inputs)
+    mgu.artifacts.put("image", fa_img, fa_path)
+    # The full-volume mask and the DWI block are not needed by later stages
+    clear_image_cache()
     return fa_path
 
 
+def _savez_atomic(cache_file, **arrays):
+    """
+    Writes arrays to an npz file under a temporary name and then moves it into place, so that a concurrent run
+    never reads a partial cache entry.
+    """
+    tmp_file = "{}.{}.tmp.npz".format(cache_file[:-len(".npz")], os.getpid())
+    np.savez(tmp_file, **arrays)
+    os.replace(tmp_file, cache_file)
+
+
+# Peak fields of a PeaksAndMetrics that are persisted in the model cache, when present
+_PEAK_FIELDS = ("peak_dirs", "peak_values", "peak_indices", "gfa", "qa", "shm_coeff", "B", "odf")
+
+
+def save_peaks(cache_file, pam):
+    """
+    Saves the arrays of a PeaksAndMetrics to an npz model cache entry.
+    """
+    arrays = dict((field, getattr(pam, field)) for field in _PEAK_FIELDS if getattr(pam, field, None) is not None)
+    for field in ("ang_thr", "qa_thr", "total_weight"):
+        if hasattr(pam, field):
+            arrays[field] = np.asarray(getattr(pam, field))
+    _savez_atomic(cache_file, **arrays)
+
+
+def load_peaks(cache_file, sphere):
+    """
+    Loads a PeaksAndMetrics saved with save_peaks, on the sphere its peaks were computed on.
+    """
+    from dipy.direction.peaks import PeaksAndMetrics
+
+    pam = PeaksAndMetrics()
+    pam.sphere = sphere
+    with np.load(cache_file) as arrays:
+        for field in arrays.files:
+            val = arrays[field]
+            setattr(pam, field, val.item() if val.ndim == 0 else val)
+    return pam
+
+
+# Per-process tracking state. It is set in the parent before the worker pool forks, so workers inherit the
+# direction getter and tissue classifier instead of unpickling them.
+_tracking_state = {}
+
+
+def _track_chunk(seeds):
+    """
+    Track one chunk of seeds and return the packed streamlines.
+    """
+    state = _tracking_state
+    streamline_generator = state["tracker"](
+        state["direction_getter"],
+        state["tiss_classifier"],
+        seeds,
+        state["stream_affine"],
+        random_seed=state["random_seed"],
+        **state["kwargs"]
+    )
+    return Streamlines(streamline_generator)
+
+
+def parallel_tracking(
+    tracker,
+    direction_getter,
+    tiss_classifier,
+    seeds,
+    stream_affine,
+    n_jobs=1,
+    chunk_size=None,
+    random_seed=42,
+    sink=None,
+    limit=None,
+    **kwargs
+):
+    """
+    Runs a dipy tracking class over chunks of seeds in a pool of worker processes. Every chunk is tracked with the
+    same `random_seed`, from which dipy seeds each streamline along with the seed's voxel coordinates under
+    `stream_affine`. Probabilistic streamlines are therefore the same for any chunking and number of workers, and
+    match tracking every seed in one process with the same random seed. The same seeds tracked in a differently
+    cropped grid give different probabilistic streamlines.
+
+    Seeds may be one array or an iterable of seed batches such as seed_stream. One pool tracks every batch, and
+    chunks are cut from the batches lazily as workers free up, so workers do not wait for the end of a batch and only
+    a few chunks of seeds exist at a time.
+
+    Parameters
+    ----------
+    tracker: class
+        - LocalTracking, ParticleFilteringTracking, or a class with the same constructor.
+    direction_getter: DirectionGetter
+        - Direction getter shared by every worker.
+    tiss_classifier: TissueClassifier
+        - Tissue classifier shared by every worker.
+    seeds: array or iterable
+        - (N, 3) array of seed points, or an iterable of such arrays.
+    stream_affine: array
+        - Affine of the streamline coordinates.
+    n_jobs: int
+        - Number of worker processes. Values below 1 use every available core.
+    chunk_size: int
+        - Number of seeds per chunk. Defaults to splitting each batch of seeds into four chunks per worker.
+    random_seed: int
+        - Random seed passed to `tracker` for every chunk.
+    sink: trk_stream
+        - Optional writer that receives each chunk's streamlines as it completes, instead of keeping them in memory.
+    limit: int
+        - Stop once this many streamlines have been accepted in total, by the sink when one is given. The
+        streamlines kept are the first ones in seed order.
+    kwargs:
+        - Keyword arguments passed on to `tracker`.
+
+    Returns
+    -------
+    streamlines: Streamlines
+        - The streamlines of every chunk, concatenated in seed order, or `sink` if one was given.
+    """
+    import multiprocessing
+    import threading
+
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    batches = [seeds] if isinstance(seeds, np.ndarray) else seeds
+    # The pool feeds tasks from a background thread that would otherwise draw every batch at once. Each chunk takes a
+    # slot that is freed when its streamlines are consumed, and `stop` lets the feeder return once tracking ends.
+    slots = threading.Semaphore(4 * n_jobs)
+    stop = threading.Event()
+
+    def chunks():
+        for batch in batches:
+            batch = np.asarray(batch)
+            size = chunk_size or max(1, int(np.ceil(len(batch) / float(4 * n_jobs))))
+            for start in range(0, len(batch), size):
+                slots.acquire()
+                if stop.is_set():
+                    return
+                yield batch[start:start + size]
+
+    print("Tracking seed chunks with {} workers...".format(n_jobs))
+    _tracking_state.update(
+        tracker=tracker,
+        direction_getter=direction_getter,
+        tiss_classifier=tiss_classifier,
+        stream_affine=stream_affine,
+        random_seed=int(random_seed),
+        kwargs=kwargs,
+    )
+    streamlines = Streamlines() if sink is None else sink
+    pool = multiprocessing.get_context("fork").Pool(n_jobs)
+    try:
+        for chunk_streamlines in pool.imap(_track_chunk, chunks()):
+            slots.release()
+            if sink is None:
+                if limit is not None:
+                    chunk_streamlines = chunk_streamlines[:max(limit - len(streamlines), 0)]
+                streamlines.extend(chunk_streamlines)
+                n_accepted = len(streamlines)
+            else:
+                sink.write(chunk_streamlines, limit=limit)
+                n_accepted = sink.nb_accepted
+            if limit is not None and n_accepted >= limit:
+                break
+    finally:
+        # Every result has been consumed, or the streamline limit was reached and the remaining chunks are dropped
+        stop.set()
+        slots.release()
+        pool.terminate()
+        pool.join()
+        _tracking_state.clear()
+    return streamlines
+
+
+def load_streamlines(streams):
+    """
+    Loads a tractogram written by trk_stream, either a TRK file or a float16 .npz, along with its JSON sidecar.
+    Coordinates are returned as float32 in streamline coordinates.
+
+    Parameters
+    ----------
+    streams: string
+        - Path to a .trk or .npz tractogram.
+
+    Returns
+    -------
+    streamlines: Streamlines
+        - The streamlines.
+    sidecar: dict
+        - The storage description from the sidecar, such as the compression tolerance. Empty if there is none.
+    """
+    import json
+
+    sidecar_file = os.path.splitext(streams)[0] + ".json"
+    sidecar = {}
+    if os.path.isfile(sidecar_file):
+        with open(sidecar_file) as f:
+            sidecar = json.load(f)
+    if not streams.endswith(".npz"):
+        return nib.streamlines.load(streams).streamlines, sidecar
+    with np.load(streams) as arrays:
+        lengths = arrays["lengths"].astype(np.int64)
+        points = arrays["points"].astype(np.float32)
+    if not len(lengths):
+        return Streamlines(), sidecar
+    return Streamlines(np.split(points, np.cumsum(lengths)[:-1])), sidecar
+
+
+class trk_stream(object):
+    def __init__(self, trk_file, header, affine_to_rasmm=np.eye(4), min_length=40, compress_tol=None,
+                 buffer_size=10000, float16=False, sidecar=None):
+        """
+        A streaming tractogram writer. Streamlines are filtered by length, optionally compressed, and appended to the
+        file in buffered blocks as they are produced, so memory use does not grow with the size of the tractogram.
+        The streamline count in the header is patched when the writer is closed, and a JSON sidecar describing the
+        storage (compression tolerance, coordinate dtype) is written next to the file.
+
+        Parameters
+        ----------
+        trk_file: string
+            - Path of the .trk file to write, or of a .npz file when `float16` is set.
+        header: dict
+            - TRK header fields, as for nib.streamlines.trk.TrkFile. `nb_streamlines` is filled in on close.
+        affine_to_rasmm: array
+            - Affine mapping the streamline coordinates to RAS+ mm, as for nib.streamlines.Tractogram.
+        min_length: int
+            - Streamlines with this many points or fewer are dropped.
+        compress_tol: float
+            - If set, streamlines are linearized with dipy's compress_streamlines, keeping every point within this
+            distance of the original streamline, in streamline coordinate units.
+        buffer_size: int
+            - Number of streamlines buffered between writes.
+        float16: bool
+            - Store coordinates as float16 in a .npz file ("points" and "lengths" arrays, in streamline
+            coordinates), since TRK only holds float32. Read it back with load_streamlines.
+        sidecar: dict
+            - Extra fields to record in the JSON sidecar, such as the tracking step size.
+        """
+        from nibabel.streamlines.trk import TrkFile, header_2_dtype, get_affine_rasmm_to_trackvis
+
+        if float16 and not trk_file.endswith(".npz"):
+            raise ValueError("float16 tractograms are stored as .npz, got {}".format(trk_file))
+        self.trk_file = trk_file
+        self.min_length = min_length
+        self.compress_tol = compress_tol
+        self.buffer_size = buffer_size
+        self.float16 = float16
+        self.sidecar = dict(sidecar or {})
+        self.header = np.zeros((), dtype=header_2_dtype.newbyteorder("<"))
+        empty = TrkFile.create_empty_header()
+        for name in header_2_dtype.names:
+            self.header[name] = empty[name]
+        for key, val in header.items():
+            if key in header_2_dtype.names:
+                self.header[key] = val
+        if self.header["voxel_order"] == b"":
+            self.header["voxel_order"] = b"LPS"
+        self.affine = np.dot(get_affine_rasmm_to_trackvis(self.header), affine_to_rasmm)
+        self.nb_streamlines = 0
+        self.nb_dropped = 0
+        self._buffer = []
+        self._lengths = []
+        if float16:
+            # Points are appended to a raw float16 file and packed into the .npz on close
+            self._file = open(trk_file + ".points.tmp", "wb")
+        else:
+            self._file = open(trk_file, "wb")
+            self._file.write(self.header.tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def nb_accepted(self):
+        """
+        Number of streamlines that passed the length filter so far, written or still buffered.
+        """
+        return self.nb_streamlines + len(self._buffer)
+
+    def write(self, streamlines, limit=None):
+        """
+        Appends an iterable of streamlines, such as a tracking generator, to the file. If `limit` is set, consumption
+        stops as soon as that many streamlines have been accepted in total.
+        """
+        if limit is not None and self.nb_accepted >= limit:
+            return self
+        for sl in streamlines:
+            if len(sl) <= self.min_length:
+                self.nb_dropped += 1
+                continue
+            self._buffer.append(sl)
+            if limit is not None and self.nb_accepted >= limit:
+                break
+            if len(self._buffer) >= self.buffer_size:
+                self.flush()
+        return self
+
+    def flush(self):
+        """
+        Writes the buffered streamlines as one block of interleaved point counts and voxmm coordinates.
+        """
+        if not self._buffer:
+            return
+        if self.compress_tol:
+            from dipy.tracking.streamline import compress_streamlines
+
+            self._buffer = compress_streamlines(self._buffer, tol_error=self.compress_tol)
+        lengths = np.array([len(sl) for sl in self._buffer], dtype="<i4")
+        points = np.concatenate(self._buffer)
+        if self.float16:
+            self._file.write(points.astype("<f2").tobytes())
+            self._lengths.append(lengths)
+            self.nb_streamlines += len(lengths)
+            self._buffer = []
+            return
+        points = np.dot(points, self.affine[:3, :3].T) + self.affine[:3, 3]
+
+        # Each streamline is an int32 point count followed by its float32 points, so counts and coordinates share
+        # one 4-byte buffer
+        block = np.empty(len(lengths) + points.size, dtype="<f4")
+        starts = np.arange(len(lengths)) + 3 * (np.cumsum(lengths) - lengths)
+        is_point = np.ones(len(block), dtype=bool)
+        is_point[starts] = False
+        block.view("<i4")[starts] = lengths
+        block[is_point] = points.ravel()
+        self._file.write(block.tobytes())
+        self.nb_streamlines += len(lengths)
+        self._buffer = []
+
+    def close(self):
+        """
+        Flushes the remaining streamlines and patches the header with the final streamline count.
+        """
+        import json
+
+        if self._file.closed:
+            return self.nb_streamlines
+        self.flush()
+        if self.float16:
+            self._file.close()
+            lengths = np.concatenate(self._lengths) if self._lengths else np.zeros(0, dtype="<i4")
+            if lengths.sum():
+                points = np.memmap(self._file.name, dtype="<f2", mode="r", shape=(int(lengths.sum()), 3))
+            else:
+                points = np.zeros((0, 3), dtype="<f2")
+            np.savez(self.trk_file, points=points, lengths=lengths)
+            del points
+            os.remove(self._file.name)
+        else:
+            self.header["nb_streamlines"] = self.nb_streamlines
+            self._file.seek(0)
+            self._file.write(self.header.tobytes())
+            self._file.close()
+        self.sidecar.update(
+            format="npz" if self.float16 else "trk",
+            coordinate_dtype="float16" if self.float16 else "float32",
+            compress_tol=self.compress_tol,
+            min_length=self.min_length,
+            nb_streamlines=self.nb_streamlines,
+        )
+        with open(os.path.splitext(self.trk_file)[0] + ".json", "w") as f:
+            json.dump(self.sidecar, f, indent=2, sort_keys=True)
+        print("Wrote {} streamlines to {} ({} shorter than {} points dropped)".format(
+            self.nb_streamlines, self.trk_file, self.nb_dropped, self.min_length + 1))
+        return self.nb_streamlines
+
+
 class run_track(object):
+    # Model and peak-extraction parameters shared by every fit, and part of the model cache key
+    model_params = dict(
+        sh_order=6,
+        sphere="repulsion724",
+        relative_peak_threshold=0.5,
+        min_separation_angle=25,
+        npeaks=5,
+    )
+    # Tracking step size, in voxels
+    step_size = 0.5
+
     def __init__(
         self,
         dwi_in,
@@ -79,6 +721,12 @@ class run_track(object):
         mod_func,
         seeds,
         stream_affine,
+        n_jobs=1,
+        seed_chunk_size=None,
+        random_seed=42,
+        cache_dir=None,
+        crop_margin=2,
+        max_streamlines=None,
     ):
         """
         A class for deterministic tractography in native space.
@@ -111,6 +759,27 @@ class run_track(object):
             nibabel is capable of reading, with data as a 3D object.
         gtab: string
             - Gradient table.
+        n_jobs: int
+            - Number of worker processes for model fitting and for tracking chunks of seeds. 1 fits and tracks
+            everything in the main process.
+        seed_chunk_size: int
+            - Number of seeds per chunk when tracking in parallel.
+        random_seed: int
+            - Random seed of probabilistic tracking. dipy seeds each streamline from it and the seed's voxel
+            coordinates, so streamlines are reproducible for a given random seed and crop, whatever `n_jobs` and
+            `seed_chunk_size`.
+        cache_dir: string
+            - Directory of the model cache. Fitted peaks (det) and spherical harmonic coefficients (prob) are stored
+            there under a hash of the DWI, white-matter mask, gradient table, and model parameters, so a later run on
+            the same data skips model fitting. None disables the cache.
+        crop_margin: int
+            - Margin, in voxels, kept around the bounding box of the brain and tissue masks when cropping the
+            volumes for modelling and tracking. None disables cropping. Deterministic tracking is unaffected by the
+            crop, but probabilistic streamlines depend on it, since dipy seeds each streamline from its voxel
+            coordinates in the cropped grid. Use None to reproduce probabilistic streamlines tracked on the full grid.
+        max_streamlines: int
+            - Stop tracking once this many streamlines have been accepted (by the sink's length filter, when one is
+            given). Seeds should then come from a shuffled seed_stream, so that the streamlines cover the whole mask.
         """
         self.dwi = dwi_in
         self.nodif_B0_mask = nodif_B0_mask
@@ -124,11 +793,31 @@ class run_track(object):
         self.seeds = seeds
         self.mod_func = mod_func
         self.stream_affine = stream_affine
+        self.n_jobs = n_jobs
+        self.seed_chunk_size = seed_chunk_size
+        self.random_seed = random_seed
+        self.sink = None
+        self.cache_dir = cache_dir
+        self.cache_file = None
+        self.crop_margin = crop_margin
+        self.crop = None
+        self.max_streamlines = max_streamlines
 
-    def run(self):
+    def run(self, sink=None):
+        """
+        Fits the direction model and tracks every seed. If a `sink` such as trk_stream is given, streamlines are
+        handed to it as they are produced and the sink is returned, instead of a Streamlines object.
+        """
+        self.sink = sink
         self.tiss_classifier = self.prep_tracking()
+        self.cache_file = self.model_cache_file()
+        cache_hit = self.cache_file is not None and os.path.isfile(self.cache_file)
+        if cache_hit:
+            print("Found cached model fit: " + self.cache_file)
         if self.mod_type == "det":
-            if self.mod_func == "csa":
+            if cache_hit:
+                pass
+            elif self.mod_func == "csa":
                 self.mod = self.odf_mod_est()
             elif self.mod_func == "csd":
                 self.mod = self.csd_mod_est()
@@ -141,7 +830,9 @@ class run_track(object):
                     "Error: Either no seeds supplied, or no valid seeds found in white-matter interface"
                 )
         elif self.mod_type == "prob":
-            if self.mod_func == "csa":
+            if cache_hit:
+                pass
+            elif self.mod_func == "csa":
                 self.mod = self.odf_mod_est()
             elif self.mod_func == "csd":
                 self.mod = self.csd_mod_est()
@@ -153,8 +844,58 @@ class run_track(object):
             raise ValueError(
                 "Error: Either no seeds supplied, or no valid seeds found in white-matter interface"
             )
+        # Tracking is done with the full-volume masks read for the bounding box and the cropped DWI, so release them
+        clear_image_cache()
         return tracks
 
+    def model_cache_file(self):
+        """
+        Returns the model cache entry for this DWI, white-matter mask, gradient table, and model, or None if the
+        cache is disabled. Deterministic runs cache peaks and probabilistic runs cache spherical harmonic
+        coefficients.
+        """
+        import dipy
+
+        if self.cache_dir is None:
+            return None
+        kind = "peaks" if self.mod_type == "det" else "shcoeff"
+        key = hashlib.sha1()
+        key.update(mgu.file_digest(self.dwi).encode())
+        key.update(mgu.file_digest(self.wm_in_dwi).encode())
+        key.update(np.ascontiguousarray(self.gtab.bvals, dtype=np.float64).tobytes())
+        key.update(np.ascontiguousarray(self.gtab.bvecs, dtype=np.float64).tobytes())
+        key.update(repr((kind, self.mod_func, self.gtab.b0_threshold, dipy.__version__)).encode())
+        key.update(repr(sorted(self.model_params.items())).encode())
+        key.update(repr([(sl.start, sl.stop) for sl in self.crop]).encode())
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        return os.path.join(self.cache_dir, "{}_{}_{}.npz".format(self.mod_func, kind, key.hexdigest()))
+
+    @_lazy_property
+    def mask(self):
+        """Binary B0 brain mask, in the cropped grid."""
+        return load_data(self.nodif_B0_mask, crop=self.crop) > 0
+
+    @_lazy_property
+    def gm_mask_data(self):
+        """Gray matter map, in the cropped grid."""
+        return load_data(self.gm_in_dwi, crop=self.crop)
+
+    @_lazy_property
+    def wm_mask_data(self):
+        """White matter map, in the cropped grid."""
+        return load_data(self.wm_in_dwi, crop=self.crop)
+
+    @_lazy_property
+    def wm_in_dwi_data(self):
+        """Binary white matter mask, in the cropped grid."""
+        return self.wm_mask_data > 0
+
+    @_lazy_property
+    def vent_csf_in_dwi_data(self):
+        """Ventricular CSF map, in the cropped grid."""
+        return load_data(self.vent_csf_in_dwi, crop=self.crop)
+
     def prep_tracking(self):
         from dipy.tracking.local import (
             ActTissueClassifier,
@@ -167,23 +908,26 @@ class run_track(object):
         elif self.track_type == "particle":
             tiss_class = "cmc"
 
-        self.dwi_img = nib.load(self.dwi)
-        self.data = self.dwi_img.get_data()
-        # Loads mask and ensures it's a true binary mask
-        self.mask_img = nib.load(self.nodif_B0_mask)
-        self.mask = self.mask_img.get_data() > 0
-        # Load tissue maps and prepare tissue classifier
-        self.gm_mask = nib.load(self.gm_in_dwi)
-        self.gm_mask_data = self.gm_mask.get_data()
-        self.wm_mask = nib.load(self.wm_in_dwi)
-        self.wm_mask_data = self.wm_mask.get_data()
-        self.wm_in_dwi_data = nib.load(self.wm_in_dwi).get_data().astype("bool")
+        self.dwi_img = load_image(self.dwi)
+        # Crop every volume to the bounding box of the brain and tissue masks. Only the cropped block of the DWI is
+        # read, and tracking runs in the cropped grid through an offset affine, so that streamlines come out in the
+        # original coordinates. dipy's per-streamline random seed depends on the voxel coordinates of each seed, which
+        # the crop shifts, so probabilistic streamlines differ from those of an uncropped run with the same seed.
+        brain = (
+            (load_data(self.nodif_B0_mask) > 0) | (load_data(self.wm_in_dwi) > 0) | (load_data(self.gm_in_dwi) > 0)
+        )
+        self.crop = bbox_slices(brain, self.crop_margin)
+        offset = np.eye(4)
+        offset[:3, 3] = [sl.start for sl in self.crop]
+        self.crop_affine = np.dot(self.stream_affine, offset)
+        print("Cropping volumes from {} to {}...".format(
+            brain.shape, tuple(sl.stop - sl.start for sl in self.crop)))
+        self.data = load_data(self.dwi, crop=self.crop)
+        mgu.artifacts.put("dwi_crop", (self.crop, self.data), self.dwi)
         if tiss_class == "act":
-            self.vent_csf_in_dwi = nib.load(self.vent_csf_in_dwi)
-            self.vent_csf_in_dwi_data = self.vent_csf_in_dwi.get_data()
-            self.background = np.ones(self.gm_mask.shape)
+            self.background = np.ones(self.gm_mask_data.shape)
             self.background[(self.gm_mask_data + self.wm_mask_data + self.vent_csf_in_dwi_data) > 0] = 0
-            self.include_map = self.wm_mask_data
+            self.include_map = self.wm_mask_data.copy()
             self.include_map[self.background > 0] = 0
             self.exclude_map = self.vent_csf_in_dwi_data
             self.tiss_classifier = ActTissueClassifier(self.include_map, self.exclude_map)
@@ -191,9 +935,7 @@ class run_track(object):
             self.tiss_classifier = BinaryTissueClassifier(self.wm_in_dwi_data)
             #self.tiss_classifier = BinaryTissueClassifier(self.mask)
         elif tiss_class == "cmc":
-            self.vent_csf_in_dwi = nib.load(self.vent_csf_in_dwi)
-            self.vent_csf_in_dwi_data = self.vent_csf_in_dwi.get_data()
-            voxel_size = np.average(self.wm_mask.get_header()["pixdim"][1:4])
+            voxel_size = np.average(load_image(self.wm_in_dwi).header["pixdim"][1:4])
             step_size = 0.2
             self.tiss_classifier = CmcTissueClassifier.from_pve(
                 self.wm_mask_data,
@@ -212,7 +954,7 @@ class run_track(object):
 
         print("Fitting tensor model...")
         self.model = TensorModel(self.gtab)
-        self.ten = self.model.fit(self.data, self.wm_in_dwi_data)
+        self.ten = fit_model(self.model, self.data, self.wm_in_dwi_data, n_jobs=self.n_jobs)
         self.fa = self.ten.fa
         self.fa[np.isnan(self.fa)] = 0
         self.sphere = get_sphere("repulsion724")
@@ -223,7 +965,7 @@ class run_track(object):
         from dipy.reconst.shm import CsaOdfModel
 
         print("Fitting CSA ODF model...")
-        self.mod = CsaOdfModel(self.gtab, sh_order=6)
+        self.mod = CsaOdfModel(self.gtab, sh_order=self.model_params["sh_order"])
         return self.mod
 
     def csd_mod_est(self):
@@ -235,7 +977,7 @@ class run_track(object):
         print("Fitting CSD model...")
         try:
             print("Attempting to use spherical harmonic basis first...")
-            self.mod = ConstrainedSphericalDeconvModel(self.gtab, None, sh_order=6)
+            self.mod = ConstrainedSphericalDeconvModel(self.gtab, None, sh_order=self.model_params["sh_order"])
         except:
             print("Falling back to estimating recursive response...")
             self.response = recursive_response(
@@ -248,139 +990,169 @@ class run_track(object):
                 init_trace=0.0021,
                 iter=8,
                 convergence=0.001,
-                parallel=False,
+                parallel=self.n_jobs != 1,
+                nbr_processes=self.n_jobs if self.n_jobs > 0 else None,
             )
             print("CSD Reponse: " + str(self.response))
             self.mod = ConstrainedSphericalDeconvModel(self.gtab, self.response)
         return self.mod
 
+    def peaks_est(self):
+        """
+        Extracts peaks from the fitted model, or loads them from the model cache.
+        """
+        from dipy.direction import peaks_from_model
+
+        if self.cache_file is not None and os.path.isfile(self.cache_file):
+            print("Loading cached peaks...")
+            self.mod_peaks = load_peaks(self.cache_file, self.sphere)
+            return self.mod_peaks
+        print("Obtaining peaks from model...")
+        self.mod_peaks = peaks_from_model(
+            self.mod,
+            self.data,
+            self.sphere,
+            relative_peak_threshold=self.model_params["relative_peak_threshold"],
+            min_separation_angle=self.model_params["min_separation_angle"],
+            mask=self.wm_in_dwi_data,
+            npeaks=self.model_params["npeaks"],
+            normalize_peaks=True,
+            parallel=self.n_jobs != 1,
+            nbr_processes=self.n_jobs if self.n_jobs > 0 else None,
+        )
+        if self.cache_file is not None:
+            save_peaks(self.cache_file, self.mod_peaks)
+        return self.mod_peaks
+
+    def prob_direction_getter(self):
+        """
+        Builds a probabilistic direction getter from the spherical harmonic coefficients of the fitted model, which
+        are loaded from the model cache when available. Models without coefficients fall back to their FOD PMF.
+        """
+        from dipy.direction import ProbabilisticDirectionGetter
+
+        if self.cache_file is not None and os.path.isfile(self.cache_file):
+            print("Loading cached spherical harmonic coefficients...")
+            with np.load(self.cache_file) as arrays:
+                shm_coeff = arrays["shm_coeff"]
+            self.pdg = ProbabilisticDirectionGetter.from_shcoeff(
+                shm_coeff, max_angle=60.0, sphere=self.sphere
+            )
+            return self.pdg
+        print("Fitting model to data...")
+        self.mod_fit = fit_model(self.mod, self.data, self.wm_in_dwi_data, n_jobs=self.n_jobs)
+        print("Building direction-getter...")
+        try:
+            print(
+                "Proceeding using spherical harmonic coefficient from model estimation..."
+            )
+            self.pdg = ProbabilisticDirectionGetter.from_shcoeff(
+                self.mod_fit.shm_coeff, max_angle=60.0, sphere=self.sphere
+            )
+        except:
+            print("Proceeding using FOD PMF from model estimation...")
+            self.fod = self.mod_fit.odf(self.sphere)
+            self.pmf = self.fod.clip(min=0)
+            self.pdg = ProbabilisticDirectionGetter.from_pmf(
+                self.pmf, max_angle=60.0, sphere=self.sphere
+            )
+        else:
+            if self.cache_file is not None:
+                _savez_atomic(self.cache_file, shm_coeff=self.mod_fit.shm_coeff)
+        return self.pdg
+
     def local_tracking(self):
         from dipy.tracking.local import LocalTracking
         from dipy.data import get_sphere
-        from dipy.direction import peaks_from_model, ProbabilisticDirectionGetter
 
-        self.sphere = get_sphere("repulsion724")
+        self.sphere = get_sphere(self.model_params["sphere"])
         if self.mod_type == "det":
-            print("Obtaining peaks from model...")
-            self.mod_peaks = peaks_from_model(
-                self.mod,  # AttributeError: 'run_track' object has no attribute 'mod' -- should this be mod_func?
-                self.data,
-                self.sphere,
-                relative_peak_threshold=0.5,
-                min_separation_angle=25,
-                mask=self.wm_in_dwi_data,
-                npeaks=5,
-                normalize_peaks=True,
-            )
-            self.streamline_generator = LocalTracking(
-                self.mod_peaks,
-                self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
-                step_size=0.5,
-                return_all=True,
-            )
+            self.direction_getter = self.peaks_est()
         elif self.mod_type == "prob":
             print("Preparing probabilistic tracking...")
-            print("Fitting model to data...")
-            self.mod_fit = self.mod.fit(self.data, self.wm_in_dwi_data)
-            print("Building direction-getter...")
-            try:
-                print(
-                    "Proceeding using spherical harmonic coefficient from model estimation..."
-                )
-                self.pdg = ProbabilisticDirectionGetter.from_shcoeff(
-                    self.mod_fit.shm_coeff, max_angle=60.0, sphere=self.sphere
-                )
-            except:
-                print("Proceeding using FOD PMF from model estimation...")
-                self.fod = self.mod_fit.odf(self.sphere)
-                self.pmf = self.fod.clip(min=0)
-                self.pdg = ProbabilisticDirectionGetter.from_pmf(
-                    self.pmf, max_angle=60.0, sphere=self.sphere
-                )
-            self.streamline_generator = LocalTracking(
-            self.pdg,
-            self.tiss_classifier,
-            self.seeds,
-            self.stream_affine,
-            step_size=0.5,
-            return_all=True)
-        print("Reconstructing tractogram streamlines...")
-        self.streamlines = Streamlines(self.streamline_generator)
-        return self.streamlines
+            self.direction_getter = self.prob_direction_getter()
+        return self.reconstruct(LocalTracking, step_size=self.step_size, return_all=True)
 
     def particle_tracking(self):
         from dipy.tracking.local import ParticleFilteringTracking
         from dipy.data import get_sphere
-        from dipy.direction import peaks_from_model, ProbabilisticDirectionGetter
 
-        self.sphere = get_sphere("repulsion724")
+        self.sphere = get_sphere(self.model_params["sphere"])
         if self.mod_type == "det":
             maxcrossing = 1
-            print("Obtaining peaks from model...")
-            self.mod_peaks = peaks_from_model(
-                self.mod,
-                self.data,
-                self.sphere,
-                relative_peak_threshold=0.5,
-                min_separation_angle=25,
-                mask=self.wm_in_dwi_data,
-                npeaks=5,
-                normalize_peaks=True,
-            )
-            self.streamline_generator = ParticleFilteringTracking(
-                self.mod_peaks,
-                self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
-                max_cross=maxcrossing,
-                step_size=0.5,
-                maxlen=1000,
-                pft_back_tracking_dist=2,
-                pft_front_tracking_dist=1,
-                particle_count=15,
-                return_all=True,
-            )
+            self.direction_getter = self.peaks_est()
         elif self.mod_type == "prob":
             maxcrossing = 2
             print("Preparing probabilistic tracking...")
-            print("Fitting model to data...")
-            self.mod_fit = self.mod.fit(self.data, self.wm_in_dwi_data)
-            print("Building direction-getter...")
-            try:
-                print(
-                    "Proceeding using spherical harmonic coefficient from model estimation..."
-                )
-                self.pdg = ProbabilisticDirectionGetter.from_shcoeff(
-                    self.mod_fit.shm_coeff, max_angle=60.0, sphere=self.sphere
-                )
-            except:
-                print("Proceeding using FOD PMF from model estimation...")
-                self.fod = self.mod_fit.odf(self.sphere)
-                self.pmf = self.fod.clip(min=0)
-                self.pdg = ProbabilisticDirectionGetter.from_pmf(
-                    self.pmf, max_angle=60.0, sphere=self.sphere
-                )
-            self.streamline_generator = ParticleFilteringTracking(
-                self.pdg,
+            self.direction_getter = self.prob_direction_getter()
+        return self.reconstruct(
+            ParticleFilteringTracking,
+            max_cross=maxcrossing,
+            step_size=self.step_size,
+            maxlen=1000,
+            pft_back_tracking_dist=2,
+            pft_front_tracking_dist=1,
+            particle_count=15,
+            return_all=True,
+        )
+
+    def reconstruct(self, tracker, **kwargs):
+        """
+        Tracks the seeds with `tracker` and the fitted direction getter, either in one generator or, when
+        `n_jobs` is not 1, in seed chunks spread over one pool of worker processes. Seeds may be one array or an
+        iterable of seed batches such as seed_stream, and tracking stops early once `max_streamlines` streamlines are
+        accepted.
+        """
+        import itertools
+
+        print("Reconstructing tractogram streamlines...")
+        sink = self.sink
+        budget = self.max_streamlines
+        batches = [self.seeds] if isinstance(self.seeds, np.ndarray) else self.seeds
+        if self.n_jobs != 1:
+            self.streamlines = parallel_tracking(
+                tracker,
+                self.direction_getter,
                 self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
-                max_cross=maxcrossing,
-                step_size=0.5,
-                maxlen=1000,
-                pft_back_tracking_dist=2,
-                pft_front_tracking_dist=1,
-                particle_count=15,
-                return_all=True,
+                batches,
+                self.crop_affine,
+                n_jobs=self.n_jobs,
+                chunk_size=self.seed_chunk_size,
+                random_seed=self.random_seed,
+                sink=sink,
+                limit=budget,
+                **kwargs
             )
-        print("Reconstructing tractogram streamlines...")
-        self.streamlines = Streamlines(self.streamline_generator)
+            return self.streamlines
+        streamlines = Streamlines() if sink is None else sink
+        for batch in batches:
+            n_accepted = len(streamlines) if sink is None else sink.nb_accepted
+            if budget is not None and n_accepted >= budget:
+                break
+            self.streamline_generator = tracker(
+                self.direction_getter,
+                self.tiss_classifier,
+                batch,
+                self.crop_affine,
+                random_seed=self.random_seed,
+                **kwargs
+            )
+            if sink is not None:
+                sink.write(self.streamline_generator, limit=budget)
+                continue
+            batch_streamlines = self.streamline_generator
+            if budget is not None:
+                batch_streamlines = itertools.islice(batch_streamlines, budget - n_accepted)
+            batch_streamlines = Streamlines(batch_streamlines)
+            if len(streamlines):
+                streamlines.extend(batch_streamlines)
+            else:
+                streamlines = batch_streamlines
+        self.streamlines = streamlines
         return self.streamlines
 
 
-def eudx_basic(dwi_file, gtab, stop_val=0.1):
+def eudx_basic(dwi_file, gtab, stop_val=0.1, n_jobs=1):
     import os
     from dipy.reconst.dti import TensorModel, quantize_evecs
     from dipy.tracking.eudx import EuDX
@@ -401,6 +1173,8 @@ def eudx_basic(dwi_file, gtab, stop_val=0.1):
     **Optional Arguments:**
             stop_val:
                 - Value to cutoff fiber track
+            n_jobs:
+                - Number of worker processes for the tensor fit
     """
 
     img = nib.load(dwi_file)
@@ -427,7 +1201,7 @@ def eudx_basic(dwi_file, gtab, stop_val=0.1):
 
     print("data location: {}".format(dwi_file))
     print("mask location: {}".format(mask_out_file))
-    ten = model.fit(data, mask_data)
+    ten = fit_model(model, data, mask_data, n_jobs=n_jobs)
     sphere = get_sphere("symmetric724")
     ind = quantize_evecs(ten.evecs, sphere.vertices)
     streamlines = EuDX(
@@ -363,3 +363,67 @@ def parcel_overlap(parcellation1, parcellation2, outpath):
             f.write(str(p1reg) + "," + ",".join(datstr) + "\n")
         f.close()
     return
+
+
+def file_digest(path, block_size=2 ** 20):
+    """
+    Returns the sha1 digest of a file's contents, read in blocks.
+    """
+    import hashlib
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class artifact_registry(object):
+    def __init__(self):
+        """
+        An in-process store of intermediate results, such as tensor fits, FA maps, and streamlines, so that later
+        pipeline stages reuse what earlier stages computed instead of reloading or recomputing it. Artifacts are
+        keyed by a kind and the inputs they were derived from. File inputs are identified by path, size, and
+        modification time, so rewriting a file invalidates everything derived from it.
+        """
+        self._artifacts = {}
+
+    def _key(self, kind, inputs):
+        import hashlib
+
+        parts = [kind]
+        for inp in inputs:
+            if isinstance(inp, str) and op.isfile(inp):
+                stat = os.stat(inp)
+                parts.append((op.abspath(inp), stat.st_size, stat.st_mtime))
+            elif isinstance(inp, np.ndarray):
+                parts.append(hashlib.sha1(np.ascontiguousarray(inp).tobytes()).hexdigest())
+            else:
+                parts.append(repr(inp))
+        return tuple(parts)
+
+    def get(self, kind, *inputs):
+        """
+        Returns the artifact of `kind` derived from `inputs`, or None if it has not been registered.
+        """
+        return self._artifacts.get(self._key(kind, inputs))
+
+    def put(self, kind, value, *inputs):
+        """
+        Registers `value` as the artifact of `kind` derived from `inputs`, and returns it.
+        """
+        self._artifacts[self._key(kind, inputs)] = value
+        return value
+
+    def discard(self, kind, *inputs):
+        """
+        Drops the artifact of `kind` derived from `inputs`, if it has been registered.
+        """
+        self._artifacts.pop(self._key(kind, inputs), None)
+
+    def clear(self):
+        self._artifacts.clear()
+
+
+# Artifacts shared by the stages of a pipeline run in this process
+artifacts = artifact_registry()
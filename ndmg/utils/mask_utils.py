@@ -0,0 +1,106 @@
+# Copyright 2019 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# mask_utils.py
+# In-memory equivalents of the fslmaths operations used to build tissue masks, so that a chain of thresholds,
+# erosions and mask arithmetic reads each input once and writes only its final masks.
+
+import warnings
+
+warnings.simplefilter("ignore")
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+
+class mask_images(object):
+    def __init__(self):
+        """
+        Loads tissue maps once and keeps them in memory for a chain of mask operations. Maps are returned as float32
+        arrays, and the header of the first map loaded is used as the reference for the masks that are saved.
+        """
+        self._images = {}
+        self.ref = None
+
+    def __getitem__(self, path):
+        if path not in self._images:
+            img = nib.load(path)
+            self._images[path] = np.asarray(img.get_data(), dtype=np.float32)
+            if self.ref is None:
+                self.ref = img
+        return self._images[path]
+
+    def zooms(self):
+        """
+        Voxel sizes, in mm, of the reference map.
+        """
+        return self.ref.header.get_zooms()[:3]
+
+    def save(self, data, out, dtype=np.uint8):
+        """
+        Saves a mask or map in the grid of the reference map.
+        """
+        img = nib.Nifti1Image(np.asarray(data, dtype=dtype), affine=self.ref.affine, header=self.ref.header)
+        img.set_data_dtype(dtype)
+        nib.save(img, out)
+        return out
+
+
+def threshold(data, thr):
+    """
+    Zeroes values below `thr`, as fslmaths -thr.
+    """
+    return np.where(data >= thr, data, 0)
+
+
+def binarize(data):
+    """
+    Returns where `data` is positive, as fslmaths -bin.
+    """
+    return data > 0
+
+
+def sphere_kernel(radius, zooms):
+    """
+    Returns a boolean structuring element of the voxels within `radius` mm of the center, as fslmaths -kernel sphere.
+    """
+    half = [int(np.floor(radius / float(zoom))) for zoom in zooms]
+    grid = np.meshgrid(*[np.arange(-h, h + 1) * zoom for h, zoom in zip(half, zooms)], indexing="ij")
+    return sum(axis ** 2 for axis in grid) <= radius ** 2
+
+
+def erode(mask, radius, zooms):
+    """
+    Erodes a mask with a sphere of `radius` mm, as fslmaths -kernel sphere <radius> -ero. Voxels outside the image do
+    not erode the mask.
+    """
+    return ndimage.binary_erosion(mask, structure=sphere_kernel(radius, zooms), border_value=1)
+
+
+def edge(mask):
+    """
+    Returns the voxels where the central-difference gradient of a mask is nonzero, as fslmaths -edge -bin.
+    """
+    grads = np.gradient(np.asarray(mask, dtype=np.float32))
+    return sum(grad ** 2 for grad in grads) > 0
+
+
+def interface(gm, wm, cc, vent_csf, mask):
+    """
+    Returns the gray/white matter interface used to seed tracking, plus the corpus callosum and minus ventricular CSF,
+    within `mask`, as fslmaths gm -mul wm -add cc -sub vent_csf -mas mask -bin.
+    """
+    total = binarize(gm).astype(np.int8) * binarize(wm) + binarize(cc) - binarize(vent_csf)
+    return binarize(total) & binarize(mask)
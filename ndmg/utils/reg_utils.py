@@ -25,6 +25,221 @@ import numpy as np
 import nilearn.image as nl
 import os
 import os.path as op
+import threading
+
+
+# Per-thread state. `recording` holds the commands of the job being recorded by job_runner.add in that thread, and is
+# unset when commands run immediately, so that wrappers called from other threads are never captured.
+_local = threading.local()
+
+# Registration backend of align and applyxfm: "fsl" runs flirt, "dipy" registers in-process (see set_backend)
+_backend = "fsl"
+
+# Named registration profiles, trading accuracy for throughput. "standard" is the set of parameters ndmg has always
+# used. searchrange, bins, coarsesearch and finesearch are passed to flirt (None keeps flirt's default), warpres to
+# fnirt, and the remaining entries set the mutual information metric, Gaussian pyramid and iterations per pyramid level
+# of dipy_align and wm_syn.
+profiles = {
+    "fast": {
+        "searchrange": 90,
+        "bins": 64,
+        "coarsesearch": None,
+        "finesearch": None,
+        "warpres": "10,10,10",
+        "mi_bins": 32,
+        "mi_sampling": 0.25,
+        "factors": (4, 2),
+        "sigmas": (3.0, 1.0),
+        "align_iters": (250, 50),
+        "rigid_iters": (10, 10),
+        "affine_iters": (250, 250),
+        "syn_iters": (10, 5),
+        "syn_qa": False,
+    },
+    "standard": {
+        "searchrange": 180,
+        "bins": None,
+        "coarsesearch": None,
+        "finesearch": None,
+        "warpres": "8,8,8",
+        "mi_bins": 32,
+        "mi_sampling": None,
+        "factors": (4, 2, 1),
+        "sigmas": (3.0, 1.0, 0.0),
+        "align_iters": (1000, 100, 10),
+        "rigid_iters": (10, 10, 5),
+        "affine_iters": (1000, 1000, 100),
+        "syn_iters": (10, 10, 5),
+        "syn_qa": True,
+    },
+    "accurate": {
+        "searchrange": 180,
+        "bins": 256,
+        "coarsesearch": 30,
+        "finesearch": 9,
+        "warpres": "6,6,6",
+        "mi_bins": 64,
+        "mi_sampling": None,
+        "factors": (4, 2, 1),
+        "sigmas": (3.0, 1.0, 0.0),
+        "align_iters": (10000, 1000, 100),
+        "rigid_iters": (100, 100, 10),
+        "affine_iters": (10000, 1000, 100),
+        "syn_iters": (20, 20, 10),
+        "syn_qa": True,
+    },
+}
+
+# Registration profile of every registration call (see set_profile)
+_profile = "standard"
+
+
+def _system(cmd):
+    """
+    Runs a shell command, or records it when a job_runner is collecting the commands of a job.
+    """
+    recording = getattr(_local, "recording", None)
+    if recording is not None:
+        recording.append(cmd)
+        return 0
+    return os.system(cmd)
+
+
+def _call(func, *args, **kwargs):
+    """
+    Runs an in-process step, or records it when a job_runner is collecting the steps of a job.
+    """
+    import functools
+
+    recording = getattr(_local, "recording", None)
+    if recording is not None:
+        recording.append(functools.partial(func, *args, **kwargs))
+        return 0
+    return func(*args, **kwargs)
+
+
+def _run_steps(steps):
+    """
+    Runs the recorded steps of a job in this process, stopping at the first failure. Returns a return code.
+    """
+    for step in steps:
+        if callable(step):
+            try:
+                step()
+            except Exception as e:
+                print("Error: {}".format(e))
+                return 1
+        else:
+            code = os.system(step)
+            if code:
+                return code
+    return 0
+
+
+class job_runner(object):
+    def __init__(self, n_jobs=1):
+        """
+        A small dependency-aware runner for the FSL commands issued by reg_utils. Jobs are added with the reg_utils
+        function that would run them (or a shell command) and the names of the jobs they depend on, and run() then
+        launches every job whose dependencies have finished, up to `n_jobs` at a time. FSL tools are single-threaded,
+        so independent flirt/applywarp/fslmaths calls scale with the number of cores. Jobs that use the in-process
+        registration backend run in worker threads of this process, alongside the subprocesses and within the same
+        `n_jobs` limit.
+
+        **Positional Arguments:**
+
+            n_jobs:
+                - the maximum number of commands running at once. Values below 1 use every available core.
+        """
+        import multiprocessing
+
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = multiprocessing.cpu_count()
+        self.n_jobs = n_jobs
+        self.jobs = []
+        self.results = {}
+
+    def add(self, name, func, *args, **kwargs):
+        """
+        Adds a job. `func` is either a shell command, or a reg_utils function called with `args` and `kwargs`, whose
+        commands are recorded rather than run. Pass `after` with the names of the jobs this one depends on.
+        """
+        after = tuple(kwargs.pop("after", ()))
+        missing = set(after) - set(job[0] for job in self.jobs)
+        if missing:
+            raise ValueError("Jobs must be added after the jobs they depend on: {}".format(sorted(missing)))
+        if isinstance(func, str):
+            cmds = [func]
+        else:
+            _local.recording = []
+            try:
+                func(*args, **kwargs)
+                cmds = _local.recording
+            finally:
+                _local.recording = None
+        self.jobs.append((name, cmds, after))
+        return name
+
+    def run(self):
+        """
+        Runs the jobs, and returns a dict mapping each job name to its return code and runtime in seconds. Jobs
+        whose dependencies failed are skipped, with a return code of None.
+        """
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        pending = list(self.jobs)
+        running = {}
+        start_time = time.time()
+        executor = ThreadPoolExecutor(self.n_jobs)
+        try:
+            self._schedule(pending, running, executor)
+        finally:
+            executor.shutdown()
+
+        for name, result in self.results.items():
+            if result["returncode"]:
+                print("Warning: {} exited with code {}".format(name, result["returncode"]))
+        print(
+            "%s%s%s"
+            % ("Registration jobs runtime: ", str(np.round(time.time() - start_time, 1)), "s")
+        )
+        return self.results
+
+    def _schedule(self, pending, running, executor):
+        """
+        Launches pending jobs as their dependencies finish, as subprocesses or, for jobs with in-process steps, on
+        `executor`, until every job has a result.
+        """
+        import subprocess
+        import time
+
+        while pending or running:
+            for name, (job, started) in list(running.items()):
+                if isinstance(job, subprocess.Popen):
+                    returncode = job.poll()
+                else:
+                    returncode = job.result() if job.done() else None
+                if returncode is not None:
+                    self.results[name] = dict(returncode=returncode, runtime=time.time() - started)
+                    del running[name]
+            for job in list(pending):
+                if len(running) >= self.n_jobs:
+                    break
+                name, cmds, after = job
+                if any(dep not in self.results for dep in after):
+                    continue
+                pending.remove(job)
+                if any(self.results[dep]["returncode"] != 0 for dep in after):
+                    print("Skipping {}: a job it depends on failed".format(name))
+                    self.results[name] = dict(returncode=None, runtime=0.0)
+                    continue
+                if any(callable(cmd) for cmd in cmds):
+                    running[name] = (executor.submit(_run_steps, cmds), time.time())
+                else:
+                    running[name] = (subprocess.Popen(" && ".join(cmds) or "true", shell=True), time.time())
+            if running:
+                time.sleep(0.05)
 
 
 def erode_mask(mask, v=0):
@@ -157,7 +372,7 @@ def extract_brain(inp, out, opts=""):
     """
     print("extracting brain")
     cmd = "bet {} {} {}".format(inp, out, opts)
-    os.system(cmd)
+    _system(cmd)
 
 
 def apply_mask(inp, mask, out):
@@ -318,7 +533,7 @@ def extract_brain(inp, out, opts="-B"):
             - the output brain extracted image.
     """
     cmd = "bet {} {} {}".format(inp, out, opts)
-    os.system(cmd)
+    _system(cmd)
     pass
 
 
@@ -353,7 +568,7 @@ def segment_t1w(t1w, basename, opts=""):
     # segment into CSF (pve_0), WM (pve_1), GM (pve_2)
     cmd = "fast -t 1 {} -n 3 -o {} {}".format(opts, basename, t1w)
     print("Executing fast: {}".format(cmd))
-    os.system(cmd)
+    _system(cmd)
     out = {}  # the outputs
     out["wm_prob"] = "{}_{}".format(basename, "pve_2.nii.gz")
     out["gm_prob"] = "{}_{}".format(basename, "pve_1.nii.gz")
@@ -368,7 +583,7 @@ def align(
     out=None,
     dof=12,
     searchrad=True,
-    bins=256,
+    bins=None,
     interp=None,
     cost="mutualinfo",
     sch=None,
@@ -391,8 +606,11 @@ def align(
             dof:
                 - the number of degrees of freedom of the alignment.
             searchrad:
-                - a bool indicating whether to use the predefined
-                searchradius parameter (180 degree sweep in x, y, and z).
+                - a bool indicating whether to sweep rotations in x, y, and z
+                over the search range of the registration profile.
+            bins:
+                - the number of cost-function histogram bins, or None to use
+                the registration profile's.
             interp:
                 - the interpolation method to use.
             sch:
@@ -401,7 +619,16 @@ def align(
                 - an optional white-matter segmentation for bbr.
             init:
                 - an initial guess of an alignment.
+            finesearch:
+                - the angle, in degrees, of the fine rotation search, or None
+                to use the registration profile's.
+
+    With the "dipy" backend (see set_backend), mutual information registrations without a schedule or bbr run
+    in-process through dipy_align.
     """
+    if _backend == "dipy" and cost == "mutualinfo" and sch is None and wmseg is None:
+        _call(dipy_align, inp, ref, xfm=xfm, out=out, dof=dof, interp=interp, init=init)
+        return
     cmd = "flirt -in {} -ref {}".format(inp, ref)
     if xfm is not None:
         cmd += " -omat {}".format(xfm)
@@ -409,6 +636,9 @@ def align(
         cmd += " -out {}".format(out)
     if dof is not None:
         cmd += " -dof {}".format(dof)
+    params = profiles[_profile]
+    bins = params["bins"] if bins is None else bins
+    finesearch = params["finesearch"] if finesearch is None else finesearch
     if bins is not None:
         cmd += " -bins {}".format(bins)
     if interp is not None:
@@ -416,7 +646,11 @@ def align(
     if cost is not None:
         cmd += " -cost {}".format(cost)
     if searchrad is not None:
-        cmd += " -searchrx -180 180 -searchry -180 180 " + "-searchrz -180 180"
+        cmd += " -searchrx -{0} {0} -searchry -{0} {0} -searchrz -{0} {0}".format(params["searchrange"])
+        if params["coarsesearch"] is not None:
+            cmd += " -coarsesearch {}".format(params["coarsesearch"])
+        if finesearch is not None:
+            cmd += " -finesearch {}".format(finesearch)
     if sch is not None:
         cmd += " -schedule {}".format(sch)
     if wmseg is not None:
@@ -424,7 +658,7 @@ def align(
     if init is not None:
         cmd += " -init {}".format(init)
     print(cmd)
-    os.system(cmd)
+    _system(cmd)
 
 
 def align_epi(epi, t1, brain, out):
@@ -433,7 +667,7 @@ def align_epi(epi, t1, brain, out):
     """
     cmd = "epi_reg --epi={} --t1={} --t1brain={} --out={}"
     cmd = cmd.format(epi, t1, brain, out)
-    os.system(cmd)
+    _system(cmd)
 
 
 def align_nonlinear(inp, ref, xfm, out, warp, ref_mask=None, in_mask=None, config=None):
@@ -454,9 +688,11 @@ def align_nonlinear(inp, ref, xfm, out, warp, ref_mask=None, in_mask=None, confi
         mask:
             - a mask in which voxels will be extracted
             during nonlinear alignment.
+
+    The warp resolution is set by the registration profile.
     """
-    cmd = "fnirt --in={} --ref={} --aff={} --iout={} --cout={} --warpres=8,8,8"
-    cmd = cmd.format(inp, ref, xfm, out, warp, config)
+    cmd = "fnirt --in={} --ref={} --aff={} --iout={} --cout={} --warpres={}"
+    cmd = cmd.format(inp, ref, xfm, out, warp, profiles[_profile]["warpres"])
     if ref_mask is not None:
         cmd += " --refmask={} --applyrefmask=1".format(ref_mask)
     if in_mask is not None:
@@ -464,7 +700,7 @@ def align_nonlinear(inp, ref, xfm, out, warp, ref_mask=None, in_mask=None, confi
     if config is not None:
         cmd += " --config={}".format(config)
     print(cmd)
-    os.system(cmd)
+    _system(cmd)
 
 
 def applyxfm(ref, inp, xfm, aligned, interp="trilinear", dof=6):
@@ -481,11 +717,16 @@ def applyxfm(ref, inp, xfm, aligned, interp="trilinear", dof=6):
                 - Transform between two images
             aligned:
                 - Aligned output image as a nifti image file
+
+    With the "dipy" backend (see set_backend), the transform is applied in-process through dipy_applyxfm.
     """
+    if _backend == "dipy":
+        _call(dipy_applyxfm, ref, inp, xfm, aligned, interp=interp)
+        return
     cmd = "flirt -in {} -ref {} -out {} -init {} -interp {} -dof {} -applyxfm"
     cmd = cmd.format(inp, ref, aligned, xfm, interp, dof)
     print(cmd)
-    os.system(cmd)
+    _system(cmd)
 
 
 def apply_warp(ref, inp, out, warp, xfm=None, mask=None, interp=None, sup=False):
@@ -520,7 +761,7 @@ def apply_warp(ref, inp, out, warp, xfm=None, mask=None, interp=None, sup=False)
     if sup is True:
         cmd += " --super --superlevel=a"
     print(cmd)
-    os.system(cmd)
+    _system(cmd)
 
 
 def inverse_warp(ref, out, warp):
@@ -545,7 +786,7 @@ def inverse_warp(ref, out, warp):
     """
     cmd = "invwarp --warp=" + warp + " --out=" + out + " --ref=" + ref
     print(cmd)
-    os.system(cmd)
+    _system(cmd)
 
 
 def resample(base, ingested, template):
@@ -590,7 +831,294 @@ def combine_xfms(xfm1, xfm2, xfmout):
     """
     cmd = "convert_xfm -omat {} -concat {} {}".format(xfmout, xfm1, xfm2)
     print(cmd)
-    os.system(cmd)
+    _system(cmd)
+
+
+def set_backend(backend):
+    """
+    Selects how align and applyxfm register and resample images for the rest of this process.
+
+    **Positional Arguments:**
+
+        backend:
+            - "fsl" to run flirt subprocesses, or "dipy" to run mutual information registration in-process with
+            dipy's AffineRegistration.
+    """
+    global _backend
+
+    if backend not in ("fsl", "dipy"):
+        raise ValueError("Unknown registration backend: {}".format(backend))
+    _backend = backend
+
+
+def get_backend():
+    return _backend
+
+
+def set_profile(profile):
+    """
+    Selects the registration profile of every registration call for the rest of this process.
+
+    **Positional Arguments:**
+
+        profile:
+            - the name of a profile in `profiles`: "fast", "standard" or "accurate".
+    """
+    global _profile
+
+    if profile not in profiles:
+        raise ValueError("Unknown registration profile: {}".format(profile))
+    _profile = profile
+
+
+def get_profile():
+    return _profile
+
+
+def save_profile(out):
+    """
+    Records the registration profile, its parameters and the registration backend in a JSON file.
+    """
+    import json
+
+    with open(out, "w") as f:
+        json.dump(dict(profile=_profile, backend=_backend, parameters=profiles[_profile]), f, indent=2, sort_keys=True)
+    return out
+
+
+def _load_image(img):
+    """
+    Returns a nibabel image for a path or image, reusing an image already registered in mgu.artifacts.
+    """
+    if not isinstance(img, str):
+        return img
+    loaded = mgu.artifacts.get("image", img)
+    return loaded if loaded is not None else nib.load(img)
+
+
+def fsl_scaled_voxel(img):
+    """
+    Returns the matrix from voxel indices to FSL's scaled-voxel coordinates: voxel indices times voxel sizes, with
+    the x axis flipped for images stored in neurological orientation.
+    """
+    zooms = img.header.get_zooms()[:3]
+    scaled = np.diag(list(zooms) + [1.0])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = img.shape[0] - 1
+        scaled = scaled.dot(flip)
+    return scaled
+
+
+def dipy2fsl(affine, inp_img, ref_img):
+    """
+    Converts a dipy AffineMap matrix, which maps reference world coordinates to input world coordinates, into the
+    FLIRT matrix that maps input scaled-voxel coordinates to reference scaled-voxel coordinates.
+    """
+    inp_to_world = inp_img.affine.dot(np.linalg.inv(fsl_scaled_voxel(inp_img)))
+    world_to_ref = fsl_scaled_voxel(ref_img).dot(np.linalg.inv(ref_img.affine))
+    return world_to_ref.dot(np.linalg.inv(affine)).dot(inp_to_world)
+
+
+def fsl2dipy(xfm, inp_img, ref_img):
+    """
+    Converts a FLIRT matrix into the dipy AffineMap matrix between the same two images. The inverse of dipy2fsl.
+    """
+    ref_to_world = ref_img.affine.dot(np.linalg.inv(fsl_scaled_voxel(ref_img)))
+    world_to_inp = fsl_scaled_voxel(inp_img).dot(np.linalg.inv(inp_img.affine))
+    return np.linalg.inv(ref_to_world.dot(xfm).dot(world_to_inp))
+
+
+def _resample(affine_map, inp_img, interp):
+    """
+    Resamples a 3D or 4D image through a dipy AffineMap, volume by volume.
+    """
+    interpolation = "nearest" if interp in ("nearestneighbour", "nn") else "linear"
+    data = np.asanyarray(inp_img.dataobj)
+    if interpolation == "linear":
+        data = data.astype(np.float32)
+    if data.ndim == 3:
+        return affine_map.transform(data, interpolation=interpolation).astype(data.dtype)
+    return np.stack(
+        [affine_map.transform(data[..., idx], interpolation=interpolation) for idx in range(data.shape[-1])], axis=-1
+    ).astype(data.dtype)
+
+
+def _save_resampled(data, ref_img, out):
+    img = nib.Nifti1Image(data, ref_img.affine, ref_img.header)
+    img.set_data_dtype(data.dtype)
+    nib.save(img, out)
+
+
+def dipy_align(inp, ref, xfm=None, out=None, dof=12, interp=None, init=None):
+    """
+    Aligns two images in-process with dipy's mutual information AffineRegistration, as a replacement for
+    align(). Registration starts from `init` if given, and otherwise from the alignment of the centers of mass, then
+    runs translation, rigid and, for 12 degrees of freedom, affine stages. Unlike flirt -searchr, there is no global
+    rotation search, so inputs must start within a moderate rotation of each other.
+
+    **Positional Arguments:**
+
+        inp:
+            - the input image, as a path or nibabel image.
+        ref:
+            - the reference image, as a path or nibabel image.
+        xfm:
+            - the path to store the transform, as a FLIRT matrix.
+        out:
+            - the path to store the input resampled onto the reference grid.
+        dof:
+            - 6 (rigid) or 12 (affine) degrees of freedom.
+        interp:
+            - the interpolation of `out`, nearestneighbour or linear.
+        init:
+            - an initial FLIRT matrix, as a path or 4x4 array.
+
+    The metric, pyramid and iterations of each stage are set by the registration profile. Returns the FLIRT matrix.
+    """
+    from dipy.align.imaffine import MutualInformationMetric, AffineRegistration, transform_centers_of_mass, AffineMap
+    from dipy.align.transforms import TranslationTransform3D, RigidTransform3D, AffineTransform3D
+
+    if dof not in (6, 12):
+        raise ValueError("The dipy backend supports 6 or 12 degrees of freedom, not {}".format(dof))
+    inp_img = _load_image(inp)
+    ref_img = _load_image(ref)
+    static = np.asanyarray(ref_img.dataobj).astype(np.float32)
+    moving = np.asanyarray(inp_img.dataobj).astype(np.float32)
+    if moving.ndim == 4:
+        moving = moving[..., 0]
+
+    if init is not None:
+        init = np.loadtxt(init) if isinstance(init, str) else init
+        starting_affine = fsl2dipy(init, inp_img, ref_img)
+    else:
+        starting_affine = transform_centers_of_mass(static, ref_img.affine, moving, inp_img.affine).affine
+
+    params = profiles[_profile]
+    affine_reg = AffineRegistration(metric=MutualInformationMetric(params["mi_bins"], params["mi_sampling"]),
+                                    level_iters=list(params["align_iters"]), sigmas=list(params["sigmas"]),
+                                    factors=list(params["factors"]))
+    transforms = [TranslationTransform3D(), RigidTransform3D()]
+    if dof == 12:
+        transforms.append(AffineTransform3D())
+    for transform in transforms:
+        starting_affine = affine_reg.optimize(static, moving, transform, None, ref_img.affine, inp_img.affine,
+                                              starting_affine=starting_affine).affine
+
+    fsl_xfm = dipy2fsl(starting_affine, inp_img, ref_img)
+    if xfm is not None:
+        np.savetxt(xfm, fsl_xfm, fmt="%.10f")
+    if out is not None:
+        affine_map = AffineMap(starting_affine, static.shape, ref_img.affine, moving.shape, inp_img.affine)
+        _save_resampled(_resample(affine_map, inp_img, interp), ref_img, out)
+    return fsl_xfm
+
+
+def dipy_applyxfm(ref, inp, xfm, aligned, interp="trilinear"):
+    """
+    Resamples an image onto a reference grid through a FLIRT matrix, in-process, as a replacement for applyxfm().
+    """
+    from dipy.align.imaffine import AffineMap
+
+    inp_img = _load_image(inp)
+    ref_img = _load_image(ref)
+    xfm = np.loadtxt(xfm) if isinstance(xfm, str) else xfm
+    affine_map = AffineMap(
+        fsl2dipy(xfm, inp_img, ref_img), ref_img.shape[:3], ref_img.affine, inp_img.shape[:3], inp_img.affine
+    )
+    _save_resampled(_resample(affine_map, inp_img, interp), ref_img, aligned)
+    return aligned
+
+
+class transform_chain(object):
+    def __init__(self):
+        """
+        A chain of FSL transforms from a source image to a target grid. Affine (.mat) and warp steps are collected
+        symbolically, in the order they map the source, and apply() composes them into a single applywarp call, so
+        the source is interpolated exactly once and no intermediate images are written. Consecutive affines are
+        concatenated with convert_xfm into the --premat or --postmat of the warp.
+
+        Example:
+            transform_chain().affine(atlas2mni).warp(mni2t1w).affine(t1w2dwi).apply(atlas, b0, out, interp="nn")
+        """
+        self.steps = []
+
+    def affine(self, xfm):
+        """
+        Appends an FSL affine matrix file.
+        """
+        self.steps.append(("affine", xfm))
+        return self
+
+    def warp(self, warp):
+        """
+        Appends an FSL warp field. A chain holds at most one warp.
+        """
+        if any(kind == "warp" for kind, _ in self.steps):
+            raise ValueError("A transform chain can hold at most one warp.")
+        self.steps.append(("warp", warp))
+        return self
+
+    def _concat(self, xfms, out):
+        """
+        Concatenates affines in the order they are applied, returning the single matrix that applies them all.
+        """
+        if len(xfms) == 1:
+            return xfms[0]
+        combined = xfms[0]
+        for idx, xfm in enumerate(xfms[1:]):
+            step_out = out if idx == len(xfms) - 2 else "{}_{}.mat".format(out[:-len(".mat")], idx)
+            cmd = "convert_xfm -omat {} -concat {} {}".format(step_out, xfm, combined)
+            print(cmd)
+            _system(cmd)
+            combined = step_out
+        return combined
+
+    def apply(self, inp, ref, out, interp="nn", sup=False, tmp_dir=None):
+        """
+        Resamples `inp` onto the grid of `ref` through every transform of the chain, in one interpolation.
+
+        **Positional Arguments:**
+
+            inp:
+                - the source image.
+            ref:
+                - the image whose grid the output is resampled to.
+            out:
+                - the output image.
+            interp:
+                - applywarp interpolation: nn, trilinear, sinc or spline.
+            sup:
+                - whether to supersample intermediate grids, as applywarp --super.
+            tmp_dir:
+                - the directory of the concatenated matrices, so they stay out of the output tree. None uses a new
+                temporary directory.
+        """
+        import tempfile
+
+        kinds = [kind for kind, _ in self.steps]
+        split = kinds.index("warp") if "warp" in kinds else len(kinds)
+        pre = [xfm for _, xfm in self.steps[:split]]
+        post = [xfm for _, xfm in self.steps[split + 1:]]
+        if tmp_dir is None and (len(pre) > 1 or len(post) > 1):
+            tmp_dir = tempfile.mkdtemp()
+        base = op.join(tmp_dir or "", op.basename(out).split(".nii")[0])
+
+        cmd = "applywarp --ref={} --in={} --out={}".format(ref, inp, out)
+        if pre:
+            cmd += " --premat={}".format(self._concat(pre, base + "_premat.mat"))
+        if split < len(kinds):
+            cmd += " --warp={}".format(self.steps[split][1])
+        if post:
+            cmd += " --postmat={}".format(self._concat(post, base + "_postmat.mat"))
+        if interp is not None:
+            cmd += " --interp={}".format(interp)
+        if sup is True:
+            cmd += " --super --superlevel=a"
+        print(cmd)
+        _system(cmd)
+        return out
 
 
 def reslice_to_xmm(infile, vox_sz=2):
@@ -604,13 +1132,126 @@ def reslice_to_xmm(infile, vox_sz=2):
         "mm.nii.gz",
     )
     cmd = cmd.format(infile, infile, out_file, vox_sz)
-    os.system(cmd)
+    _system(cmd)
     return out_file
 
 
-def wm_syn(template_path, fa_path, working_dir):
+class syn_template(object):
+    def __init__(self, template_path, nbins=32, sampling_prop=None):
+        """
+        The template side of wm_syn, loaded once and shared by every subject registered to it in this process. The
+        template data, its affine and the affine-stage metric are only built when the context is created, so batch
+        runs do not reload and reconvert the compressed template for each subject. Get instances with
+        get_syn_template, which caches one per template and setting.
+
+        Parameters
+        ----------
+            template_path : str
+                File path to the template reference image.
+            nbins : int
+                Number of histogram bins of the mutual information metric.
+            sampling_prop : float
+                Proportion of voxels, in (0, 1], sampled by the mutual information metric in the affine stages. None
+                uses every voxel, which is slower but deterministic.
+        """
+        from dipy.align.imaffine import MutualInformationMetric
+
+        template_img = nib.load(template_path)
+        self.template_path = template_path
+        self.static = np.asanyarray(template_img.get_data())
+        self.static_affine = template_img.affine
+        self.sampling_prop = sampling_prop
+        self.metric = MutualInformationMetric(nbins, sampling_prop)
+
+    def register(self, fa_path, working_dir, profile=None):
+        """
+        Registers an FA image to the template with translation, rigid and affine stages followed by SyN.
+
+        Parameters
+        ----------
+            fa_path : str
+                File path to the FA moving image.
+            working_dir : str
+                Path to the working directory to save QA images in.
+            profile : str
+                Registration profile that sets the pyramid, the iterations of each stage and whether sagittal,
+                coronal and axial overlays of the warped FA on the template are rendered. None uses the current
+                profile.
+        """
+        from dipy.align.imaffine import AffineRegistration, transform_origins
+        from dipy.align.transforms import TranslationTransform3D, RigidTransform3D, AffineTransform3D
+        from dipy.align.imwarp import SymmetricDiffeomorphicRegistration
+        from dipy.align.metrics import CCMetric
+
+        fa_img = nib.load(fa_path)
+        static = self.static
+        static_affine = self.static_affine
+        moving = fa_img.get_data().astype(np.float32)
+        moving_affine = fa_img.affine
+
+        affine_map = transform_origins(static, static_affine, moving, moving_affine)
+
+        params = profiles[profile or _profile]
+        affine_reg = AffineRegistration(metric=self.metric, level_iters=list(params["rigid_iters"]),
+                                        sigmas=list(params["sigmas"]), factors=list(params["factors"]))
+        transform = TranslationTransform3D()
+
+        params0 = None
+        translation = affine_reg.optimize(static, moving, transform, params0,
+                                          static_affine, moving_affine)
+        transform = RigidTransform3D()
+
+        rigid_map = affine_reg.optimize(static, moving, transform, params0,
+                                        static_affine, moving_affine,
+                                        starting_affine=translation.affine)
+        transform = AffineTransform3D()
+
+        # We bump up the iterations to get a more exact fit:
+        affine_reg.level_iters = list(params["affine_iters"])
+        affine_opt = affine_reg.optimize(static, moving, transform, params0,
+                                         static_affine, moving_affine,
+                                         starting_affine=rigid_map.affine)
+
+        # We now perform the non-rigid deformation using the Symmetric Diffeomorphic Registration(SyN) Algorithm:
+        metric = CCMetric(3)
+        sdr = SymmetricDiffeomorphicRegistration(metric, list(params["syn_iters"]))
+
+        mapping = sdr.optimize(static, moving, static_affine, moving_affine,
+                               affine_opt.affine)
+
+        if params["syn_qa"]:
+            from dipy.viz import regtools
+
+            # We show the registration result with:
+            warped_moving = mapping.transform(moving)
+            regtools.overlay_slices(static, warped_moving, None, 0, "Static", "Moving",
+                                    "%s%s" % (working_dir, "/transformed_sagittal.png"))
+            regtools.overlay_slices(static, warped_moving, None, 1, "Static", "Moving",
+                                    "%s%s" % (working_dir, "/transformed_coronal.png"))
+            regtools.overlay_slices(static, warped_moving, None, 2, "Static", "Moving",
+                                    "%s%s" % (working_dir, "/transformed_axial.png"))
+
+        return mapping, affine_map
+
+
+# Per-process syn_template contexts, keyed by template path and metric settings
+_syn_templates = {}
+
+
+def get_syn_template(template_path, nbins=32, sampling_prop=None):
+    """
+    Returns the syn_template for a template and metric setting, creating it on first use in this process.
+    """
+    key = (op.abspath(template_path), os.path.getmtime(template_path), nbins, sampling_prop)
+    if key not in _syn_templates:
+        print("Loading SyN template {}...".format(template_path))
+        _syn_templates[key] = syn_template(template_path, nbins=nbins, sampling_prop=sampling_prop)
+    return _syn_templates[key]
+
+
+def wm_syn(template_path, fa_path, working_dir, profile=None):
     """
-    A function to perform ANTS SyN registration
+    A function to perform ANTS SyN registration. The template is loaded once per process and reused across calls.
 
     Parameters
     ----------
@@ -620,68 +1261,13 @@ def wm_syn(template_path, fa_path, working_dir):
             File path to the FA moving image.
         working_dir : str
             Path to the working directory to perform SyN and save outputs.
+        profile : str
+            Registration profile that sets the mutual information metric, pyramid and iterations, and whether overlay
+            PNGs of the registration result are saved in `working_dir`. None uses the current profile.
     """
-    from dipy.align.imaffine import MutualInformationMetric, AffineRegistration, transform_origins
-    from dipy.align.transforms import TranslationTransform3D, RigidTransform3D, AffineTransform3D
-    from dipy.align.imwarp import SymmetricDiffeomorphicRegistration
-    from dipy.align.metrics import CCMetric
-    from dipy.viz import regtools
-
-    fa_img = nib.load(fa_path)
-    template_img = nib.load(template_path)
-
-    static = template_img.get_data()
-    static_affine = template_img.affine
-    moving = fa_img.get_data().astype(np.float32)
-    moving_affine = fa_img.affine
-
-    affine_map = transform_origins(static, static_affine, moving, moving_affine)
-
-    nbins = 32
-    sampling_prop = None
-    metric = MutualInformationMetric(nbins, sampling_prop)
-
-    level_iters = [10, 10, 5]
-    sigmas = [3.0, 1.0, 0.0]
-    factors = [4, 2, 1]
-    affine_reg = AffineRegistration(metric=metric, level_iters=level_iters,
-                                    sigmas=sigmas, factors=factors)
-    transform = TranslationTransform3D()
-
-    params0 = None
-    translation = affine_reg.optimize(static, moving, transform, params0,
-                                      static_affine, moving_affine)
-    transform = RigidTransform3D()
-
-    rigid_map = affine_reg.optimize(static, moving, transform, params0,
-                                    static_affine, moving_affine,
-                                    starting_affine=translation.affine)
-    transform = AffineTransform3D()
-
-    # We bump up the iterations to get a more exact fit:
-    affine_reg.level_iters = [1000, 1000, 100]
-    affine_opt = affine_reg.optimize(static, moving, transform, params0,
-                                     static_affine, moving_affine,
-                                     starting_affine=rigid_map.affine)
-
-    # We now perform the non-rigid deformation using the Symmetric Diffeomorphic Registration(SyN) Algorithm:
-    metric = CCMetric(3)
-    level_iters = [10, 10, 5]
-    sdr = SymmetricDiffeomorphicRegistration(metric, level_iters)
-
-    mapping = sdr.optimize(static, moving, static_affine, moving_affine,
-                           affine_opt.affine)
-    warped_moving = mapping.transform(moving)
-
-    # We show the registration result with:
-    regtools.overlay_slices(static, warped_moving, None, 0, "Static", "Moving",
-                            "%s%s" % (working_dir, "/transformed_sagittal.png"))
-    regtools.overlay_slices(static, warped_moving, None, 1, "Static", "Moving",
-                            "%s%s" % (working_dir, "/transformed_coronal.png"))
-    regtools.overlay_slices(static, warped_moving, None, 2, "Static", "Moving",
-                            "%s%s" % (working_dir, "/transformed_axial.png"))
-
-    return mapping, affine_map
+    params = profiles[profile or _profile]
+    template = get_syn_template(template_path, nbins=params["mi_bins"], sampling_prop=params["mi_sampling"])
+    return template.register(fa_path, working_dir, profile=profile)
 
 
 def normalize_xform(img):
@@ -122,13 +122,16 @@ def s3_get_data(bucket, remote, local, public=False, force=False):
     out = subprocess.check_output("echo \"\n\n\n\n\n\n\nDATA ARRIVED\n\n\n\n\n\n\" {}".format(local), shell=True)
     print(out)
 
-def s3_push_data(bucket, remote, outDir, modifier, creds=True, debug=True):
+def s3_push_data(bucket, remote, outDir, modifier, creds=True, debug=True, exclude=()):
     # TODO : use boto3 for this instead
     cmd = 'aws s3 cp --exclude "tmp/*" {} s3://{}/{}/{}/{}/ --recursive --acl public-read'
     dataset = remote.split('/')[0]
     rest_of_path_list = remote.split('/')[1:]
     rest_of_path = os.path.join(*rest_of_path_list)
     cmd = cmd.format(outDir, bucket, dataset, modifier, rest_of_path)
+    # Further patterns, relative to outDir, that are not pushed
+    for pattern in exclude:
+        cmd += ' --exclude "{}"'.format(pattern)
     if not creds:
         print("Note: no credentials provided, may fail to push big files.")
         cmd += " --no-sign-request"
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Benchmark the in-process dipy registration backend of reg_utils.align against flirt, on the BNU1 test subject.
+Registers the mean B0 to the T1w (6 DOF) and, when FSLDIR is set, the T1w to the MNI template (12 DOF), and reports
+the runtime of each backend and the disagreement between their transforms.
+
+Usage:
+    python tests/benchmarks/bench_affine_backend.py
+    python tests/benchmarks/bench_affine_backend.py --dwi dwi.nii.gz --bval dwi.bval --t1w T1w.nii.gz
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from ndmg.utils import reg_utils as mgru
+
+BNU1 = Path(__file__).parent.parent / "data" / "BNU1" / "sub-0025864" / "ses-1"
+
+
+def mean_b0(dwi, bval, out):
+    """
+    Saves the mean of the b=0 volumes of a dwi image.
+    """
+    img = nib.load(dwi)
+    bvals = np.loadtxt(bval)
+    b0 = np.asanyarray(img.dataobj)[..., bvals < 50].mean(axis=-1).astype(np.float32)
+    nib.save(nib.Nifti1Image(b0, img.affine), out)
+    return out
+
+
+def rms_deviation(xfm1, xfm2, img):
+    """
+    Mean displacement, in mm, between two FLIRT matrices over the corners of the input field of view.
+    """
+    shape = np.array(img.shape[:3]) - 1
+    zooms = np.array(img.header.get_zooms()[:3])
+    corners = np.array([[i, j, k, 1] for i in (0, 1) for j in (0, 1) for k in (0, 1)], dtype=float)
+    corners[:, :3] *= shape * zooms
+    return np.mean(np.linalg.norm((corners.dot(xfm1.T) - corners.dot(xfm2.T))[:, :3], axis=1))
+
+
+def run_backend(backend, inp, ref, xfm, out, dof):
+    mgru.set_backend(backend)
+    start_time = time.time()
+    mgru.align(inp, ref, xfm=xfm, out=out, dof=dof, searchrad=True, interp="trilinear", cost="mutualinfo", bins=256)
+    runtime = time.time() - start_time
+    print("%s%s%s" % ("{} runtime: ".format(backend), str(np.round(runtime, 1)), "s"))
+    return np.loadtxt(xfm), runtime
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark in-process affine registration against flirt")
+    parser.add_argument("--dwi", default=str(BNU1 / "dwi" / "sub-0025864_ses-1_dwi.nii.gz"))
+    parser.add_argument("--bval", default=str(BNU1 / "dwi" / "sub-0025864_ses-1_dwi.bval"))
+    parser.add_argument("--t1w", default=str(BNU1 / "anat" / "sub-0025864_ses-1_T1w.nii.gz"))
+    result = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    b0 = mean_b0(result.dwi, result.bval, os.path.join(workdir, "b0.nii.gz"))
+    cases = [("B0 --> T1w", b0, result.t1w, 6)]
+    if "FSLDIR" in os.environ:
+        template = os.path.join(os.environ["FSLDIR"], "data/standard/MNI152_T1_2mm_brain.nii.gz")
+        cases.append(("T1w --> MNI", result.t1w, template, 12))
+    has_flirt = shutil.which("flirt") is not None
+    if not has_flirt:
+        print("flirt not found, timing the dipy backend only")
+
+    for name, inp, ref, dof in cases:
+        print("{} ({} DOF)".format(name, dof))
+        outputs = {}
+        for backend in ["fsl", "dipy"] if has_flirt else ["dipy"]:
+            outputs[backend] = run_backend(
+                backend, inp, ref, os.path.join(workdir, backend + ".mat"),
+                os.path.join(workdir, backend + ".nii.gz"), dof
+            )
+        if has_flirt:
+            (fsl_xfm, fsl_time), (dipy_xfm, dipy_time) = outputs["fsl"], outputs["dipy"]
+            print("%s%s%s" % ("Speedup: ", str(np.round(fsl_time / dipy_time, 1)), "x"))
+            deviation = rms_deviation(fsl_xfm, dipy_xfm, nib.load(inp))
+            print("%s%s%s" % ("Mean corner displacement between backends: ", str(np.round(deviation, 2)), "mm"))
+    shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
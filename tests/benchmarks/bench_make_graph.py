@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Benchmark the vectorized connectome engine in graph_tools.make_graph against the per-streamline loop it replaced.
+
+Usage:
+    python tests/benchmarks/bench_make_graph.py --n-streamlines 100000
+    python tests/benchmarks/bench_make_graph.py --trk streamlines.trk --labels labels_in_dwi.nii.gz
+"""
+
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from itertools import combinations
+
+import networkx as nx
+import nibabel as nib
+import numpy as np
+from dipy.tracking._utils import _mapping_to_voxel, _to_voxel_coordinates
+from dipy.tracking.streamline import Streamlines
+
+from ndmg.graph import gen_graph as mgg
+
+
+def make_graph_loop(tracks, rois, overlap_thr=1, voxel_size=2):
+    """
+    The per-streamline implementation of graph_tools.make_graph prior to the vectorized engine.
+    """
+    lin_T, offset = _mapping_to_voxel(np.eye(4), voxel_size)
+    mx = len(np.unique(rois.astype(np.int64))) - 1
+    g = nx.Graph(ecount=0, vcount=mx)
+    edge_dict = defaultdict(int)
+    node_dict = dict(zip(np.unique(rois) + 1, np.arange(mx) + 1))
+    for node in range(1, mx + 1):
+        g.add_node(node)
+    for s in tracks:
+        i, j, k = _to_voxel_coordinates(s, lin_T, offset).T
+        lab_arr = rois[i, j, k]
+        endlabels = []
+        for lab in np.unique(lab_arr):
+            if lab > 0:
+                if np.sum(lab_arr == lab) >= overlap_thr:
+                    endlabels.append(node_dict[lab])
+        for edge in combinations(endlabels, 2):
+            lst = tuple([int(node) for node in edge])
+            edge_dict[tuple(sorted(lst))] += 1
+        edge_list = [(k[0], k[1], v) for k, v in edge_dict.items()]
+        g.add_weighted_edges_from(edge_list)
+    conn_matrix = np.array(nx.to_numpy_matrix(g))
+    conn_matrix = np.asmatrix(np.maximum(conn_matrix, conn_matrix.transpose()))
+    return nx.from_numpy_matrix(conn_matrix)
+
+
+def synthetic_data(n_streamlines, n_labels, shape=(91, 109, 91), seed=42):
+    rng = np.random.RandomState(seed)
+    rois = rng.randint(0, n_labels + 1, size=shape).astype(np.int32)
+    lengths = rng.randint(40, 200, size=n_streamlines)
+    starts = rng.uniform(10, np.array(shape) - 10, size=(n_streamlines, 3))
+    ids = np.repeat(np.arange(n_streamlines), lengths)
+    walk = np.cumsum(rng.normal(scale=0.5, size=(lengths.sum(), 3)), axis=0)
+    walk -= walk[np.cumsum(lengths) - lengths][ids]
+    points = np.clip(starts[ids] + walk, 0, np.array(shape) - 1).astype(np.float32)
+    tracks = Streamlines(np.split(points, np.cumsum(lengths)[:-1]))
+    return tracks, rois
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark connectome construction from streamlines")
+    parser.add_argument("--trk", help="Streamlines (.trk) in the voxel space of --labels")
+    parser.add_argument("--labels", help="Label volume (.nii.gz)")
+    parser.add_argument("--n-streamlines", type=int, default=20000)
+    parser.add_argument("--n-labels", type=int, default=200)
+    parser.add_argument("--skip-loop", action="store_true", help="Only time the vectorized engine")
+    result = parser.parse_args()
+
+    if result.trk and result.labels:
+        tracks = nib.streamlines.load(result.trk).streamlines
+        rois = nib.load(result.labels).get_data().astype("int")
+    else:
+        tracks, rois = synthetic_data(result.n_streamlines, result.n_labels)
+
+    print("# of Streamlines: {}".format(len(tracks)))
+    print("# of Labels: {}".format(len(np.unique(rois)) - 1))
+
+    graph = mgg.graph_tools.__new__(mgg.graph_tools)
+    graph.rois = rois
+    graph.tracks = tracks
+    graph.modal = "dwi"
+
+    start_time = time.time()
+    g_vec = graph.make_graph()
+    vec_time = time.time() - start_time
+    print("%s%s%s" % ("Vectorized runtime: ", str(np.round(vec_time, 2)), "s"))
+
+    if not result.skip_loop:
+        start_time = time.time()
+        g_loop = make_graph_loop(tracks, rois)
+        loop_time = time.time() - start_time
+        print("%s%s%s" % ("Loop runtime: ", str(np.round(loop_time, 2)), "s"))
+        print("%s%s%s" % ("Speedup: ", str(np.round(loop_time / vec_time, 1)), "x"))
+        identical = np.array_equal(g_vec.to_dense(), nx.to_numpy_matrix(g_loop))
+        print("Identical connectomes: {}".format(identical))
+
+
+if __name__ == "__main__":
+    main()
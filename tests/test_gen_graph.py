@@ -0,0 +1,194 @@
+import numpy as np
+import nibabel as nib
+import networkx as nx
+from itertools import combinations
+from collections import defaultdict
+from ndmg.graph import gen_graph as mgg
+
+
+def make_labels(tmp_path, shape=(20, 20, 20), n_labels=12, seed=0, name="labels"):
+    rng = np.random.RandomState(seed)
+    rois = rng.randint(0, n_labels + 1, size=shape).astype(np.int32)
+    rois[:, :, :2] = 0
+    roi_file = str(tmp_path / "{}.nii.gz".format(name))
+    nib.save(nib.Nifti1Image(rois, np.eye(4)), roi_file)
+    return roi_file, rois
+
+
+def make_tracks(shape=(20, 20, 20), n_tracks=200, seed=0):
+    rng = np.random.RandomState(seed)
+    tracks = []
+    for _ in range(n_tracks):
+        n = rng.randint(2, 30)
+        tracks.append(rng.uniform(0, np.array(shape) - 1, size=(n, 3)).astype(np.float32))
+    return tracks
+
+
+def reference_matrix(tracks, rois, overlap_thr=1):
+    """Per-streamline labeling, as done before the vectorized engine."""
+    mx = len(np.unique(rois)) - 1
+    edge_dict = defaultdict(int)
+    for s in tracks:
+        i, j, k = np.floor(s + 0.5).astype(int).T
+        lab_arr = rois[i, j, k]
+        endlabels = [lab for lab in np.unique(lab_arr) if lab > 0 and np.sum(lab_arr == lab) >= overlap_thr]
+        for edge in combinations(endlabels, 2):
+            edge_dict[tuple(sorted(edge))] += 1
+    conn = np.zeros((mx, mx))
+    for (a, b), w in edge_dict.items():
+        conn[a - 1, b - 1] = w
+        conn[b - 1, a - 1] = w
+    return conn
+
+
+def test_make_graph_matches_reference(tmp_path):
+    roi_file, rois = make_labels(tmp_path)
+    tracks = make_tracks()
+    for overlap_thr in [1, 2]:
+        g1 = mgg.graph_tools(rois=roi_file, tracks=tracks, affine=np.eye(4), namer=None,
+                             connectome_path=str(tmp_path / "conn.ssv"))
+        g = g1.make_graph(overlap_thr=overlap_thr, voxel_size=1, chunk_size=37)
+        assert np.array_equal(g.to_dense(), reference_matrix(tracks, rois, overlap_thr=overlap_thr))
+
+
+def test_connectome_exports(tmp_path):
+    conn = reference_matrix(make_tracks(), make_labels(tmp_path)[1])
+    g = mgg.connectome(conn, np.arange(1, conn.shape[0] + 1))
+    g_nx = nx.convert_node_labels_to_integers(nx.from_numpy_matrix(np.asmatrix(conn)), first_label=1)
+    assert g.number_of_edges() == g_nx.number_of_edges()
+
+    nx.write_weighted_edgelist(g_nx, str(tmp_path / "nx.ssv"), delimiter=" ", encoding="utf-8")
+    g.write_edgelist(str(tmp_path / "sparse.ssv"))
+    assert (tmp_path / "nx.ssv").read_text() == (tmp_path / "sparse.ssv").read_text()
+
+    g.write_graphml(str(tmp_path / "sparse.graphml"))
+    g_read = nx.read_graphml(str(tmp_path / "sparse.graphml"), node_type=int)
+    assert np.array_equal(nx.to_numpy_array(g_read, nodelist=sorted(g_read.nodes())), conn)
+    assert np.array_equal(nx.to_numpy_array(g.to_networkx(), nodelist=sorted(g_nx.nodes())), conn)
+
+
+def test_make_graphs_single_pass(tmp_path):
+    tracks = make_tracks()
+    graphs = []
+    for seed, n_labels in enumerate([5, 12, 40]):
+        roi_file, rois = make_labels(tmp_path, n_labels=n_labels, seed=seed, name="labels_{}".format(seed))
+        graphs.append(mgg.graph_tools(rois=roi_file, tracks=tracks, affine=np.eye(4), namer=None,
+                                      connectome_path=str(tmp_path / "conn.ssv")))
+    conns = mgg.make_graphs(graphs, voxel_size=1, chunk_size=50)
+    for g1, g in zip(graphs, conns):
+        assert g1.g is g
+        assert np.array_equal(g.to_dense(), reference_matrix(tracks, g1.rois))
+
+
+def test_make_graph_parallel(tmp_path):
+    roi_file, rois = make_labels(tmp_path)
+    tracks = make_tracks(n_tracks=500)
+    g1 = mgg.graph_tools(rois=roi_file, tracks=tracks, affine=np.eye(4), namer=None,
+                         connectome_path=str(tmp_path / "conn.ssv"))
+    g = g1.make_graph(voxel_size=1, chunk_size=60, n_jobs=3)
+    assert np.array_equal(g.to_dense(), reference_matrix(tracks, rois))
+
+
+def test_make_graph_endpoint_margin(tmp_path):
+    roi_file, rois = make_labels(tmp_path)
+    tracks = make_tracks()
+    g1 = mgg.graph_tools(rois=roi_file, tracks=tracks, affine=np.eye(4), namer=None,
+                         connectome_path=str(tmp_path / "conn.ssv"))
+    g = g1.make_graph(error_margin=2, overlap_thr=2, voxel_size=1, chunk_size=37)
+
+    # Reference: dilate each endpoint with get_sphere, one coordinate at a time
+    endpoint_tracks = []
+    for s in tracks:
+        coords = np.floor(s[[0, -1]] + 0.5).astype(int)
+        endpoint_tracks.append(np.vstack([mgg.get_sphere(c, 2, (1, 1, 1), rois.shape) for c in coords]))
+    assert np.array_equal(g.to_dense(), reference_matrix(endpoint_tracks, rois, overlap_thr=2))
+
+
+def test_make_graph_edge_attributes(tmp_path):
+    roi_file, rois = make_labels(tmp_path)
+    tracks = make_tracks()
+    fa = np.random.RandomState(1).uniform(0, 1, size=rois.shape).astype(np.float32)
+    voxel_size = 2
+    mx = len(np.unique(rois)) - 1
+    length_sum, fa_sum = np.zeros((mx, mx)), np.zeros((mx, mx))
+    for s in tracks:
+        i, j, k = np.floor(s + 0.5).astype(int).T
+        labs = [lab for lab in np.unique(rois[i, j, k]) if lab > 0]
+        for a, b in combinations(labs, 2):
+            length_sum[a - 1, b - 1] += np.sum(np.linalg.norm(np.diff(s, axis=0), axis=1)) * voxel_size
+            fa_sum[a - 1, b - 1] += fa[i, j, k].mean()
+    count = np.triu(reference_matrix(tracks, rois))
+    with np.errstate(invalid="ignore"):
+        length_mean = np.nan_to_num(length_sum / count)
+        fa_mean = np.nan_to_num(fa_sum / count)
+
+    g1 = mgg.graph_tools(rois=roi_file, tracks=tracks, affine=np.eye(4), namer=None,
+                         connectome_path=str(tmp_path / "conn.ssv"))
+    for n_jobs in [1, 2]:
+        g = g1.make_graph(voxel_size=voxel_size, chunk_size=37, n_jobs=n_jobs, edge_lengths=True,
+                          scalar_maps={"fa": fa})
+        assert np.allclose(g.to_dense(weight="length"), length_mean + length_mean.T, atol=1e-3)
+        assert np.allclose(g.to_dense(weight="fa"), fa_mean + fa_mean.T, atol=1e-5)
+
+    g1.save_graph(str(tmp_path / "conn.ssv"))
+    assert (tmp_path / "conn_length.ssv").exists() and (tmp_path / "conn_fa.ssv").exists()
+
+
+def test_cor_graph_matches_corrcoef(tmp_path):
+    rng = np.random.RandomState(0)
+    ts = rng.randn(50, 80)
+    ts[3] = 1.0
+    g1 = mgg.graph_tools(rois=make_labels(tmp_path)[0], tracks=[], affine=np.eye(4), namer=None,
+                         connectome_path=str(tmp_path / "conn.ssv"), sens="func")
+    conn = g1.cor_graph((ts, np.arange(1, 51)), block_size=16)
+    assert conn.dtype == np.float32
+    assert np.allclose(conn, np.abs(np.nan_to_num(np.corrcoef(ts))), atol=1e-6)
+
+    fisher = mgg.correlation_matrix(ts, kind="fisher_z", absolute=False)
+    ref = np.nan_to_num(np.corrcoef(ts))
+    np.fill_diagonal(ref, 0)
+    assert np.allclose(fisher, np.arctanh(ref), atol=1e-5)
+
+    g1.save_graph(str(tmp_path / "conn.csv"))
+    assert np.allclose(np.loadtxt(str(tmp_path / "conn.csv"), delimiter=",", skiprows=1), conn, atol=1e-6)
+
+
+def test_correlation_matrix_ledoit_wolf():
+    from sklearn.covariance import ledoit_wolf
+
+    rng = np.random.RandomState(0)
+    # More timesteps than ROIs, and fewer, where shrinkage matters most
+    for n_rois, n_timesteps in [(10, 60), (30, 12)]:
+        ts = rng.randn(n_rois, n_timesteps) + rng.randn(1, n_timesteps)
+        ts[3] = 1.0
+        conn = mgg.correlation_matrix(ts, kind="ledoit_wolf", absolute=False)
+        assert conn.dtype == np.float32
+
+        # sklearn's shrunk covariance of the z-scored timeseries, whose sample covariance is the correlation
+        valid = np.arange(n_rois) != 3
+        z = ts[valid] - ts[valid].mean(axis=1, keepdims=True)
+        z /= np.linalg.norm(z, axis=1, keepdims=True)
+        ref, shrinkage = ledoit_wolf(z.T * np.sqrt(n_timesteps), assume_centered=True)
+        assert 0 < shrinkage < 1
+        assert np.allclose(conn[np.ix_(valid, valid)], ref, atol=1e-6)
+        assert not conn[3].any() and not conn[:, 3].any()
+
+
+def test_make_graphs_edge_lengths_1mm(tmp_path):
+    roi_file, rois = make_labels(tmp_path)
+    tracks = make_tracks()
+    mx = len(np.unique(rois)) - 1
+    length_sum = np.zeros((mx, mx))
+    for s in tracks:
+        i, j, k = np.floor(s + 0.5).astype(int).T
+        labs = [lab for lab in np.unique(rois[i, j, k]) if lab > 0]
+        for a, b in combinations(labs, 2):
+            length_sum[a - 1, b - 1] += np.sum(np.linalg.norm(np.diff(s, axis=0), axis=1))
+    count = np.triu(reference_matrix(tracks, rois))
+    with np.errstate(invalid="ignore"):
+        length_mean = np.nan_to_num(length_sum / count)
+
+    g1 = mgg.graph_tools(rois=roi_file, tracks=tracks, affine=np.eye(4), namer=None,
+                         connectome_path=str(tmp_path / "conn.ssv"))
+    [g] = mgg.make_graphs([g1], voxel_size=1, chunk_size=37, edge_lengths=True)
+    assert np.allclose(g.to_dense(weight="length"), length_mean + length_mean.T, atol=1e-3)
@@ -0,0 +1,178 @@
+import numpy as np
+import nibabel as nib
+from dipy.core.gradients import gradient_table
+from dipy.core.sphere import disperse_charges, HemiSphere
+from dipy.sims.voxel import multi_tensor
+from ndmg.track import gen_track as mgt
+
+
+def make_gtab(n_dirs=40, seed=0):
+    rng = np.random.RandomState(seed)
+    theta, phi = np.pi * rng.rand(n_dirs), 2 * np.pi * rng.rand(n_dirs)
+    hemisphere, _ = disperse_charges(HemiSphere(theta=theta, phi=phi), 2000)
+    bvecs = np.vstack([np.zeros((3, 3)), hemisphere.vertices])
+    bvals = np.hstack([np.zeros(3), 1000 * np.ones(n_dirs)])
+    return gradient_table(bvals, bvecs)
+
+
+def make_dwi(gtab, shape=(6, 6, 5), seed=0):
+    rng = np.random.RandomState(seed)
+    mevals = np.array([[0.0015, 0.0003, 0.0003], [0.0015, 0.0003, 0.0003]])
+    data = np.zeros(shape + (len(gtab.bvals),))
+    for idx in np.ndindex(*shape):
+        angles = [tuple(rng.uniform(0, 90, 2)), tuple(rng.uniform(0, 90, 2))]
+        data[idx], _ = multi_tensor(gtab, mevals, S0=100, angles=angles, fractions=[50, 50], snr=None)
+    mask = rng.rand(*shape) > 0.2
+    return data.astype(np.float32), mask
+
+
+def test_fit_model_csd_parallel():
+    from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
+    from dipy.reconst.shm import SphHarmFit
+
+    gtab = make_gtab()
+    data, mask = make_dwi(gtab)
+    model = ConstrainedSphericalDeconvModel(gtab, (np.array([0.0015, 0.0003, 0.0003]), 100), sh_order=6)
+    serial = model.fit(data, mask=mask)
+    fit = mgt.fit_model(model, data, mask, n_jobs=2, chunk_size=40)
+    # The chunked path rebuilds a SphHarmFit; the serial fallback would return the model's own fit type
+    assert type(fit) is SphHarmFit
+    assert fit.shm_coeff.shape == serial.shm_coeff.shape
+    assert np.allclose(fit.shm_coeff, serial.shm_coeff, atol=1e-6)
+    assert not fit.shm_coeff[~mask].any()
+
+
+def test_load_streamlines_float16(tmp_path):
+    rng = np.random.RandomState(0)
+    streamlines = [rng.uniform(0, 50, size=(n, 3)).astype(np.float32) for n in (45, 60, 10, 52)]
+    streams = str(tmp_path / "tracks.npz")
+    with mgt.trk_stream(streams, {}, min_length=40, float16=True, buffer_size=2) as sink:
+        sink.write(streamlines)
+    loaded, sidecar = mgt.load_streamlines(streams)
+    kept = [sl for sl in streamlines if len(sl) > 40]
+    assert len(loaded) == len(kept) == sidecar["nb_streamlines"]
+    for sl, ref in zip(loaded, kept):
+        assert sl.dtype == np.float32
+        assert np.allclose(sl, ref.astype(np.float16))
+    # Streamlines are independent of the loaded buffer once built
+    loaded.extend([kept[0]])
+    assert len(loaded) == len(kept) + 1
+
+    empty = str(tmp_path / "empty.npz")
+    with mgt.trk_stream(empty, {}, float16=True):
+        pass
+    assert len(mgt.load_streamlines(empty)[0]) == 0
+
+
+def make_tracking(mod_type, seeds, shape=(14, 10, 8), **kwargs):
+    from dipy.data import get_sphere
+    from dipy.direction import DeterministicMaximumDirectionGetter, ProbabilisticDirectionGetter
+    from dipy.tracking.local import BinaryTissueClassifier
+
+    # Two crossing fiber populations along x and y in a white matter box
+    sphere = get_sphere("repulsion724")
+    lobes = np.abs(sphere.vertices[:, 0]) ** 20 + 0.7 * np.abs(sphere.vertices[:, 1]) ** 20
+    pmf = np.tile(lobes, shape + (1,))
+    wm = np.zeros(shape, dtype=bool)
+    wm[1:-1, 1:-1, 2:-2] = True
+    getter = ProbabilisticDirectionGetter if mod_type == "prob" else DeterministicMaximumDirectionGetter
+    trct = mgt.run_track(None, None, None, None, None, None, None, mod_type, "local", "csd", seeds, np.eye(4),
+                         **kwargs)
+    trct.direction_getter = getter.from_pmf(pmf, max_angle=60.0, sphere=sphere)
+    trct.tiss_classifier = BinaryTissueClassifier(wm)
+    trct.crop_affine = np.eye(4)
+    return trct
+
+
+def make_seeds(n_seeds=60, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.uniform([2, 2, 3], [11, 7, 4], size=(n_seeds, 3))
+
+
+def assert_same_streamlines(streamlines, reference):
+    assert len(streamlines) == len(reference)
+    for sl, ref in zip(streamlines, reference):
+        assert np.array_equal(sl, ref)
+
+
+def test_reconstruct_reproducible_across_n_jobs():
+    from dipy.tracking.local import LocalTracking
+
+    seeds = make_seeds()
+    tracked = {}
+    for mod_type in ["prob", "det"]:
+        runs = []
+        for n_jobs, chunk_size in [(1, None), (2, None), (3, None), (2, 7)]:
+            trct = make_tracking(mod_type, seeds, n_jobs=n_jobs, seed_chunk_size=chunk_size, random_seed=7)
+            runs.append(trct.reconstruct(LocalTracking, step_size=0.5, return_all=True))
+        assert len(runs[0]) >= len(seeds)
+        for streamlines in runs[1:]:
+            assert_same_streamlines(streamlines, runs[0])
+        tracked[mod_type] = runs[0]
+
+    # The random seed does change probabilistic streamlines
+    other = make_tracking("prob", seeds, random_seed=8).reconstruct(LocalTracking, step_size=0.5, return_all=True)
+    assert any(len(sl) != len(ref) or not np.allclose(sl, ref) for sl, ref in zip(other, tracked["prob"]))
+
+
+def make_mask(tmp_path, shape=(14, 10, 8)):
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[2:12, 2:8, 3:5] = 1
+    mask_file = str(tmp_path / "mask.nii.gz")
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), mask_file)
+    return mask_file, mask
+
+
+def test_seed_stream(tmp_path):
+    mask_file, mask = make_mask(tmp_path)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    n_voxels = int(mask.sum())
+    seeds = mgt.seed_stream(mask_file, affine, dens=3, batch_size=50, random_seed=0)
+    batches = list(seeds)
+    assert len(seeds) == 3 * n_voxels
+    # Batches hold whole voxels: batch_size // dens voxels each, and the rest in the last one
+    assert [len(batch) for batch in batches[:-1]] == [48] * (len(batches) - 1)
+    assert 0 < len(batches[-1]) <= 48
+    all_seeds = np.vstack(batches)
+    assert len(all_seeds) == len(seeds)
+    voxels = np.round(all_seeds / 2.0).astype(int)
+    assert mask[tuple(voxels.T)].all()
+    assert np.array_equal(np.bincount(np.ravel_multi_index(voxels.T, mask.shape), minlength=mask.size), np.ravel(mask) * 3)
+    assert np.array_equal(np.vstack(list(seeds)), all_seeds)
+
+    # Shuffling changes the voxel order, but with a fixed random seed every voxel gets the same seeds
+    shuffled = mgt.seed_stream(mask_file, affine, dens=3, batch_size=50, shuffle=True, random_seed=0)
+    shuffled_seeds = np.vstack(list(shuffled))
+    assert not np.array_equal(shuffled_seeds, all_seeds)
+    assert np.array_equal(np.vstack(list(shuffled)), shuffled_seeds)
+    assert np.array_equal(all_seeds[np.lexsort(all_seeds.T)], shuffled_seeds[np.lexsort(shuffled_seeds.T)])
+
+    other = np.vstack(list(mgt.seed_stream(mask_file, affine, dens=3, batch_size=50, random_seed=1)))
+    assert not np.array_equal(other, all_seeds)
+
+
+def test_reconstruct_max_streamlines(tmp_path):
+    from dipy.tracking.local import LocalTracking
+
+    mask_file, _ = make_mask(tmp_path)
+    seeds = mgt.seed_stream(mask_file, np.eye(4), dens=2, batch_size=20, shuffle=True, random_seed=0)
+    full = make_tracking("prob", seeds).reconstruct(LocalTracking, step_size=0.5, return_all=True)
+    budget = 25
+    assert len(full) > budget
+    for n_jobs in [1, 2]:
+        # Tracking stops inside a batch, and keeps the first streamlines in seed order
+        trct = make_tracking("prob", seeds, n_jobs=n_jobs, seed_chunk_size=3, max_streamlines=budget)
+        streamlines = trct.reconstruct(LocalTracking, step_size=0.5, return_all=True)
+        assert_same_streamlines(streamlines, full[:budget])
+
+        # With a sink, the budget counts the streamlines its length filter accepts
+        streams = str(tmp_path / "tracks_{}.trk".format(n_jobs))
+        trct = make_tracking("prob", seeds, n_jobs=n_jobs, seed_chunk_size=3, max_streamlines=budget)
+        with mgt.trk_stream(streams, {}, min_length=3) as sink:
+            trct.sink = sink
+            trct.reconstruct(LocalTracking, step_size=0.5, return_all=True)
+        kept = [sl for sl in full if len(sl) > 3][:budget]
+        assert sink.nb_streamlines == budget
+        loaded = mgt.load_streamlines(streams)[0]
+        assert len(loaded) == budget
+        assert all(np.allclose(sl, ref, atol=1e-5) for sl, ref in zip(loaded, kept))
@@ -0,0 +1,55 @@
+import numpy as np
+from scipy import ndimage
+from ndmg.utils import mask_utils as mgmu
+
+
+def box(shape=(12, 12, 12), lo=3, hi=9):
+    mask = np.zeros(shape, dtype=bool)
+    mask[lo:hi, lo:hi, lo:hi] = True
+    return mask
+
+
+def test_threshold_and_binarize():
+    data = np.array([-1.0, 0.0, 0.1, 0.15, 0.2], dtype=np.float32)
+    # fslmaths -thr keeps values at or above the threshold
+    assert np.allclose(mgmu.threshold(data, 0.15), [0, 0, 0, 0.15, 0.2])
+    assert np.array_equal(mgmu.binarize(data), [False, False, True, True, True])
+
+
+def test_sphere_kernel_anisotropic():
+    kernel = mgmu.sphere_kernel(2, (1.0, 1.0, 2.0))
+    # 2mm reaches two 1mm voxels along x and y, and one 2mm voxel along z
+    assert kernel.shape == (5, 5, 3)
+    assert kernel[2, 2, 0] and kernel[0, 2, 1] and kernel[2, 4, 1]
+    assert not kernel[0, 0, 1] and not kernel[1, 2, 0]
+
+
+def test_erode_anisotropic_and_border():
+    eroded = mgmu.erode(box(), 2, (1.0, 1.0, 2.0))
+    expected = np.zeros_like(eroded)
+    expected[5:7, 5:7, 4:8] = True
+    assert np.array_equal(eroded, expected)
+
+    # Voxels outside the image do not erode a mask that touches the border
+    full = np.ones((6, 6, 6), dtype=bool)
+    assert mgmu.erode(full, 2, (1.0, 1.0, 1.0)).all()
+
+
+def test_edge():
+    mask = box()
+    edge = mgmu.edge(mask)
+    # Inside the mask, the edge is the layer of voxels with a face neighbour outside it
+    inner = ndimage.binary_erosion(mask, structure=ndimage.generate_binary_structure(3, 1))
+    assert np.array_equal(edge & mask, mask & ~inner)
+    # The central difference also marks the face neighbours just outside the mask
+    assert edge[2, 5, 5] and edge[9, 5, 5] and not edge[1, 5, 5]
+
+
+def test_interface_matches_fslmaths():
+    rng = np.random.RandomState(0)
+    gm, wm, cc, vent_csf, mask = [rng.rand(8, 8, 8) > 0.5 for _ in range(5)]
+    # fslmaths gm -mul wm -add cc -sub vent_csf -mas mask -bin, in floating point
+    total = gm.astype(float) * wm + cc - vent_csf
+    expected = (total * mask) > 0
+    assert np.array_equal(mgmu.interface(gm, wm, cc, vent_csf, mask), expected)
+    assert mgmu.interface(gm, wm, cc, vent_csf, mask).dtype == bool
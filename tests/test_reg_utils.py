@@ -0,0 +1,137 @@
+import threading
+import numpy as np
+import nibabel as nib
+from ndmg.utils import reg_utils as mgru
+
+
+def test_job_runner_dependencies(tmp_path):
+    log = str(tmp_path / "order.txt")
+    runner = mgru.job_runner(n_jobs=4)
+    runner.add("a", "sleep 0.2 && echo a >> {}".format(log))
+    runner.add("b", "echo b >> {}".format(log), after=["a"])
+    runner.add("c", "echo c >> {}".format(log), after=["b"])
+    runner.add("d", "true")
+    results = runner.run()
+    assert open(log).read().split() == ["a", "b", "c"]
+    assert all(results[name]["returncode"] == 0 for name in "abcd")
+    assert results["a"]["runtime"] >= 0.2
+    assert all(isinstance(results[name]["runtime"], float) for name in "abcd")
+
+
+def test_job_runner_skips_after_failure():
+    runner = mgru.job_runner(n_jobs=2)
+    runner.add("fails", "false")
+    runner.add("skipped", "true", after=["fails"])
+    runner.add("after_skipped", "true", after=["skipped"])
+    runner.add("independent", "true")
+    results = runner.run()
+    assert results["fails"]["returncode"] not in (0, None)
+    assert results["skipped"] == dict(returncode=None, runtime=0.0)
+    assert results["after_skipped"]["returncode"] is None
+    assert results["independent"]["returncode"] == 0
+
+
+def test_job_runner_records_only_its_thread():
+    codes = []
+
+    def job():
+        # A wrapper called from another thread while this job is being recorded runs immediately
+        thread = threading.Thread(target=lambda: codes.append(mgru._system("exit 3")))
+        thread.start()
+        thread.join()
+        mgru._system("true")
+
+    runner = mgru.job_runner()
+    runner.add("job", job)
+    assert runner.jobs == [("job", ["true"], ())]
+    assert codes and codes[0] != 0
+
+
+def test_job_runner_overlaps_in_process_jobs():
+    import time
+
+    runner = mgru.job_runner(n_jobs=3)
+    runner.add("in_process", mgru._call, time.sleep, 0.5)
+    runner.add("in_process_2", mgru._call, time.sleep, 0.5)
+    runner.add("shell", "sleep 0.5")
+    start_time = time.time()
+    results = runner.run()
+    assert time.time() - start_time < 1.0
+    assert all(result["returncode"] == 0 for result in results.values())
+
+
+def make_image(affine, shape=(20, 24, 16)):
+    return nib.Nifti1Image(np.zeros(shape, dtype=np.float32), affine)
+
+
+# Radiological (det < 0) and neurological (det > 0) voxel-to-world affines
+RADIOLOGICAL = np.array([[-2.0, 0, 0, 20], [0, 2.0, 0, -30], [0, 0, 2.5, -10], [0, 0, 0, 1]])
+NEUROLOGICAL = np.array([[2.0, 0, 0, -20], [0, 2.0, 0, -30], [0, 0, 2.5, -10], [0, 0, 0, 1]])
+
+
+def test_fsl_scaled_voxel():
+    for affine in [RADIOLOGICAL, NEUROLOGICAL]:
+        img = make_image(affine)
+        corner = mgru.fsl_scaled_voxel(img).dot([0, 0, 0, 1])
+        # FSL scales voxel indices by the voxel sizes, and flips x for neurological images
+        expected_x = 0 if affine is RADIOLOGICAL else (img.shape[0] - 1) * 2.0
+        assert np.allclose(corner, [expected_x, 0, 0, 1])
+
+
+def test_dipy_fsl_conversion_round_trip():
+    rng = np.random.RandomState(0)
+    for inp_affine, ref_affine in [(RADIOLOGICAL, NEUROLOGICAL), (NEUROLOGICAL, RADIOLOGICAL),
+                                   (NEUROLOGICAL, NEUROLOGICAL)]:
+        inp, ref = make_image(inp_affine), make_image(ref_affine, shape=(18, 22, 20))
+        affine = np.eye(4)
+        affine[:3] += rng.uniform(-0.1, 0.1, size=(3, 4)) * [1, 1, 1, 50]
+        assert np.allclose(mgru.fsl2dipy(mgru.dipy2fsl(affine, inp, ref), inp, ref), affine)
+        assert np.allclose(mgru.dipy2fsl(mgru.fsl2dipy(affine, inp, ref), inp, ref), affine)
+
+
+def test_dipy_fsl_conversion_identity():
+    for affine in [RADIOLOGICAL, NEUROLOGICAL]:
+        img = make_image(affine)
+        assert np.allclose(mgru.dipy2fsl(np.eye(4), img, img), np.eye(4))
+        assert np.allclose(mgru.fsl2dipy(np.eye(4), img, img), np.eye(4))
+
+
+def test_dipy_fsl_conversion_translation():
+    shift = np.array([4.0, -2.0, 5.0])
+    dipy_affine = np.eye(4)
+    dipy_affine[:3, 3] = shift
+    for affine in [RADIOLOGICAL, NEUROLOGICAL]:
+        img = make_image(affine)
+        # dipy maps reference world to input world, so the input is the reference moved by `shift` in world space.
+        # FSL's scaled-voxel axes run along world -x, +y and +z for both orientations, so FLIRT moves the input by
+        # -shift along y and z and by +shift along x.
+        expected = np.eye(4)
+        expected[:3, 3] = [shift[0], -shift[1], -shift[2]]
+        assert np.allclose(mgru.dipy2fsl(dipy_affine, img, img), expected)
+
+
+def record(func, *args, **kwargs):
+    runner = mgru.job_runner()
+    runner.add("job", func, *args, **kwargs)
+    return runner.jobs[0][1]
+
+
+def test_transform_chain_split_and_order(tmp_path):
+    tmp = str(tmp_path)
+    chain = mgru.transform_chain().affine("a1.mat").affine("a2.mat").affine("a3.mat").warp("w.nii.gz")
+    chain.affine("p1.mat").affine("p2.mat")
+    cmds = record(chain.apply, "inp.nii.gz", "ref.nii.gz", "reg/out.nii.gz", tmp_dir=tmp)
+    # convert_xfm -concat B A applies A first, so every later affine goes first
+    assert cmds == [
+        "convert_xfm -omat {0}/out_premat_0.mat -concat a2.mat a1.mat".format(tmp),
+        "convert_xfm -omat {0}/out_premat.mat -concat a3.mat {0}/out_premat_0.mat".format(tmp),
+        "convert_xfm -omat {0}/out_postmat.mat -concat p2.mat p1.mat".format(tmp),
+        "applywarp --ref=ref.nii.gz --in=inp.nii.gz --out=reg/out.nii.gz --premat={0}/out_premat.mat "
+        "--warp=w.nii.gz --postmat={0}/out_postmat.mat --interp=nn".format(tmp),
+    ]
+
+
+def test_transform_chain_affines_only():
+    cmds = record(mgru.transform_chain().affine("a1.mat").apply, "inp.nii.gz", "ref.nii.gz", "out.nii.gz",
+                  interp="trilinear")
+    assert cmds == ["applywarp --ref=ref.nii.gz --in=inp.nii.gz --out=out.nii.gz --premat=a1.mat --interp=trilinear"]